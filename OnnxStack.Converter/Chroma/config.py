@@ -0,0 +1,4 @@
+text_bucket = 0
+rotary_tables = False
+conditioning = False
+modulation_size = 0 # distilled_guidance_layer modulation rows per timestep, recorded when the transformer is loaded
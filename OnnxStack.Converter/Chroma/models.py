@@ -1,3 +1,4 @@
+import config
 import torch
 from typing import Union, Tuple
 from diffusers import AutoencoderKL, ChromaTransformer2DModel
@@ -21,9 +22,12 @@ class RandomDataLoader:
 # TEXT ENCODER
 # -----------------------------------------------------------------------------
 def text_encoder_inputs(batchsize, torch_dtype):
-    return {
+    inputs = {
         "input_ids": torch.zeros((batchsize, 512), dtype=torch_dtype)
     }
+    if config.text_bucket:
+        inputs["attention_mask"] = torch.ones((batchsize, 512), dtype=torch.int64)
+    return inputs
 
 
 def text_encoder_load(model_name):
@@ -109,6 +113,14 @@ class WrappedChromaTransformer2DModel(ChromaTransformer2DModel):
         )
 
 
+class RotaryTables(torch.nn.Module):
+    # Replaces pos_embed: the img_ids/txt_ids inputs carry precomputed cos/sin tables [text + image, 128]
+    # (createRotaryTables.py), the transformer concatenates (txt_ids, img_ids) before pos_embed
+    def forward(self, ids):
+        rotary_sin, rotary_cos = ids.chunk(2)
+        return rotary_cos, rotary_sin
+
+
 def transformer_inputs(batchsize, torch_dtype, is_conversion_inputs=False):
     inputs = {
         "hidden_states": torch.rand((1, 4096, 64), dtype=torch_dtype),
@@ -118,11 +130,20 @@ def transformer_inputs(batchsize, torch_dtype, is_conversion_inputs=False):
         "txt_ids": torch.rand((512, 3), dtype=torch_dtype),
         "attention_mask": torch.rand((1, 4608), dtype=torch_dtype)
     }
+    if config.rotary_tables:
+        inputs["img_ids"] = torch.rand((4608, 128), dtype=torch_dtype)
+        inputs["txt_ids"] = torch.rand((4608, 128), dtype=torch_dtype)
+    if config.conditioning:
+        inputs = modulation_inputs(inputs)
     return inputs
 
 
 def transformer_load(model_name):
     model = WrappedChromaTransformer2DModel.from_pretrained(model_name, subfolder="transformer", torch_dtype=torch.float32)
+    if config.rotary_tables:
+        model.pos_embed = RotaryTables()
+    if config.conditioning:
+        modulation_load(model)
     return model
 
 
@@ -131,4 +152,80 @@ def transformer_conversion_inputs(model=None):
 
 
 def transformer_data_loader(data_dir, batchsize, *args, **kwargs):
-    return RandomDataLoader(transformer_inputs, batchsize, torch.float32)
\ No newline at end of file
+    return RandomDataLoader(transformer_inputs, batchsize, torch.float32)
+
+
+
+# -----------------------------------------------------------------------------
+# CONDITIONING
+# -----------------------------------------------------------------------------
+class ModulationInput(torch.nn.Module):
+    # Replaces distilled_guidance_layer, returns the precomputed conditioning modulation
+    def __init__(self):
+        super().__init__()
+        self.modulation = None
+
+    def forward(self, input_vec):
+        return self.modulation
+
+
+class Conditioning(torch.nn.Module):
+    # time_text_embed and the distilled_guidance_layer approximator, the shift/scale/gate of every block for all scheduled timesteps in one run
+    def __init__(self, transformer):
+        super().__init__()
+        self.time_text_embed = transformer.time_text_embed
+        self.distilled_guidance_layer = transformer.distilled_guidance_layer
+
+    def forward(self, timestep):
+        # timestep [steps] -> modulation [steps, modulation index, 3072], time_text_embed inlined so the guidance zeros follow the steps axis
+        embed = self.time_text_embed
+        timestep = timestep * 1000
+        timesteps_proj = embed.time_proj(timestep).to(timestep.dtype)
+        guidance_proj = embed.guidance_proj(torch.zeros_like(timestep)).to(timestep.dtype)
+        timestep_guidance = torch.cat([timesteps_proj, guidance_proj], dim=1).unsqueeze(1).expand(-1, embed.mod_proj.shape[0], -1)
+        mod_proj = embed.mod_proj.to(timestep.dtype).expand(timestep.shape[0], -1, -1)
+        return self.distilled_guidance_layer(torch.cat([timestep_guidance, mod_proj], dim=-1))
+
+
+def modulation_load(transformer):
+    # timestep input replaced by one conditioning modulation row, the other weight names are unchanged
+    transformer.distilled_guidance_layer = ModulationInput()
+    config.modulation_size = transformer.time_text_embed.mod_proj.shape[0]
+    forward = transformer.forward
+
+    def conditioning_forward(hidden_states, encoder_hidden_states, modulation, *args):
+        transformer.distilled_guidance_layer.modulation = modulation
+        # Placeholder, distilled_guidance_layer is the only time_text_embed consumer
+        timestep = torch.zeros((modulation.shape[0],), dtype=hidden_states.dtype)
+        return forward(hidden_states, encoder_hidden_states, timestep, *args)
+    transformer.forward = conditioning_forward
+
+
+def modulation_inputs(inputs):
+    # timestep -> modulation [batch, modulation index, 3072] at the timestep position
+    conditioning_inputs = {}
+    for name, value in inputs.items():
+        if name == "timestep":
+            conditioning_inputs["modulation"] = torch.rand((value.shape[0], config.modulation_size, 3072), dtype=value.dtype)
+        else:
+            conditioning_inputs[name] = value
+    return conditioning_inputs
+
+
+def conditioning_inputs(batchsize, torch_dtype):
+    return {
+        "timestep": torch.rand((28,), dtype=torch_dtype)
+    }
+
+
+def conditioning_load(model_name):
+    model = ChromaTransformer2DModel.from_pretrained(model_name, subfolder="transformer", torch_dtype=torch.float32)
+    return Conditioning(model)
+
+
+def conditioning_conversion_inputs(model=None):
+    return tuple(conditioning_inputs(1, torch.float32).values())
+
+
+def conditioning_data_loader(data_dir, batchsize, *args, **kwargs):
+    return RandomDataLoader(conditioning_inputs, batchsize, torch.float32)
@@ -4,4 +4,5 @@
 # --------------------------------------------------------------------------
 
 vae_sample_size = 1024
-unet_sample_size = 128
\ No newline at end of file
+unet_sample_size = 128
+attention_chunk = 0 # query tokens per attention chunk (ONNX Loop), 0 = full attention
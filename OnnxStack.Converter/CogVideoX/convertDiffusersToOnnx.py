@@ -5,11 +5,13 @@ import json
 import shutil
 import warnings
 from pathlib import Path
+import models
 from olive.workflows import run as olive_run
 from olive.model import ONNXModelHandler
+from ioManifest import save_io_manifest
 
 
-def optimize(script_dir: str, model_input: str, model_output: Path, submodel_names: list[str]):
+def optimize(script_dir: str, model_input: str, model_output: Path, submodel_names: list[str], io_dtype: str = "float32"):
     model_info = {}
     model_dir = model_input
    
@@ -24,6 +26,11 @@ def optimize(script_dir: str, model_input: str, model_output: Path, submodel_nam
             olive_config = json.load(fin)
 
         olive_config["input_model"]["config"]["model_path"] = model_dir
+        if io_dtype == "float16":
+            io_dtype_config(olive_config)
+        if submodel_name in ("vae_decoder_init", "vae_decoder_stream"):
+            # The cache inputs/outputs depend on the decoder blocks, resolved from the model
+            olive_config["input_model"]["config"]["io_config"] = models.vae_decoder_stream_io_config(model_dir, submodel_name == "vae_decoder_init")
         run_res = olive_run(olive_config)
         save_onnx_submodel(script_dir, submodel_name, model_info)
         print(f"Optimizing {submodel_name} complete.")
@@ -32,6 +39,12 @@ def optimize(script_dir: str, model_input: str, model_output: Path, submodel_nam
     return model_info
 
 
+def io_dtype_config(olive_config):
+    for olive_pass in olive_config["passes"].values():
+        if "keep_io_types" in olive_pass["config"]:
+            olive_pass["config"]["keep_io_types"] = False
+
+
 def save_onnx_models(model_dir, model_info, model_output, submodel_names):
     model_dir = Path(model_dir)
     model_output.mkdir(parents=True, exist_ok=True)
@@ -85,8 +98,10 @@ def parse_common_args(raw_args):
     parser = argparse.ArgumentParser("Common arguments")
     parser.add_argument("--input", required=True, type=str)
     parser.add_argument("--output", default=None, type=Path)
-    parser.add_argument("--modules", default="transformer", help="The modules to convert `transformer`")
+    parser.add_argument("--modules", default="transformer", help="The modules to convert `vae_decoder,vae_decoder_init,vae_decoder_stream,transformer`")
+    parser.add_argument("--attention_chunk", default=0, type=int, help="Export the transformer attention in query chunks of N tokens (ONNX Loop), scores are [N, keys] per head instead of [queries, keys], 0 = full attention")
     parser.add_argument("--clean", default=False, action="store_true", help="Deletes the Olive cache")
+    parser.add_argument("--io_dtype", default="float32", choices=["float32", "float16"], help="Graph input/output type of the float16 models, float16 drops the float32 casts at the graph boundary (io_manifest.json lists the types)")
     return parser.parse_known_args(raw_args)
 
 
@@ -95,6 +110,7 @@ def main(raw_args=None):
     model_input = common_args.input
     model_output = common_args.output
     submodel_names = common_args.modules.split(",")
+    config.attention_chunk = common_args.attention_chunk
     script_dir = Path(__file__).resolve().parent
 
     if model_output is None:
@@ -109,10 +125,13 @@ def main(raw_args=None):
     print(f'Input: {model_input}')
     print(f'Output: {model_output}')
     print(f'Modules: {submodel_names}')
+    print(f'Attention Chunk: {common_args.attention_chunk}')
+    print(f'IO Dtype: {common_args.io_dtype}')
     print('--------------------------------------')
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
-        optimize(script_dir, model_input, model_output, submodel_names)
+        optimize(script_dir, model_input, model_output, submodel_names, io_dtype=common_args.io_dtype)
+    save_io_manifest(model_output)
 
     clean(script_dir)
     print('Olive CogVideoX Conversion Complete.')
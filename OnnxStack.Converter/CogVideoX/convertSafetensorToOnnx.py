@@ -37,7 +37,9 @@ def parse_common_args(raw_args):
     parser.add_argument("--output", default=None, type=Path)
     parser.add_argument("--modules", default="tokenizer,tokenizer_2,tokenizer_3,text_encoder,text_encoder_2,text_encoder_3,vae_encoder,vae_decoder,transformer", help="The modules to convert `tokenizer,tokenizer_2,tokenizer_3,text_encoder,text_encoder_2,text_encoder_3,vae_encoder,vae_decoder,transformer`")
     parser.add_argument("--conversion", default="optimized", help="Type of conversion: optimized or unoptimized")
+    parser.add_argument("--attention_chunk", default=0, type=int, help="Export the transformer attention in query chunks of N tokens (ONNX Loop), scores are [N, keys] per head instead of [queries, keys], 0 = full attention")
     parser.add_argument("--clean", default=False, action="store_true", help="Deletes the Olive cache")
+    parser.add_argument("--io_dtype", default="float32", choices=["float32", "float16"], help="Graph input/output type of the float16 models, float16 drops the float32 casts at the graph boundary (io_manifest.json lists the types)")
     return parser.parse_known_args(raw_args)
 
 
@@ -1,6 +1,7 @@
 import config
 import torch
-from typing import Union, Tuple
+from typing import Optional, Union, Tuple
+from torch.utils._pytree import tree_flatten, tree_unflatten
 from diffusers import CogVideoXTransformer3DModel,AutoencoderKLCogVideoX
 
 
@@ -42,6 +43,103 @@ def vae_decoder_data_loader(data_dir, batchsize, *args, **kwargs):
 
 
 
+# -----------------------------------------------------------------------------
+# VAE DECODER STREAM
+# -----------------------------------------------------------------------------
+class CogVideoXStreamingDecoder(torch.nn.Module):
+    # Latent frame chunks per call, the causal conv conv_cache is carried as explicit inputs/outputs
+    # cache_spec None: first chunk (vae_decoder_init), else later chunks (vae_decoder_stream)
+    def __init__(self, vae, cache_spec=None):
+        super().__init__()
+        self.vae = vae
+        self.cache_spec = cache_spec
+        self.output_cache_spec = None
+
+    def forward(self, latent_sample, *cache):
+        conv_cache = None if self.cache_spec is None else tree_unflatten(list(cache), self.cache_spec)
+        if self.vae.post_quant_conv is not None:
+            latent_sample = self.vae.post_quant_conv(latent_sample)
+        sample, conv_cache = self.vae.decoder(latent_sample, conv_cache=conv_cache)
+        cache, self.output_cache_spec = tree_flatten(conv_cache)
+        return (sample, *cache)
+
+
+# The first chunk takes the odd frame, then num_latent_frames_batch_size (2) frames per chunk
+vae_stream_init_frames = 3
+vae_stream_frames = 2
+stream_cache = []
+
+
+def vae_decoder_stream_cache(model_name, height, width):
+    # First chunk cache tensors and their conv_cache structure, the vae_decoder_stream dummy inputs
+    decoder = vae_decoder_init_load(model_name)
+    with torch.no_grad():
+        cache = decoder(torch.rand((1, 16, vae_stream_init_frames, height, width)))[1:]
+    return decoder.vae, decoder.output_cache_spec, cache
+
+
+def vae_decoder_stream_io_config(model_name, init):
+    _, _, cache = vae_decoder_stream_cache(model_name, 8, 8)
+    cache_names = [f"cache_{index}" for index in range(len(cache))]
+    cache_out_names = [f"cache_out_{index}" for index in range(len(cache))]
+    dynamic_axes = {
+        "latent_sample": { "3": "height", "4": "width" },
+        "sample": { "3": "sample_height", "4": "sample_width" }
+    }
+    for index in range(len(cache)):
+        dynamic_axes[cache_names[index]] = { "3": f"cache_{index}_height", "4": f"cache_{index}_width" }
+        dynamic_axes[cache_out_names[index]] = { "3": f"cache_{index}_height", "4": f"cache_{index}_width" }
+    return {
+        "input_names": ["latent_sample"] + ([] if init else cache_names),
+        "output_names": ["sample"] + cache_out_names,
+        "dynamic_axes": dynamic_axes
+    }
+
+
+def vae_decoder_init_inputs(batchsize, torch_dtype):
+    return {
+        "latent_sample": torch.rand((1, 16, vae_stream_init_frames, 60, 90), dtype=torch_dtype)
+    }
+
+
+def vae_decoder_init_load(model_name):
+    model = AutoencoderKLCogVideoX.from_pretrained(model_name, subfolder="vae", torch_dtype=torch.float32)
+    return CogVideoXStreamingDecoder(model)
+
+
+def vae_decoder_init_conversion_inputs(model=None):
+    return tuple(vae_decoder_init_inputs(1, torch.float32).values())
+
+
+def vae_decoder_init_data_loader(data_dir, batchsize, *args, **kwargs):
+    return RandomDataLoader(vae_decoder_init_inputs, batchsize, torch.float32)
+
+
+def vae_decoder_stream_inputs(batchsize, torch_dtype):
+    inputs = {
+        "latent_sample": torch.rand((1, 16, vae_stream_frames, 60, 90), dtype=torch_dtype)
+    }
+    for index, value in enumerate(stream_cache):
+        inputs[f"cache_{index}"] = value.to(torch_dtype)
+    return inputs
+
+
+def vae_decoder_stream_load(model_name):
+    model, cache_spec, cache = vae_decoder_stream_cache(model_name, 60, 90)
+    stream_cache[:] = cache
+    return CogVideoXStreamingDecoder(model, cache_spec)
+
+
+def vae_decoder_stream_conversion_inputs(model=None):
+    return tuple(vae_decoder_stream_inputs(1, torch.float32).values())
+
+
+def vae_decoder_stream_data_loader(data_dir, batchsize, *args, **kwargs):
+    return RandomDataLoader(vae_decoder_stream_inputs, batchsize, torch.float32)
+
+
+
+
 # -----------------------------------------------------------------------------
 # TRANSFORMER
 # -----------------------------------------------------------------------------
@@ -72,6 +170,8 @@ def unet_inputs(batchsize, torch_dtype, is_conversion_inputs=False):
 
 def unet_load(model_name):
     model = CogVideoXTransformer3DModel.from_pretrained(model_name, subfolder="transformer", torch_dtype=torch.float32)
+    if config.attention_chunk:
+        attention_chunk_load(model)
     return model
 
 
@@ -80,4 +180,39 @@ def unet_conversion_inputs(model=None):
 
 
 def unet_data_loader(data_dir, batchsize, *args, **kwargs):
-    return RandomDataLoader(unet_inputs, batchsize, torch.float16)
\ No newline at end of file
+    return RandomDataLoader(unet_inputs, batchsize, torch.float16)
+
+
+# -----------------------------------------------------------------------------
+# CHUNKED ATTENTION
+# -----------------------------------------------------------------------------
+@torch.jit.script
+def query_chunk_attention(query: torch.Tensor, key: torch.Tensor, value: torch.Tensor, attn_mask: Optional[torch.Tensor], scale: Optional[float], chunk_size: int, chunk_mask: bool):
+    # Scripted, exported as an ONNX Loop over the dynamic query length: the scores are [chunk_size, keys] per head instead of [queries, keys]
+    outputs = []
+    for start in range(0, query.shape[-2], chunk_size):
+        mask = attn_mask
+        if mask is not None and chunk_mask:
+            mask = mask[..., start:start + chunk_size, :]
+        outputs.append(torch.nn.functional.scaled_dot_product_attention(query[..., start:start + chunk_size, :], key, value, attn_mask=mask, scale=scale))
+    return torch.cat(outputs, dim=-2)
+
+
+def chunked_scaled_dot_product_attention(query, key, value, attn_mask=None, dropout_p=0.0, is_causal=False, scale=None, **kwargs):
+    # Exact, every query chunk attends to all keys. Only a mask with a query dimension is chunked, broadcast masks are passed whole
+    chunk_mask = attn_mask is not None and attn_mask.shape[-2] != 1
+    return query_chunk_attention(query, key, value, attn_mask, scale, config.attention_chunk, chunk_mask)
+
+
+def attention_chunk_load(transformer):
+    # scaled_dot_product_attention runs in query chunks of config.attention_chunk tokens during the transformer forward, the attention processors are unchanged
+    forward = transformer.forward
+
+    def attention_chunk_forward(*args):
+        scaled_dot_product_attention = torch.nn.functional.scaled_dot_product_attention
+        torch.nn.functional.scaled_dot_product_attention = chunked_scaled_dot_product_attention
+        try:
+            return forward(*args)
+        finally:
+            torch.nn.functional.scaled_dot_product_attention = scaled_dot_product_attention
+    transformer.forward = attention_chunk_forward
@@ -0,0 +1,126 @@
+import time
+import argparse
+import numpy as np
+import onnxruntime as ort
+from pathlib import Path
+
+
+def frame_axis(array: np.ndarray):
+    # [1,C,F,H,W] video latents/samples, [F,C,H,W] for the image-batch decoders (StableDiffusionVideo)
+    return 2 if array.ndim == 5 else 0
+
+
+def split_frames(sample: np.ndarray):
+    # Decoded frames as [C,H,W]
+    return list(np.moveaxis(sample[0], 1, 0)) if sample.ndim == 5 else list(sample)
+
+
+def window_starts(frames: int, window: int, overlap: int):
+    # Evenly strided windows, the last window is aligned to the last frame
+    if frames <= window:
+        return [0]
+    starts = list(range(0, frames - window, window - overlap))
+    return starts + [frames - window]
+
+
+def run_decoder(session: ort.InferenceSession, latents: np.ndarray, cache: dict = None):
+    feed = dict(cache or {})
+    for model_input in session.get_inputs():
+        if model_input.name == "latent_sample":
+            feed["latent_sample"] = latents
+        elif model_input.name == "num_frames":
+            feed["num_frames"] = np.array(1, dtype=np.int64)
+    return session.run(None, feed)
+
+
+def stream_cached(model_dir: Path, latents: np.ndarray, options, providers):
+    # vae_decoder_init decodes the first chunk, vae_decoder_stream the rest with the cache carried between calls
+    init = ort.InferenceSession(str(model_dir / "vae_decoder_init" / "model.onnx"), options, providers=providers)
+    stream = ort.InferenceSession(str(model_dir / "vae_decoder_stream" / "model.onnx"), options, providers=providers)
+    init_frames = init.get_inputs()[0].shape[2]
+    stream_frames = stream.get_inputs()[0].shape[2]
+    frames = latents.shape[2]
+    if frames < init_frames or (frames - init_frames) % stream_frames:
+        raise ValueError(f"{frames} latent frames can not be split into {init_frames} + n * {stream_frames}")
+
+    outputs = run_decoder(init, latents[:, :, :init_frames])
+    yield from split_frames(outputs[0])
+    cache_names = [model_input.name for model_input in stream.get_inputs()[1:]]
+    for start in range(init_frames, frames, stream_frames):
+        outputs = run_decoder(stream, latents[:, :, start:start + stream_frames], dict(zip(cache_names, outputs[1:])))
+        yield from split_frames(outputs[0])
+
+
+def stream_windowed(model_dir: Path, latents: np.ndarray, options, providers, window: int, overlap: int):
+    # Overlapping latent frame windows through vae_decoder, overlapping output frames are blended linearly
+    if overlap >= window:
+        raise ValueError("Window overlap must be smaller than the window")
+    session = ort.InferenceSession(str(model_dir / "vae_decoder" / "model.onnx"), options, providers=providers)
+    axis = frame_axis(latents)
+    pending, pending_start, ratio = [], 0, None
+    for start in window_starts(latents.shape[axis], window, overlap):
+        chunk = np.take(latents, range(start, min(start + window, latents.shape[axis])), axis=axis)
+        decoded = split_frames(run_decoder(session, chunk)[0])
+        if ratio is None:
+            # Temporal compression, causal video VAEs decode n latent frames to 1 + (n - 1) * ratio
+            length = chunk.shape[axis]
+            ratio = 1 if len(decoded) == length else (len(decoded) - 1) // max(length - 1, 1)
+
+        # Frames before this window are final, the rest of the previous window is blended in
+        decoded_start = start * ratio
+        final = decoded_start - pending_start
+        yield from pending[:final]
+        blend = pending[final:]
+        for index, frame in enumerate(blend):
+            weight = (index + 1) / (len(blend) + 1)
+            decoded[index] = frame * (1 - weight) + decoded[index] * weight
+        pending, pending_start = decoded, decoded_start
+    yield from pending
+
+
+def stream_decode(model_dir: Path, latents: np.ndarray, window: int = 8, overlap: int = 1, provider: str = "CPUExecutionProvider"):
+    # Generator of decoded frames [C,H,W], uses the cached streaming decoders when they were exported
+    options = ort.SessionOptions()
+    providers = [provider]
+    if (model_dir / "vae_decoder_stream" / "model.onnx").exists():
+        return stream_cached(model_dir, latents, options, providers)
+    return stream_windowed(model_dir, latents, options, providers, window, overlap)
+
+
+def parse_common_args(raw_args):
+    parser = argparse.ArgumentParser("Common arguments")
+    parser.add_argument("--model", required=True, type=Path, help="Converted model folder with vae_decoder_init/vae_decoder_stream or vae_decoder")
+    parser.add_argument("--input", required=True, type=Path, help="Input .npy, unscaled latents [1,C,F,H,W] ([F,C,H,W] for StableDiffusionVideo)")
+    parser.add_argument("--output", required=True, type=Path, help="Output folder, frames are saved as frame_<n>.npy [C,H,W]")
+    parser.add_argument("--window", default=8, type=int, help="Latent frames per call without the streaming decoders")
+    parser.add_argument("--overlap", default=1, type=int, help="Latent frames shared by neighbouring windows")
+    parser.add_argument("--provider", default="CPUExecutionProvider", type=str)
+    return parser.parse_known_args(raw_args)
+
+
+def main(raw_args=None):
+    common_args, extra_args = parse_common_args(raw_args)
+    latents = np.load(common_args.input).astype(np.float32)
+    common_args.output.mkdir(parents=True, exist_ok=True)
+    cached = (common_args.model / "vae_decoder_stream" / "model.onnx").exists()
+
+    print('Streaming VAE Decode')
+    print('--------------------------------------')
+    print(f'Model: {common_args.model}')
+    print(f'Mode: {"cached" if cached else "windowed"}')
+    print(f'Input: {list(latents.shape)}')
+    print('--------------------------------------')
+
+    start_time = time.perf_counter()
+    index = 0
+    for index, frame in enumerate(stream_decode(common_args.model, latents, common_args.window, common_args.overlap, common_args.provider)):
+        if index == 0:
+            print(f"First frame: {time.perf_counter() - start_time:.3f}s")
+        np.save(common_args.output / f"frame_{index:04d}.npy", frame)
+
+    print(f"Frames: {index + 1}, Total: {time.perf_counter() - start_time:.3f}s")
+    print('Streaming VAE Decode Complete.')
+
+
+if __name__ == "__main__":
+    main()
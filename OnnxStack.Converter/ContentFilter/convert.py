@@ -14,6 +14,7 @@ from packaging import version
 from olive.common.utils import set_tempdir
 from olive.workflows import run as olive_run
 from olive.model import ONNXModelHandler
+from ioManifest import save_io_manifest
 
 
 def optimize(
@@ -144,6 +145,7 @@ def main(raw_args=None):
         warnings.simplefilter("ignore")
         optimize(script_dir, common_args.model_input,
                  model_output, provider)
+    save_io_manifest(model_output)
 
 
 if __name__ == "__main__":
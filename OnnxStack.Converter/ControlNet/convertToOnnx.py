@@ -8,28 +8,77 @@ import warnings
 from pathlib import Path
 from olive.workflows import run as olive_run
 from olive.model import ONNXModelHandler
+from swapWeights import create_weight_map, save_variants
+from ioManifest import save_io_manifest
 
 
-def optimize(script_dir: str, model_input: str, model_output: Path, submodel_names: list[str]):
+def optimize(script_dir: str, model_input: str, model_output: Path, submodel_names: list[str], swap_weights: bool, workers: int, io_dtype: str = "float32"):
     model_info = {}
     model_dir = model_input
-   
+
+    # Modules sharing an architecture are traced once, the rest reuse the template graph
+    templates = {}
     for submodel_name in submodel_names:
-        print(f"\nOptimizing {submodel_name}...")
+        architecture = get_architecture(Path(model_dir) / submodel_name) if swap_weights else submodel_name
+        templates.setdefault(architecture, []).append(submodel_name)
+
+    for template_name, *variant_names in templates.values():
+        optimize_submodel(script_dir, model_dir, template_name, model_info, io_dtype)
+
+    template_names = [template_name for template_name, *variant_names in templates.values()]
+    save_onnx_models(model_dir, model_info, model_output, template_names)
+
+    for template_name, *variant_names in templates.values():
+        if not variant_names:
+            continue
+
+        print(f"\nSwapping weights {variant_names} into {template_name}...")
+        template_path = model_output / template_name / model_info[template_name]["path"].name
+        try:
+            weight_map = create_weight_map(template_path, Path(model_dir) / template_name)
+        except ValueError as ex:
+            print(f"Weight map failed for {template_name}: {ex}")
+            weight_map = None
+
+        failed_names = variant_names
+        if weight_map is not None:
+            variants = {Path(model_dir) / variant_name: model_output / variant_name for variant_name in variant_names}
+            results = save_variants(template_path, weight_map, variants, workers)
+            failed_names = [variant_name for variant_name in variant_names if results[Path(model_dir) / variant_name] is None]
+
+        # Fallback to a full conversion
+        for variant_name in failed_names:
+            optimize_submodel(script_dir, model_dir, variant_name, model_info, io_dtype)
+        save_onnx_models(model_dir, model_info, model_output, failed_names)
+        print(f"Swapping weights into {template_name} complete.")
+
+    print(f"Model Output: {model_output}")
+    return model_info
 
-        olive_config = None
-        with (script_dir / f"config_controlnet.json").open() as fin:
-            olive_config = json.load(fin)
 
-        olive_config["input_model"]["config"]["model_path"] = Path(model_dir) / submodel_name
-        olive_config["engine"]["output_dir"] += submodel_name
+def optimize_submodel(script_dir: str, model_dir: str, submodel_name: str, model_info: dict, io_dtype: str):
+    print(f"\nOptimizing {submodel_name}...")
 
-        run_res = olive_run(olive_config)
-        save_onnx_submodel(script_dir, submodel_name, model_info)
-        print(f"Optimizing {submodel_name} complete.")
+    olive_config = None
+    with (script_dir / f"config_controlnet.json").open() as fin:
+        olive_config = json.load(fin)
 
-    save_onnx_models(model_dir, model_info, model_output, submodel_names)
-    return model_info
+    olive_config["input_model"]["config"]["model_path"] = Path(model_dir) / submodel_name
+    olive_config["engine"]["output_dir"] += submodel_name
+
+    run_res = olive_run(olive_config)
+    save_onnx_submodel(script_dir, submodel_name, model_info, io_dtype)
+    print(f"Optimizing {submodel_name} complete.")
+
+
+def get_architecture(submodel_dir: Path):
+    config_path = submodel_dir / "config.json"
+    if not os.path.exists(config_path):
+        return str(submodel_dir)
+
+    with config_path.open() as fin:
+        model_config = json.load(fin)
+    return json.dumps({key: value for key, value in model_config.items() if not key.startswith("_")}, sort_keys=True)
 
 
 def save_onnx_models(model_dir, model_info, model_output, submodel_names):
@@ -49,10 +98,8 @@ def save_onnx_models(model_dir, model_info, model_output, submodel_names):
         if os.path.exists(src_data_path):
             shutil.copy(src_data_path, dst_dir)
 
-    print(f"Model Output: {model_output}")
-
 
-def save_onnx_submodel(script_dir, submodel_name, model_info):
+def save_onnx_submodel(script_dir, submodel_name, model_info, io_dtype):
     footprints_file_path = (script_dir / ".olive-cache" / "models" / submodel_name / "footprints.json")
     with footprints_file_path.open("r") as footprint_file:
         footprints = json.load(footprint_file)
@@ -69,21 +116,22 @@ def save_onnx_submodel(script_dir, submodel_name, model_info):
 
         optimized_olive_model = ONNXModelHandler(**optimizer_footprint["model_config"]["config"])
 
-        # convertIO
-        optimized_path = optimized_olive_model.model_path
-        optimized_data_path = optimized_path + ".data"
-        subprocess.run([sys.executable, "convertIO.py"] + ["--input", optimized_path])
-        convert_dir = Path(optimized_path).parent
-        convert_path = convert_dir / "converted.onnx"
-        convert_data_path = convert_dir / "converted.onnx.data"
-        if os.path.exists(optimized_path):
-            os.remove(optimized_path)
-        if os.path.exists(optimized_data_path):
-            os.remove(optimized_data_path)
-        if os.path.exists(convert_path):
-            os.rename(convert_path, optimized_path)
-        if os.path.exists(convert_data_path):
-            os.rename(convert_data_path, optimized_data_path)
+        # convertIO, float32 graph inputs/outputs
+        if io_dtype == "float32":
+            optimized_path = optimized_olive_model.model_path
+            optimized_data_path = optimized_path + ".data"
+            subprocess.run([sys.executable, "convertIO.py"] + ["--input", optimized_path])
+            convert_dir = Path(optimized_path).parent
+            convert_path = convert_dir / "converted.onnx"
+            convert_data_path = convert_dir / "converted.onnx.data"
+            if os.path.exists(optimized_path):
+                os.remove(optimized_path)
+            if os.path.exists(optimized_data_path):
+                os.remove(optimized_data_path)
+            if os.path.exists(convert_path):
+                os.rename(convert_path, optimized_path)
+            if os.path.exists(convert_data_path):
+                os.rename(convert_data_path, optimized_data_path)
 
         model_info[submodel_name] = {
             "path": Path(optimized_olive_model.model_path)
@@ -100,6 +148,9 @@ def parse_common_args(raw_args):
     parser.add_argument("--output", default=None, type=Path)
     parser.add_argument("--modules", default="Canny,Depth,Inpaint,Instruct,LineArt,LineArtAnime,MLSD,Normal,OpenPose,Scribble,Segmentation,Shuffle,SoftEdge,Tile", help="The modules to convert")
     parser.add_argument("--clean", action="store_true", help="Deletes the Olive cache")
+    parser.add_argument("--io_dtype", default="float32", choices=["float32", "float16"], help="Graph input/output type, float32 casts the float16 graph inputs/outputs with convertIO, float16 keeps them (io_manifest.json lists the types)")
+    parser.add_argument("--disable_weight_swap", action="store_true", help="Run a full conversion for every module instead of reusing the first module of each architecture")
+    parser.add_argument("--workers", default=4, type=int, help="Number of weight swapped modules written in parallel")
     return parser.parse_known_args(raw_args)
 
 
@@ -122,11 +173,14 @@ def main(raw_args=None):
     print(f'Input: {model_input}')
     print(f'Output: {model_output}')
     print(f'Modules: {submodel_names}')
+    print(f'Weight Swap: {not common_args.disable_weight_swap}')
+    print(f'IO Dtype: {common_args.io_dtype}')
     print('--------------------------------------')
 
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
-        optimize(script_dir, model_input, model_output, submodel_names)
+        optimize(script_dir, model_input, model_output, submodel_names, not common_args.disable_weight_swap, common_args.workers, common_args.io_dtype)
+    save_io_manifest(model_output)
 
     clean(script_dir)
     print('Olive Locomotion Conversion Complete.')
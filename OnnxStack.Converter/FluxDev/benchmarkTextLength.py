@@ -0,0 +1,98 @@
+import time
+import argparse
+import numpy as np
+import onnxruntime
+from pathlib import Path
+from tabulate import tabulate
+
+
+def create_session(model_path: Path, threads: int, provider: str):
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = threads
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return onnxruntime.InferenceSession(str(model_path), options, providers=[provider])
+
+
+def transformer_inputs(session, text_length: int, height: int, width: int):
+    # Packed 2x2 latents: (height / 16) * (width / 16) image tokens after text_length text tokens
+    dtypes = {"tensor(float)": np.float32, "tensor(float16)": np.float16, "tensor(int64)": np.int64}
+    image_length = (height // 16) * (width // 16)
+    inputs = {}
+    for input in session.get_inputs():
+        dtype = dtypes[input.type]
+        if input.name == "hidden_states":
+            inputs[input.name] = np.random.rand(1, image_length, 64).astype(dtype)
+        elif input.name == "encoder_hidden_states":
+            inputs[input.name] = np.random.rand(1, text_length, 4096).astype(dtype)
+        elif input.name == "pooled_projections":
+            inputs[input.name] = np.random.rand(1, 768).astype(dtype)
+        elif input.name in ("timestep", "guidance"):
+            inputs[input.name] = np.array([1.0], dtype=dtype)
+        elif input.name in ("img_ids", "txt_ids"):
+            length = image_length if input.name == "img_ids" else text_length
+            shape = (1, length, 3) if len(input.shape) == 3 else (length, 3)
+            inputs[input.name] = np.zeros(shape, dtype=dtype)
+        elif input.name in ("rotary_cos", "rotary_sin"):
+            inputs[input.name] = np.random.rand(text_length + image_length, 128).astype(dtype)
+        elif input.name == "modulation":
+            inputs[input.name] = np.random.rand(1, input.shape[-1]).astype(dtype)
+        elif input.name == "encoder_attention_mask":
+            inputs[input.name] = np.ones((1, text_length), dtype=dtype)
+        else:
+            raise ValueError(f"Unsupported input {input.name}, the benchmark expects a transformer model")
+    return inputs
+
+
+def benchmark_step(session, text_length: int, height: int, width: int, runs: int):
+    inputs = transformer_inputs(session, text_length, height, width)
+    session.run(None, inputs)
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        session.run(None, inputs)
+        timings.append(time.perf_counter() - start)
+    return float(np.median(timings)) * 1000
+
+
+def benchmark(model_path: Path, text_lengths: list, height: int, width: int, runs: int, threads: int, provider: str):
+    session = create_session(model_path, threads, provider)
+    timings = [benchmark_step(session, text_length, height, width, runs) for text_length in text_lengths]
+
+    # Speedup against the longest text length, the fixed max_length padding without --text_bucket
+    baseline = timings[text_lengths.index(max(text_lengths))]
+    results = [[text_length, step_ms, baseline / step_ms] for text_length, step_ms in zip(text_lengths, timings)]
+    print(tabulate(results, headers=["Text Length", "Step (ms)", "Speedup"], floatfmt=".2f"))
+    return results
+
+
+def parse_common_args(raw_args):
+    parser = argparse.ArgumentParser("Common arguments")
+    parser.add_argument("--input", required=True, type=Path, help="Converted transformer model.onnx (dynamic text length, --text_bucket)")
+    parser.add_argument("--text_lengths", default="64,128,256,512", type=str, help="Comma separated text lengths, multiples of the text bucket")
+    parser.add_argument("--height", default=1024, type=int)
+    parser.add_argument("--width", default=1024, type=int)
+    parser.add_argument("--runs", default=3, type=int, help="Timed runs per text length")
+    parser.add_argument("--threads", default=0, type=int, help="CPU intra-op threads (0 = default)")
+    parser.add_argument("--provider", default="CPUExecutionProvider", type=str)
+    return parser.parse_known_args(raw_args)
+
+
+def main(raw_args=None):
+    common_args, extra_args = parse_common_args(raw_args)
+    text_lengths = [int(text_length) for text_length in common_args.text_lengths.split(",")]
+
+    print('Text Length Benchmark')
+    print('--------------------------------------')
+    print(f'Input: {common_args.input}')
+    print(f'Text Lengths: {text_lengths}')
+    print(f'Size: {common_args.width}x{common_args.height}')
+    print(f'Provider: {common_args.provider}')
+    print('--------------------------------------')
+
+    benchmark(common_args.input, text_lengths, common_args.height, common_args.width, common_args.runs, common_args.threads, common_args.provider)
+
+    print('Text Length Benchmark Complete.')
+
+
+if __name__ == "__main__":
+    main()
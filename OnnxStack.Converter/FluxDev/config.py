@@ -0,0 +1,6 @@
+text_bucket = 0
+rotary_tables = False
+conditioning = False
+modulation_size = 0 # AdaLN modulation columns per timestep, recorded when the transformer is loaded
+block_cache = False
+block_cache_dim = 0 # block_signal/block_residual channels (inner_dim), recorded when the transformer is loaded
@@ -37,6 +37,13 @@ def parse_common_args(raw_args):
     parser.add_argument("--output", default=None, type=Path)
     parser.add_argument("--modules", default="tokenizer,tokenizer_2,text_encoder,text_encoder_2,vae_encoder,vae_decoder,transformer", help="The modules to convert `tokenizer,tokenizer_2,text_encoder,text_encoder_2,vae_encoder,vae_decoder,transformer`")
     parser.add_argument("--clean", default=False, action="store_true", help="Deletes the Olive cache")
+    parser.add_argument("--io_dtype", default="float32", choices=["float32", "float16"], help="Graph input/output type of the float16 models, float16 drops the float32 casts at the graph boundary (io_manifest.json lists the types)")
+    parser.add_argument("--vae_tile_size", default=0, type=int, help="Export the vae_encoder/vae_decoder for a fixed pixel tile size (multiple of 8) for tiledVae.py, 0 = dynamic")
+    parser.add_argument("--fuse_tokenizer", default=False, action="store_true", help="Also save text_encoder*/model_tokenizer.onnx with the tokenizer graph fused in front (string input, one session)")
+    parser.add_argument("--text_bucket", default=0, type=int, help="Dynamic T5 text length: attention_mask inputs, the T5 tokenizer pads to a multiple of text_bucket (64), 0 = fixed max_length")
+    parser.add_argument("--rotary_tables", default=False, action="store_true", help="Export the transformer with rotary_cos/rotary_sin table inputs (createRotaryTables.py) instead of img_ids/txt_ids")
+    parser.add_argument("--conditioning", default=False, action="store_true", help="Also export the conditioning model (AdaLN modulation for all timesteps in one run), the transformer takes a modulation input instead of pooled_projections/timestep/guidance")
+    parser.add_argument("--block_cache", default=False, action="store_true", help="Also export transformer_replay (block_residual replayed in place of the block stack), the transformer gains block_signal/block_residual outputs")
     return parser.parse_known_args(raw_args)
 
 
@@ -1,6 +1,8 @@
+import config
 import torch
 from typing import Union, Tuple
 from diffusers import AutoencoderKL, FluxTransformer2DModel
+from diffusers.models.normalization import AdaLayerNormZero, AdaLayerNormZeroSingle, AdaLayerNormContinuous
 from transformers import CLIPTextModel, T5EncoderModel
 
 class RandomDataLoader:
@@ -40,9 +42,12 @@ def text_encoder_data_loader(data_dir, batchsize, *args, **kwargs):
 # TEXT ENCODER 2
 # -----------------------------------------------------------------------------
 def text_encoder_2_inputs(batchsize, torch_dtype):
-    return {
+    inputs = {
         "input_ids": torch.zeros((batchsize, 256), dtype=torch_dtype)
     }
+    if config.text_bucket:
+        inputs["attention_mask"] = torch.ones((batchsize, 256), dtype=torch.int64)
+    return inputs
 
 
 def text_encoder_2_load(model_name):
@@ -130,6 +135,41 @@ class WrappedFluxTransformer2DModel(FluxTransformer2DModel):
         )
 
 
+class MaskedFluxTransformer2DModel(FluxTransformer2DModel):
+    def forward(
+        self,
+        hidden_states: torch.FloatTensor, 
+        encoder_hidden_states: torch.FloatTensor,
+        pooled_projections: torch.FloatTensor,
+        timestep: torch.LongTensor, 
+        img_ids: torch.FloatTensor,
+        txt_ids: torch.FloatTensor,
+        guidance: torch.Tensor,
+        encoder_attention_mask: torch.Tensor,
+    ) -> Union[FluxTransformer2DModel, Tuple]:
+        # Padded text tokens (encoder_attention_mask = 0) are masked out of the joint [text, image] attention
+        image_mask = torch.ones_like(hidden_states[:, :, 0], dtype=torch.bool)
+        attention_mask = torch.cat([encoder_attention_mask.bool(), image_mask], dim=1)
+        return super().forward(
+            hidden_states = hidden_states,
+            encoder_hidden_states = encoder_hidden_states,
+            pooled_projections = pooled_projections,
+            timestep = timestep,
+            img_ids = img_ids,
+            txt_ids = txt_ids,
+            guidance = guidance,
+            joint_attention_kwargs = {"attention_mask": attention_mask[:, None, None, :]}
+        )
+
+
+class RotaryTables(torch.nn.Module):
+    # Replaces pos_embed: the img_ids/txt_ids inputs carry precomputed cos/sin tables [text + image, 128]
+    # (createRotaryTables.py), the transformer concatenates (txt_ids, img_ids) before pos_embed
+    def forward(self, ids):
+        rotary_sin, rotary_cos = ids.chunk(2)
+        return rotary_cos, rotary_sin
+
+
 def transformer_inputs(batchsize, torch_dtype, is_conversion_inputs=False):
     inputs = {
         "hidden_states": torch.rand((1, 4096, 64), dtype=torch_dtype),
@@ -140,11 +180,25 @@ def transformer_inputs(batchsize, torch_dtype, is_conversion_inputs=False):
         "txt_ids": torch.rand((512, 3), dtype=torch_dtype),
         "guidance": torch.rand((1), dtype=torch_dtype)
     }
+    if config.rotary_tables:
+        inputs["img_ids"] = torch.rand((4608, 128), dtype=torch_dtype)
+        inputs["txt_ids"] = torch.rand((4608, 128), dtype=torch_dtype)
+    if config.text_bucket:
+        inputs["encoder_attention_mask"] = torch.ones((1, 512), dtype=torch.int64)
+    if config.conditioning:
+        inputs = modulation_inputs(inputs)
     return inputs
 
 
 def transformer_load(model_name):
-    model = WrappedFluxTransformer2DModel.from_pretrained(model_name, subfolder="transformer", torch_dtype=torch.float32)
+    model_class = MaskedFluxTransformer2DModel if config.text_bucket else WrappedFluxTransformer2DModel
+    model = model_class.from_pretrained(model_name, subfolder="transformer", torch_dtype=torch.float32)
+    if config.rotary_tables:
+        model.pos_embed = RotaryTables()
+    if config.conditioning:
+        modulation_load(model)
+    if config.block_cache:
+        block_cache_load(model)
     return model
 
 
@@ -153,4 +207,167 @@ def transformer_conversion_inputs(model=None):
 
 
 def transformer_data_loader(data_dir, batchsize, *args, **kwargs):
-    return RandomDataLoader(transformer_inputs, batchsize, torch.float32)
\ No newline at end of file
+    return RandomDataLoader(transformer_inputs, batchsize, torch.float32)
+
+
+
+# -----------------------------------------------------------------------------
+# CONDITIONING
+# -----------------------------------------------------------------------------
+class ModulationInput(torch.nn.Module):
+    # Replaces an AdaLN linear, returns its slice of the precomputed conditioning modulation
+    def __init__(self, out_features):
+        super().__init__()
+        self.out_features = out_features
+        self.modulation = None
+
+    def forward(self, emb):
+        return self.modulation
+
+
+def modulation_modules(model):
+    # AdaLN layers in module order: norm1/norm1_context per block, norm per single block, norm_out
+    return [module for module in model.modules() if isinstance(module, (AdaLayerNormZero, AdaLayerNormZeroSingle, AdaLayerNormContinuous))]
+
+
+class Conditioning(torch.nn.Module):
+    # time_text_embed and the AdaLN shift/scale/gate linears of every block, all scheduled timesteps in one run
+    def __init__(self, transformer):
+        super().__init__()
+        self.time_text_embed = transformer.time_text_embed
+        self.norms = torch.nn.ModuleList(modulation_modules(transformer))
+
+    def forward(self, timestep, pooled_projections, guidance):
+        # timestep [steps] x pooled_projections [batch, 768] -> modulation [steps, batch, modulation]
+        steps, batch = timestep.shape[0], pooled_projections.shape[0]
+        timestep = (timestep[:, None] * 1000).expand(steps, batch).flatten()
+        guidance = (guidance[:, None] * 1000).expand(steps, batch).flatten()
+        pooled_projections = pooled_projections.expand(steps, -1, -1).flatten(0, 1)
+        temb = self.time_text_embed(timestep, guidance, pooled_projections)
+        modulation = torch.cat([norm.linear(norm.silu(temb)) for norm in self.norms], dim=1)
+        return modulation.unflatten(0, (steps, batch))
+
+
+def modulation_load(transformer):
+    # pooled_projections/timestep/guidance inputs replaced by one conditioning modulation row, the other weight names are unchanged
+    norms = modulation_modules(transformer)
+    for norm in norms:
+        norm.linear = ModulationInput(norm.linear.out_features)
+    sizes = [norm.linear.out_features for norm in norms]
+    config.modulation_size = sum(sizes)
+    forward = transformer.forward
+
+    def conditioning_forward(hidden_states, encoder_hidden_states, modulation, img_ids, txt_ids, *args):
+        for norm, norm_modulation in zip(norms, modulation.split(sizes, dim=1)):
+            norm.linear.modulation = norm_modulation
+        # Placeholders, the AdaLN linears are the only temb consumers
+        pooled_projections = torch.zeros((modulation.shape[0], transformer.config.pooled_projection_dim), dtype=hidden_states.dtype)
+        timestep = torch.zeros((modulation.shape[0],), dtype=hidden_states.dtype)
+        return forward(hidden_states, encoder_hidden_states, pooled_projections, timestep, img_ids, txt_ids, timestep, *args)
+    transformer.forward = conditioning_forward
+
+
+def modulation_inputs(inputs):
+    # pooled_projections/timestep/guidance -> modulation [batch, modulation] at the pooled_projections position
+    conditioning_inputs = {}
+    for name, value in inputs.items():
+        if name == "pooled_projections":
+            conditioning_inputs["modulation"] = torch.rand((value.shape[0], config.modulation_size), dtype=value.dtype)
+        elif name not in ("timestep", "guidance"):
+            conditioning_inputs[name] = value
+    return conditioning_inputs
+
+
+def conditioning_inputs(batchsize, torch_dtype):
+    return {
+        "timestep": torch.rand((28,), dtype=torch_dtype),
+        "pooled_projections": torch.rand((1, 768), dtype=torch_dtype),
+        "guidance": torch.rand((1,), dtype=torch_dtype)
+    }
+
+
+def conditioning_load(model_name):
+    model = FluxTransformer2DModel.from_pretrained(model_name, subfolder="transformer", torch_dtype=torch.float32)
+    return Conditioning(model)
+
+
+def conditioning_conversion_inputs(model=None):
+    return tuple(conditioning_inputs(1, torch.float32).values())
+
+
+def conditioning_data_loader(data_dir, batchsize, *args, **kwargs):
+    return RandomDataLoader(conditioning_inputs, batchsize, torch.float32)
+
+
+
+# -----------------------------------------------------------------------------
+# BLOCK CACHE
+# -----------------------------------------------------------------------------
+class BlockSkip(torch.nn.Module):
+    # Replaces the first transformer block in transformer_replay, returns its inputs, norm1 stays for the block_signal
+    def __init__(self, block):
+        super().__init__()
+        self.norm1 = block.norm1
+
+    def forward(self, hidden_states, encoder_hidden_states, *args, **kwargs):
+        return encoder_hidden_states, hidden_states
+
+
+def block_cache_load(transformer, replay=False):
+    # block_signal: the first block modulated input, cheap and follows how much the step output changes
+    # block_residual: block stack output - input (image tokens), added back to the block stack input by transformer_replay
+    first_block = transformer.transformer_blocks[0]
+    if replay:
+        first_block = BlockSkip(first_block)
+        transformer.transformer_blocks = torch.nn.ModuleList([first_block])
+        transformer.single_transformer_blocks = torch.nn.ModuleList()
+    config.block_cache_dim = transformer.inner_dim
+    state = {}
+
+    def block_input_hook(module, args, kwargs):
+        state["input"] = kwargs["hidden_states"]
+        state["signal"] = module.norm1(kwargs["hidden_states"], emb=kwargs["temb"])[0]
+    first_block.register_forward_pre_hook(block_input_hook, with_kwargs=True)
+
+    def block_output_hook(module, args):
+        if replay:
+            return (args[0] + state["residual"], *args[1:])
+        state["residual"] = args[0] - state["input"]
+    transformer.norm_out.register_forward_pre_hook(block_output_hook)
+    forward = transformer.forward
+
+    def block_cache_forward(*args):
+        if replay:
+            state["residual"] = args[-1]
+            return forward(*args[:-1])[0], state["signal"]
+        return forward(*args)[0], state["signal"], state["residual"]
+    transformer.forward = block_cache_forward
+
+
+def block_cache_inputs(inputs):
+    # block_residual [batch, image, block_cache_dim] appended after the transformer inputs
+    hidden_states = inputs["hidden_states"]
+    return {**inputs, "block_residual": torch.rand((*hidden_states.shape[:2], config.block_cache_dim), dtype=hidden_states.dtype)}
+
+
+def transformer_replay_inputs(batchsize, torch_dtype):
+    return block_cache_inputs(transformer_inputs(batchsize, torch_dtype))
+
+
+def transformer_replay_load(model_name):
+    model_class = MaskedFluxTransformer2DModel if config.text_bucket else WrappedFluxTransformer2DModel
+    model = model_class.from_pretrained(model_name, subfolder="transformer", torch_dtype=torch.float32)
+    if config.rotary_tables:
+        model.pos_embed = RotaryTables()
+    if config.conditioning:
+        modulation_load(model)
+    block_cache_load(model, True)
+    return model
+
+
+def transformer_replay_conversion_inputs(model=None):
+    return tuple(transformer_replay_inputs(1, torch.float32).values())
+
+
+def transformer_replay_data_loader(data_dir, batchsize, *args, **kwargs):
+    return RandomDataLoader(transformer_replay_inputs, batchsize, torch.float32)
@@ -0,0 +1,8 @@
+text_bucket = 0
+conditioning = False
+modulation_size = 0 # AdaLN modulation columns per timestep, recorded when the transformer is loaded
+reference_cache = False
+attention_layers = 57 # transformer_blocks + single_transformer_blocks, one reference_key_<n>/reference_value_<n> input pair each with reference_cache
+reference_kv_shape = [] # [heads, head_dim] of the reference key/value, recorded when the transformer is loaded
+block_cache = False
+block_cache_dim = 0 # block_signal/block_residual channels (inner_dim), recorded when the transformer is loaded
@@ -1,3 +1,4 @@
+import config
 import os
 import argparse
 import json
@@ -8,11 +9,20 @@ import onnx
 import uuid
 from onnx import helper
 from onnx import TensorProto
+from convertTokenizerToOnnx import save_tokenizer_model, save_fused_text_encoders
 from olive.workflows import run as olive_run
 from olive.model import ONNXModelHandler
+from ioManifest import save_io_manifest
 
 
-def optimize(script_dir: str, model_input: str, model_output: Path, submodel_names: list[str]):
+# Tokenizer model.onnx: max_length and input_ids type of the matching text encoder
+TOKENIZERS = {
+    "tokenizer": (77, "int32"),
+    "tokenizer_2": (256, "int64")
+}
+
+
+def optimize(script_dir: str, model_input: str, model_output: Path, submodel_names: list[str], fuse_tokenizer: bool = False, io_dtype: str = "float32"):
     model_info = {}
     model_dir = model_input
    
@@ -27,15 +37,78 @@ def optimize(script_dir: str, model_input: str, model_output: Path, submodel_nam
             olive_config = json.load(fin)
 
         olive_config["input_model"]["config"]["model_path"] = model_dir
+        if io_dtype == "float16":
+            io_dtype_config(olive_config)
+        if submodel_name in ("text_encoder_2", "transformer", "transformer_replay", "reference_projection") and config.text_bucket:
+            dynamic_text_config(olive_config, submodel_name)
+        if submodel_name in ("transformer", "transformer_replay", "reference_projection") and config.conditioning:
+            conditioning_config(olive_config)
+        if submodel_name in ("transformer", "reference_projection") and config.reference_cache:
+            reference_cache_config(olive_config, submodel_name)
+        if submodel_name == "transformer_replay" or (submodel_name == "transformer" and config.block_cache):
+            block_cache_config(olive_config, submodel_name)
         run_res = olive_run(olive_config)
         save_onnx_submodel(script_dir, submodel_name, model_info)
         print(f"Optimizing {submodel_name} complete.")
 
-    save_onnx_models(model_dir, model_info, model_output, submodel_names)
+    save_onnx_models(model_dir, model_info, model_output, submodel_names, fuse_tokenizer)
     return model_info
 
 
-def save_onnx_models(model_dir, model_info, model_output, submodel_names):
+def dynamic_text_config(olive_config, submodel_name: str):
+    # Variable text length, the T5 tokenizer pads to a multiple of --text_bucket instead of max_length
+    io_config = olive_config["input_model"]["config"]["io_config"]
+    dynamic_axes = io_config.setdefault("dynamic_axes", {})
+    if submodel_name in ("transformer", "transformer_replay", "reference_projection"):
+        # encoder_attention_mask [batch, text] masks the padded text tokens, txt_ids follows the text length
+        io_config["input_names"].append("encoder_attention_mask")
+        for name, axis in (("encoder_hidden_states", "1"), ("txt_ids", "0"), ("encoder_attention_mask", "1")):
+            dynamic_axes[name] = {axis: "transformer_hidden_sequence"}
+        return
+    io_config["input_names"].append("attention_mask")
+    for name in ("input_ids", "attention_mask", "last_hidden_state"):
+        dynamic_axes[name] = {"0": "batch_size", "1": "sequence_length"}
+
+
+def conditioning_config(olive_config):
+    # modulation [batch, modulation] takes the pooled_projections slot, timestep/guidance only feed the conditioning model
+    io_config = olive_config["input_model"]["config"]["io_config"]
+    renames = {"pooled_projections": "modulation"}
+    io_config["input_names"] = [renames.get(name, name) for name in io_config["input_names"] if name not in ("timestep", "guidance")]
+
+
+def reference_cache_config(olive_config, submodel_name: str):
+    # reference_key_<n>/reference_value_<n> per attention layer: reference_projection outputs, transformer inputs after the generated tokens
+    io_config = olive_config["input_model"]["config"]["io_config"]
+    names = [f"reference_{kind}_{index}" for index in range(config.attention_layers) for kind in ("key", "value")]
+    for name in names:
+        io_config["dynamic_axes"][name] = {"2": "reference_sequence"}
+    if submodel_name == "reference_projection":
+        io_config["output_names"] += names
+        return
+    io_config["input_names"] += names
+
+
+def block_cache_config(olive_config, submodel_name: str):
+    # block_signal/block_residual [batch, image, inner_dim]: transformer outputs, transformer_replay takes block_residual after the transformer inputs
+    io_config = olive_config["input_model"]["config"]["io_config"]
+    dynamic_axes = io_config.setdefault("dynamic_axes", {})
+    for name in ("block_signal", "block_residual"):
+        dynamic_axes[name] = {"1": "transformer_sample_sequence"}
+    if submodel_name == "transformer":
+        io_config["output_names"] += ["block_signal", "block_residual"]
+        return
+    io_config["input_names"].append("block_residual")
+    io_config["output_names"].append("block_signal")
+
+
+def io_dtype_config(olive_config):
+    for olive_pass in olive_config["passes"].values():
+        if "keep_io_types" in olive_pass["config"]:
+            olive_pass["config"]["keep_io_types"] = False
+
+
+def save_onnx_models(model_dir, model_info, model_output, submodel_names, fuse_tokenizer=False):
     model_dir = Path(model_dir)
     model_output.mkdir(parents=True, exist_ok=True)
     
@@ -44,6 +117,7 @@ def save_onnx_models(model_dir, model_info, model_output, submodel_names):
         if submodel_name in ("tokenizer", "tokenizer_2", "tokenizer_3"):
             if os.path.exists(model_dir / submodel_name):
                 shutil.copytree(model_dir / submodel_name, model_output / submodel_name, ignore=shutil.ignore_patterns("*tokenizer_config.json"))
+                save_tokenizer_model(model_dir / submodel_name, model_output / submodel_name, *TOKENIZERS[submodel_name], config.text_bucket)
             continue
         
         dst_dir = model_output / submodel_name
@@ -57,6 +131,9 @@ def save_onnx_models(model_dir, model_info, model_output, submodel_names):
         if os.path.exists(src_data_path):
             shutil.copy(src_data_path, dst_dir)
 
+    if fuse_tokenizer:
+        save_fused_text_encoders(model_dir, model_output, TOKENIZERS, config.text_bucket)
+
     print(f"Model Output: {model_output}")
 
 
@@ -93,6 +170,12 @@ def parse_common_args(raw_args):
     parser.add_argument("--output", default=None, type=Path)
     parser.add_argument("--modules", default="tokenizer,tokenizer_2,text_encoder,text_encoder_2,vae_encoder,vae_decoder,transformer", help="The modules to convert `tokenizer,tokenizer_2,text_encoder,text_encoder_2,vae_encoder,vae_decoder,transformer`")
     parser.add_argument("--clean", default=False, action="store_true", help="Deletes the Olive cache")
+    parser.add_argument("--io_dtype", default="float32", choices=["float32", "float16"], help="Graph input/output type of the float16 models, float16 drops the float32 casts at the graph boundary (io_manifest.json lists the types)")
+    parser.add_argument("--fuse_tokenizer", default=False, action="store_true", help="Also save text_encoder*/model_tokenizer.onnx with the tokenizer graph fused in front (string input, one session)")
+    parser.add_argument("--text_bucket", default=0, type=int, help="Dynamic T5 text length: attention_mask inputs, the T5 tokenizer pads to a multiple of text_bucket (64), 0 = fixed max_length")
+    parser.add_argument("--conditioning", default=False, action="store_true", help="Also export the conditioning model (AdaLN modulation for all timesteps in one run), the transformer takes a modulation input instead of pooled_projections/timestep/guidance")
+    parser.add_argument("--reference_cache", default=False, action="store_true", help="Also export reference_projection (first step + reference image key/value of every attention layer), the transformer only processes the generated tokens")
+    parser.add_argument("--block_cache", default=False, action="store_true", help="Also export transformer_replay (block_residual replayed in place of the block stack), the transformer gains block_signal/block_residual outputs")
     return parser.parse_known_args(raw_args)
 
 
@@ -110,15 +193,32 @@ def main(raw_args=None):
     if common_args.clean:
         clean(script_dir)
 
+    config.text_bucket = common_args.text_bucket
+    config.conditioning = common_args.conditioning
+    if config.conditioning and "transformer" in submodel_names and "conditioning" not in submodel_names:
+        submodel_names.insert(submodel_names.index("transformer"), "conditioning")
+    config.reference_cache = common_args.reference_cache
+    if config.reference_cache and "transformer" in submodel_names and "reference_projection" not in submodel_names:
+        submodel_names.insert(submodel_names.index("transformer"), "reference_projection")
+    config.block_cache = common_args.block_cache
+    if config.block_cache and "transformer" in submodel_names and "transformer_replay" not in submodel_names:
+        submodel_names.insert(submodel_names.index("transformer") + 1, "transformer_replay")
     print('Olive Conversion - Flux Kontext Model')
     print('--------------------------------------')
     print(f'Input: {model_input}')
     print(f'Output: {model_output}')
     print(f'Modules: {submodel_names}')
+    print(f'Fuse Tokenizer: {common_args.fuse_tokenizer}')
+    print(f'Text Bucket: {common_args.text_bucket}')
+    print(f'Conditioning: {common_args.conditioning}')
+    print(f'Reference Cache: {common_args.reference_cache}')
+    print(f'Block Cache: {common_args.block_cache}')
+    print(f'IO Dtype: {common_args.io_dtype}')
     print('--------------------------------------')
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
-        optimize(script_dir, model_input, model_output, submodel_names)
+        optimize(script_dir, model_input, model_output, submodel_names, fuse_tokenizer=common_args.fuse_tokenizer, io_dtype=common_args.io_dtype)
+    save_io_manifest(model_output)
 
     # clean(script_dir)
     print('Olive Flux Kontext Conversion Complete.')
@@ -1,6 +1,9 @@
+import config
 import torch
 from typing import Union, Tuple
 from diffusers import AutoencoderKL, FluxTransformer2DModel
+from diffusers.models.normalization import AdaLayerNormZero, AdaLayerNormZeroSingle, AdaLayerNormContinuous
+from diffusers.models.embeddings import apply_rotary_emb
 from transformers import CLIPTextModel, T5EncoderModel
 
 class RandomDataLoader:
@@ -40,9 +43,12 @@ def text_encoder_data_loader(data_dir, batchsize, *args, **kwargs):
 # TEXT ENCODER 2
 # -----------------------------------------------------------------------------
 def text_encoder_2_inputs(batchsize, torch_dtype):
-    return {
+    inputs = {
         "input_ids": torch.zeros((batchsize, 256), dtype=torch_dtype)
     }
+    if config.text_bucket:
+        inputs["attention_mask"] = torch.ones((batchsize, 256), dtype=torch.int64)
+    return inputs
 
 
 def text_encoder_2_load(model_name):
@@ -130,7 +136,34 @@ class WrappedFluxTransformer2DModel(FluxTransformer2DModel):
         )
 
 
-def transformer_inputs(batchsize, torch_dtype, is_conversion_inputs=False):
+class MaskedFluxTransformer2DModel(FluxTransformer2DModel):
+    def forward(
+        self,
+        hidden_states: torch.FloatTensor, 
+        encoder_hidden_states: torch.FloatTensor,
+        pooled_projections: torch.FloatTensor,
+        timestep: torch.LongTensor, 
+        img_ids: torch.FloatTensor,
+        txt_ids: torch.FloatTensor,
+        guidance: torch.Tensor,
+        encoder_attention_mask: torch.Tensor,
+    ) -> Union[FluxTransformer2DModel, Tuple]:
+        # Padded text tokens (encoder_attention_mask = 0) are masked out of the joint [text, image] attention
+        image_mask = torch.ones_like(hidden_states[:, :, 0], dtype=torch.bool)
+        attention_mask = torch.cat([encoder_attention_mask.bool(), image_mask], dim=1)
+        return super().forward(
+            hidden_states = hidden_states,
+            encoder_hidden_states = encoder_hidden_states,
+            pooled_projections = pooled_projections,
+            timestep = timestep,
+            img_ids = img_ids,
+            txt_ids = txt_ids,
+            guidance = guidance,
+            joint_attention_kwargs = {"attention_mask": attention_mask[:, None, None, :]}
+        )
+
+
+def transformer_base_inputs(batchsize, torch_dtype):
     inputs = {
         "hidden_states": torch.rand((1, 8192, 64), dtype=torch_dtype),
         "encoder_hidden_states": torch.rand((1, 512, 4096), dtype=torch_dtype),
@@ -140,11 +173,29 @@ def transformer_inputs(batchsize, torch_dtype, is_conversion_inputs=False):
         "txt_ids": torch.rand((512, 3), dtype=torch_dtype),
         "guidance": torch.rand((1), dtype=torch_dtype)
     }
+    if config.text_bucket:
+        inputs["encoder_attention_mask"] = torch.ones((1, 512), dtype=torch.int64)
+    if config.conditioning:
+        inputs = modulation_inputs(inputs)
+    return inputs
+
+
+def transformer_inputs(batchsize, torch_dtype, is_conversion_inputs=False):
+    inputs = transformer_base_inputs(batchsize, torch_dtype)
+    if config.reference_cache:
+        inputs = reference_cache_inputs(inputs)
     return inputs
 
 
 def transformer_load(model_name):
-    model = WrappedFluxTransformer2DModel.from_pretrained(model_name, subfolder="transformer", torch_dtype=torch.bfloat16)
+    model_class = MaskedFluxTransformer2DModel if config.text_bucket else WrappedFluxTransformer2DModel
+    model = model_class.from_pretrained(model_name, subfolder="transformer", torch_dtype=torch.bfloat16)
+    if config.conditioning:
+        modulation_load(model)
+    if config.reference_cache:
+        reference_cache_load(model)
+    if config.block_cache:
+        block_cache_load(model)
     return model
 
 
@@ -153,4 +204,309 @@ def transformer_conversion_inputs(model=None):
 
 
 def transformer_data_loader(data_dir, batchsize, *args, **kwargs):
-    return RandomDataLoader(transformer_inputs, batchsize, torch.float32)
\ No newline at end of file
+    return RandomDataLoader(transformer_inputs, batchsize, torch.float32)
+
+
+# -----------------------------------------------------------------------------
+# CONDITIONING
+# -----------------------------------------------------------------------------
+class ModulationInput(torch.nn.Module):
+    # Replaces an AdaLN linear, returns its slice of the precomputed conditioning modulation
+    def __init__(self, out_features):
+        super().__init__()
+        self.out_features = out_features
+        self.modulation = None
+
+    def forward(self, emb):
+        return self.modulation
+
+
+def modulation_modules(model):
+    # AdaLN layers in module order: norm1/norm1_context per block, norm per single block, norm_out
+    return [module for module in model.modules() if isinstance(module, (AdaLayerNormZero, AdaLayerNormZeroSingle, AdaLayerNormContinuous))]
+
+
+class Conditioning(torch.nn.Module):
+    # time_text_embed and the AdaLN shift/scale/gate linears of every block, all scheduled timesteps in one run
+    def __init__(self, transformer):
+        super().__init__()
+        self.time_text_embed = transformer.time_text_embed
+        self.norms = torch.nn.ModuleList(modulation_modules(transformer))
+
+    def forward(self, timestep, pooled_projections, guidance):
+        # timestep [steps] x pooled_projections [batch, 768] -> modulation [steps, batch, modulation]
+        steps, batch = timestep.shape[0], pooled_projections.shape[0]
+        timestep = (timestep[:, None] * 1000).expand(steps, batch).flatten()
+        guidance = (guidance[:, None] * 1000).expand(steps, batch).flatten()
+        pooled_projections = pooled_projections.expand(steps, -1, -1).flatten(0, 1)
+        temb = self.time_text_embed(timestep, guidance, pooled_projections)
+        modulation = torch.cat([norm.linear(norm.silu(temb)) for norm in self.norms], dim=1)
+        return modulation.unflatten(0, (steps, batch))
+
+
+def modulation_load(transformer):
+    # pooled_projections/timestep/guidance inputs replaced by one conditioning modulation row, the other weight names are unchanged
+    norms = modulation_modules(transformer)
+    for norm in norms:
+        norm.linear = ModulationInput(norm.linear.out_features)
+    sizes = [norm.linear.out_features for norm in norms]
+    config.modulation_size = sum(sizes)
+    forward = transformer.forward
+
+    def conditioning_forward(hidden_states, encoder_hidden_states, modulation, img_ids, txt_ids, *args):
+        for norm, norm_modulation in zip(norms, modulation.split(sizes, dim=1)):
+            norm.linear.modulation = norm_modulation
+        # Placeholders, the AdaLN linears are the only temb consumers
+        pooled_projections = torch.zeros((modulation.shape[0], transformer.config.pooled_projection_dim), dtype=hidden_states.dtype)
+        timestep = torch.zeros((modulation.shape[0],), dtype=hidden_states.dtype)
+        return forward(hidden_states, encoder_hidden_states, pooled_projections, timestep, img_ids, txt_ids, timestep, *args)
+    transformer.forward = conditioning_forward
+
+
+def modulation_inputs(inputs):
+    # pooled_projections/timestep/guidance -> modulation [batch, modulation] at the pooled_projections position
+    conditioning_inputs = {}
+    for name, value in inputs.items():
+        if name == "pooled_projections":
+            conditioning_inputs["modulation"] = torch.rand((value.shape[0], config.modulation_size), dtype=value.dtype)
+        elif name not in ("timestep", "guidance"):
+            conditioning_inputs[name] = value
+    return conditioning_inputs
+
+
+def conditioning_inputs(batchsize, torch_dtype):
+    return {
+        "timestep": torch.rand((28,), dtype=torch_dtype),
+        "pooled_projections": torch.rand((1, 768), dtype=torch_dtype),
+        "guidance": torch.rand((1,), dtype=torch_dtype)
+    }
+
+
+def conditioning_load(model_name):
+    model = FluxTransformer2DModel.from_pretrained(model_name, subfolder="transformer", torch_dtype=torch.bfloat16)
+    return Conditioning(model)
+
+
+def conditioning_conversion_inputs(model=None):
+    return tuple(conditioning_inputs(1, torch.float32).values())
+
+
+def conditioning_data_loader(data_dir, batchsize, *args, **kwargs):
+    return RandomDataLoader(conditioning_inputs, batchsize, torch.float32)
+
+
+
+# -----------------------------------------------------------------------------
+# REFERENCE CACHE
+# -----------------------------------------------------------------------------
+class ReferenceAttnProcessor:
+    # FluxAttnProcessor2_0 with the reference image tokens split out: capture records their key/value (last reference_length tokens), otherwise the cached key/value are appended
+    def __init__(self, capture):
+        self.capture = capture
+        self.reference_length = 0
+        self.key = None
+        self.value = None
+
+    def __call__(self, attn, hidden_states, encoder_hidden_states=None, attention_mask=None, image_rotary_emb=None):
+        batch_size = hidden_states.shape[0]
+        head_dim = attn.to_k.out_features // attn.heads
+        query = attn.to_q(hidden_states).view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        key = attn.to_k(hidden_states).view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        value = attn.to_v(hidden_states).view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        if attn.norm_q is not None:
+            query = attn.norm_q(query)
+        if attn.norm_k is not None:
+            key = attn.norm_k(key)
+
+        if encoder_hidden_states is not None:
+            encoder_query = attn.add_q_proj(encoder_hidden_states).view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+            encoder_key = attn.add_k_proj(encoder_hidden_states).view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+            encoder_value = attn.add_v_proj(encoder_hidden_states).view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+            if attn.norm_added_q is not None:
+                encoder_query = attn.norm_added_q(encoder_query)
+            if attn.norm_added_k is not None:
+                encoder_key = attn.norm_added_k(encoder_key)
+            query = torch.cat([encoder_query, query], dim=2)
+            key = torch.cat([encoder_key, key], dim=2)
+            value = torch.cat([encoder_value, value], dim=2)
+
+        if image_rotary_emb is not None:
+            query = apply_rotary_emb(query, image_rotary_emb)
+            key = apply_rotary_emb(key, image_rotary_emb)
+
+        if self.capture:
+            self.key, self.value = key[:, :, -self.reference_length:], value[:, :, -self.reference_length:]
+        else:
+            key = torch.cat([key, self.key], dim=2)
+            value = torch.cat([value, self.value], dim=2)
+            if attention_mask is not None:
+                attention_mask = torch.nn.functional.pad(attention_mask, (0, self.key.shape[2]), value=True)
+
+        hidden_states = torch.nn.functional.scaled_dot_product_attention(query, key, value, attn_mask=attention_mask, dropout_p=0.0, is_causal=False)
+        hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim).to(query.dtype)
+
+        if encoder_hidden_states is not None:
+            encoder_hidden_states, hidden_states = hidden_states.split_with_sizes([encoder_hidden_states.shape[1], hidden_states.shape[1] - encoder_hidden_states.shape[1]], dim=1)
+            hidden_states = attn.to_out[0](hidden_states)
+            hidden_states = attn.to_out[1](hidden_states)
+            encoder_hidden_states = attn.to_add_out(encoder_hidden_states)
+            return hidden_states, encoder_hidden_states
+        return hidden_states
+
+
+def reference_processors(transformer, capture):
+    # One processor per attention layer: transformer_blocks then single_transformer_blocks
+    attentions = [block.attn for block in transformer.transformer_blocks] + [block.attn for block in transformer.single_transformer_blocks]
+    if len(attentions) != config.attention_layers:
+        raise ValueError(f"config.attention_layers is {config.attention_layers}, the transformer has {len(attentions)} attention layers")
+    processors = [ReferenceAttnProcessor(capture) for attention in attentions]
+    for attention, processor in zip(attentions, processors):
+        attention.set_processor(processor)
+    config.reference_kv_shape = [attentions[0].heads, attentions[0].to_k.out_features // attentions[0].heads]
+    return processors
+
+
+class ReferenceProjection(torch.nn.Module):
+    # Full transformer step on the generated + reference tokens, also returns the reference key/value of every attention layer, run once per edit
+    def __init__(self, transformer):
+        super().__init__()
+        self.transformer = transformer
+        self.processors = reference_processors(transformer, True)
+
+    def forward(self, hidden_states, reference_hidden_states, *args):
+        for processor in self.processors:
+            processor.reference_length = reference_hidden_states.shape[1]
+        sample = self.transformer(torch.cat([hidden_states, reference_hidden_states], dim=1), *args)[0]
+        reference_kv = [tensor for processor in self.processors for tensor in (processor.key, processor.value)]
+        return (sample[:, :hidden_states.shape[1]], *reference_kv)
+
+
+def reference_cache_load(transformer):
+    # hidden_states/img_ids only cover the generated tokens, reference_key_<n>/reference_value_<n> inputs appended, weight names are unchanged
+    processors = reference_processors(transformer, False)
+    forward = transformer.forward
+
+    def reference_cache_forward(*args):
+        args, reference_kv = args[:-len(processors) * 2], args[-len(processors) * 2:]
+        for processor, key, value in zip(processors, reference_kv[0::2], reference_kv[1::2]):
+            processor.key, processor.value = key, value
+        return forward(*args)
+    transformer.forward = reference_cache_forward
+
+
+def reference_cache_inputs(inputs):
+    # Half the export image tokens are reference tokens: generated hidden_states/img_ids, reference_key_<n>/reference_value_<n> [batch, heads, reference, head_dim]
+    reference_length = inputs["hidden_states"].shape[1] // 2
+    reference_inputs = {}
+    for name, value in inputs.items():
+        if name == "hidden_states":
+            value = value[:, :-reference_length]
+        elif name == "img_ids":
+            value = value[:-reference_length]
+        reference_inputs[name] = value
+    dtype = inputs["hidden_states"].dtype
+    for index in range(config.attention_layers):
+        reference_inputs[f"reference_key_{index}"] = torch.rand((1, config.reference_kv_shape[0], reference_length, config.reference_kv_shape[1]), dtype=dtype)
+        reference_inputs[f"reference_value_{index}"] = torch.rand((1, config.reference_kv_shape[0], reference_length, config.reference_kv_shape[1]), dtype=dtype)
+    return reference_inputs
+
+
+def reference_projection_inputs(batchsize, torch_dtype):
+    # Transformer inputs with the reference tokens split out of hidden_states, img_ids cover the generated + reference tokens
+    inputs = {}
+    for name, value in transformer_base_inputs(batchsize, torch_dtype).items():
+        if name == "hidden_states":
+            inputs["hidden_states"], inputs["reference_hidden_states"] = value.chunk(2, dim=1)
+        else:
+            inputs[name] = value
+    return inputs
+
+
+def reference_projection_load(model_name):
+    model_class = MaskedFluxTransformer2DModel if config.text_bucket else WrappedFluxTransformer2DModel
+    model = model_class.from_pretrained(model_name, subfolder="transformer", torch_dtype=torch.bfloat16)
+    if config.conditioning:
+        modulation_load(model)
+    return ReferenceProjection(model)
+
+
+def reference_projection_conversion_inputs(model=None):
+    return tuple(reference_projection_inputs(1, torch.float32).values())
+
+
+def reference_projection_data_loader(data_dir, batchsize, *args, **kwargs):
+    return RandomDataLoader(reference_projection_inputs, batchsize, torch.float32)
+
+
+
+# -----------------------------------------------------------------------------
+# BLOCK CACHE
+# -----------------------------------------------------------------------------
+class BlockSkip(torch.nn.Module):
+    # Replaces the first transformer block in transformer_replay, returns its inputs, norm1 stays for the block_signal
+    def __init__(self, block):
+        super().__init__()
+        self.norm1 = block.norm1
+
+    def forward(self, hidden_states, encoder_hidden_states, *args, **kwargs):
+        return encoder_hidden_states, hidden_states
+
+
+def block_cache_load(transformer, replay=False):
+    # block_signal: the first block modulated input, cheap and follows how much the step output changes
+    # block_residual: block stack output - input (image tokens), added back to the block stack input by transformer_replay
+    first_block = transformer.transformer_blocks[0]
+    if replay:
+        first_block = BlockSkip(first_block)
+        transformer.transformer_blocks = torch.nn.ModuleList([first_block])
+        transformer.single_transformer_blocks = torch.nn.ModuleList()
+    config.block_cache_dim = transformer.inner_dim
+    state = {}
+
+    def block_input_hook(module, args, kwargs):
+        state["input"] = kwargs["hidden_states"]
+        state["signal"] = module.norm1(kwargs["hidden_states"], emb=kwargs["temb"])[0]
+    first_block.register_forward_pre_hook(block_input_hook, with_kwargs=True)
+
+    def block_output_hook(module, args):
+        if replay:
+            return (args[0] + state["residual"], *args[1:])
+        state["residual"] = args[0] - state["input"]
+    transformer.norm_out.register_forward_pre_hook(block_output_hook)
+    forward = transformer.forward
+
+    def block_cache_forward(*args):
+        if replay:
+            state["residual"] = args[-1]
+            return forward(*args[:-1])[0], state["signal"]
+        return forward(*args)[0], state["signal"], state["residual"]
+    transformer.forward = block_cache_forward
+
+
+def block_cache_inputs(inputs):
+    # block_residual [batch, image, block_cache_dim] appended after the transformer inputs
+    hidden_states = inputs["hidden_states"]
+    return {**inputs, "block_residual": torch.rand((*hidden_states.shape[:2], config.block_cache_dim), dtype=hidden_states.dtype)}
+
+
+def transformer_replay_inputs(batchsize, torch_dtype):
+    # The reference key/value (--reference_cache) only feed the attention layers, the replay takes the transformer hidden_states
+    inputs = {name: value for name, value in transformer_inputs(batchsize, torch_dtype).items() if not name.startswith("reference_")}
+    return block_cache_inputs(inputs)
+
+
+def transformer_replay_load(model_name):
+    model_class = MaskedFluxTransformer2DModel if config.text_bucket else WrappedFluxTransformer2DModel
+    model = model_class.from_pretrained(model_name, subfolder="transformer", torch_dtype=torch.bfloat16)
+    if config.conditioning:
+        modulation_load(model)
+    block_cache_load(model, True)
+    return model
+
+
+def transformer_replay_conversion_inputs(model=None):
+    return tuple(transformer_replay_inputs(1, torch.float32).values())
+
+
+def transformer_replay_data_loader(data_dir, batchsize, *args, **kwargs):
+    return RandomDataLoader(transformer_replay_inputs, batchsize, torch.float32)
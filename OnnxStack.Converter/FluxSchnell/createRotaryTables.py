@@ -0,0 +1,68 @@
+import argparse
+import numpy as np
+from pathlib import Path
+
+
+def position_ids(height: int, width: int, text_length: int):
+    # [text + image, 3] ids as the pipeline builds them: text ids are zero, image ids are (0, row, column) of the 2x2 packed latents
+    rows, cols = height // 16, width // 16
+    image_ids = np.zeros((rows, cols, 3), dtype=np.float64)
+    image_ids[..., 1] = np.arange(rows)[:, None]
+    image_ids[..., 2] = np.arange(cols)[None, :]
+    return np.concatenate([np.zeros((text_length, 3), dtype=np.float64), image_ids.reshape(-1, 3)])
+
+
+def rotary_tables(height: int, width: int, text_length: int, axes_dim: list, theta: float):
+    # FluxPosEmbed in float64: per axis cos/sin of position * theta^(-2i/dim), each frequency repeated twice
+    ids = position_ids(height, width, text_length)
+    cos_tables, sin_tables = [], []
+    for axis, dim in enumerate(axes_dim):
+        frequencies = 1.0 / (theta ** (np.arange(0, dim, 2, dtype=np.float64) / dim))
+        angles = np.outer(ids[:, axis], frequencies)
+        cos_tables.append(np.repeat(np.cos(angles), 2, axis=1))
+        sin_tables.append(np.repeat(np.sin(angles), 2, axis=1))
+    return np.concatenate(cos_tables, axis=1), np.concatenate(sin_tables, axis=1)
+
+
+def parse_resolution(resolution: str):
+    width, height = resolution.lower().split("x")
+    return int(width), int(height)
+
+
+def parse_common_args(raw_args):
+    parser = argparse.ArgumentParser("Common arguments")
+    parser.add_argument("--output", required=True, type=Path, help="Output folder, tables are saved as <width>x<height>/rotary_cos.npy and rotary_sin.npy")
+    parser.add_argument("--resolutions", default="1024x1024", type=str, help="Comma separated <width>x<height> image sizes")
+    parser.add_argument("--text_length", default=256, type=int, help="T5 text length of encoder_hidden_states")
+    parser.add_argument("--axes_dim", default="16,56,56", type=str, help="Rotary dimensions per id axis (transformer axes_dims_rope)")
+    parser.add_argument("--theta", default=10000, type=float)
+    parser.add_argument("--dtype", default="float32", choices=["float32", "float16"], help="Table type of the transformer inputs")
+    return parser.parse_known_args(raw_args)
+
+
+def main(raw_args=None):
+    common_args, extra_args = parse_common_args(raw_args)
+    resolutions = [parse_resolution(resolution) for resolution in common_args.resolutions.split(",")]
+    axes_dim = [int(dim) for dim in common_args.axes_dim.split(",")]
+
+    print('Rotary Tables')
+    print('--------------------------------------')
+    print(f'Output: {common_args.output}')
+    print(f'Resolutions: {resolutions}')
+    print(f'Text Length: {common_args.text_length}')
+    print(f'Axes Dim: {axes_dim}')
+    print('--------------------------------------')
+
+    for width, height in resolutions:
+        output_dir = common_args.output / f"{width}x{height}"
+        output_dir.mkdir(parents=True, exist_ok=True)
+        rotary_cos, rotary_sin = rotary_tables(height, width, common_args.text_length, axes_dim, common_args.theta)
+        np.save(output_dir / "rotary_cos.npy", rotary_cos.astype(common_args.dtype))
+        np.save(output_dir / "rotary_sin.npy", rotary_sin.astype(common_args.dtype))
+        print(f"{width}x{height}: {list(rotary_cos.shape)}")
+
+    print('Rotary Tables Complete.')
+
+
+if __name__ == "__main__":
+    main()
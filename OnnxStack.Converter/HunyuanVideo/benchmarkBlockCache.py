@@ -0,0 +1,145 @@
+import time
+import argparse
+import numpy as np
+import onnxruntime
+from pathlib import Path
+from tabulate import tabulate
+
+
+def create_session(model_path: Path, threads: int, provider: str):
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = threads
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return onnxruntime.InferenceSession(str(model_path), options, providers=[provider])
+
+
+class BlockCachePolicy:
+    # Reference policy: replay the cached block_residual while the accumulated relative L1 change of block_signal stays under threshold
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+        self.accumulated = 0.0
+        self.signal = None
+
+    def reset(self, signal):
+        # Full transformer step, block_residual is fresh
+        self.accumulated = 0.0
+        self.signal = signal
+
+    def replay(self, signal):
+        # block_signal of the current step (transformer_replay output), False = run the full transformer
+        self.accumulated += float(np.abs(signal - self.signal).mean() / np.abs(self.signal).mean())
+        self.signal = signal
+        return self.accumulated < self.threshold
+
+
+def transformer_inputs(session, frames: int, height: int, width: int, guidance_scale: float):
+    # Latents [1, 16, (frames - 1) / 4 + 1, height / 8, width / 8], 256 text tokens, embedded guidance scaled by 1000 as in the pipeline
+    dtypes = {"tensor(float)": np.float32, "tensor(float16)": np.float16, "tensor(int32)": np.int32, "tensor(int64)": np.int64}
+    inputs = {}
+    for input in session.get_inputs():
+        dtype = dtypes[input.type]
+        if input.name == "hidden_states":
+            inputs[input.name] = np.random.rand(1, 16, (frames - 1) // 4 + 1, height // 8, width // 8).astype(dtype)
+        elif input.name == "encoder_hidden_states":
+            inputs[input.name] = np.random.rand(1, 256, 4096).astype(dtype)
+        elif input.name == "encoder_attention_mask":
+            inputs[input.name] = np.ones((1, 256), dtype=dtype)
+        elif input.name == "pooled_projections":
+            inputs[input.name] = np.random.rand(1, 768).astype(dtype)
+        elif input.name == "guidance":
+            inputs[input.name] = np.array([guidance_scale * 1000], dtype=dtype)
+        elif input.name == "timestep":
+            continue
+        else:
+            raise ValueError(f"Unsupported input {input.name}, the benchmark expects a transformer model")
+    return inputs
+
+
+def schedule_inputs(session, sigmas: np.ndarray):
+    # timestep per step, in the transformer timestep type
+    dtypes = {"tensor(float)": np.float32, "tensor(float16)": np.float16, "tensor(int32)": np.int32, "tensor(int64)": np.int64}
+    dtype = next(dtypes[input.type] for input in session.get_inputs() if input.name == "timestep")
+    timesteps = (sigmas * 1000).astype(dtype)
+    return [{"timestep": timesteps[index:index + 1]} for index in range(len(timesteps))]
+
+
+def run_steps(full_session, replay_session, inputs: dict, steps: list, sigmas: np.ndarray, threshold: float):
+    # Flow matching euler steps, threshold 0 runs the full transformer every step
+    replay_names = [input.name for input in replay_session.get_inputs()]
+    policy = BlockCachePolicy(threshold)
+    latents = inputs["hidden_states"]
+    block_residual = None
+    full_steps = 0
+    start = time.perf_counter()
+    for step, sigma, sigma_next in zip(steps, sigmas[:-1], sigmas[1:]):
+        step_input = {**inputs, **step, "hidden_states": latents}
+        sample = None
+        if threshold > 0 and block_residual is not None:
+            replay_input = {**step_input, "block_residual": block_residual}
+            sample, block_signal = replay_session.run(None, {name: replay_input[name] for name in replay_names})
+            if not policy.replay(block_signal):
+                sample = None
+        if sample is None:
+            sample, block_signal, block_residual = full_session.run(None, step_input)
+            policy.reset(block_signal)
+            full_steps += 1
+        latents = (latents + (sigma_next - sigma) * sample).astype(latents.dtype)
+    return full_steps, (time.perf_counter() - start) * 1000, latents
+
+
+def benchmark(model_dir: Path, steps: int, thresholds: list, frames: int, height: int, width: int, guidance_scale: float, threads: int, provider: str):
+    full_session = create_session(model_dir / "transformer" / "model.onnx", threads, provider)
+    replay_session = create_session(model_dir / "transformer_replay" / "model.onnx", threads, provider)
+    inputs = transformer_inputs(full_session, frames, height, width, guidance_scale)
+    sigmas = np.linspace(1.0, 0.0, steps + 1)
+    schedule = schedule_inputs(full_session, sigmas[:-1])
+    run_steps(full_session, replay_session, inputs, schedule[:2], sigmas[:3], max(thresholds))
+
+    # Speedup and final latent difference against the full transformer on every step (threshold 0)
+    baseline_run = run_steps(full_session, replay_session, inputs, schedule, sigmas, 0)
+    _, baseline, baseline_latents = baseline_run
+    results = []
+    for threshold in thresholds:
+        full_steps, steps_ms, latents = run_steps(full_session, replay_session, inputs, schedule, sigmas, threshold) if threshold > 0 else baseline_run
+        latent_diff = float(np.abs(latents - baseline_latents).mean())
+        results.append([threshold, full_steps, steps - full_steps, steps_ms, baseline / steps_ms, latent_diff])
+    print(tabulate(results, headers=["Threshold", "Full Steps", "Replay Steps", "Steps (ms)", "Speedup", "Latent Diff"], floatfmt=".4f"))
+    return results
+
+
+def parse_common_args(raw_args):
+    parser = argparse.ArgumentParser("Common arguments")
+    parser.add_argument("--input", required=True, type=Path, help="Converted model folder with transformer and transformer_replay (--block_cache)")
+    parser.add_argument("--steps", default=50, type=int, help="Denoising steps")
+    parser.add_argument("--thresholds", default="0,0.05,0.1,0.2", type=str, help="Comma separated block_signal thresholds, 0 = full transformer every step")
+    parser.add_argument("--frames", default=61, type=int, help="Video length in frames")
+    parser.add_argument("--height", default=544, type=int)
+    parser.add_argument("--width", default=960, type=int)
+    parser.add_argument("--guidance_scale", default=6.0, type=float, help="Embedded guidance scale, the guidance input is scale * 1000")
+    parser.add_argument("--threads", default=0, type=int, help="CPU intra-op threads (0 = default)")
+    parser.add_argument("--provider", default="CPUExecutionProvider", type=str)
+    return parser.parse_known_args(raw_args)
+
+
+def main(raw_args=None):
+    common_args, extra_args = parse_common_args(raw_args)
+    thresholds = [float(threshold) for threshold in common_args.thresholds.split(",")]
+
+    print('Block Cache Benchmark')
+    print('--------------------------------------')
+    print(f'Input: {common_args.input}')
+    print(f'Steps: {common_args.steps}')
+    print(f'Thresholds: {thresholds}')
+    print(f'Frames: {common_args.frames}')
+    print(f'Size: {common_args.width}x{common_args.height}')
+    print(f'Guidance Scale: {common_args.guidance_scale}')
+    print(f'Provider: {common_args.provider}')
+    print('--------------------------------------')
+
+    benchmark(common_args.input, common_args.steps, thresholds, common_args.frames, common_args.height, common_args.width, common_args.guidance_scale, common_args.threads, common_args.provider)
+
+    print('Block Cache Benchmark Complete.')
+
+
+if __name__ == "__main__":
+    main()
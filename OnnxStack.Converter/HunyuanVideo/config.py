@@ -0,0 +1,3 @@
+block_cache = False
+block_cache_dim = 0 # block_signal/block_residual channels (inner_dim), recorded when the transformer is loaded
+attention_chunk = 0 # query tokens per attention chunk (ONNX Loop), 0 = full attention
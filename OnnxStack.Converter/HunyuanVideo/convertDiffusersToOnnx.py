@@ -1,3 +1,4 @@
+import config
 import os
 import argparse
 import json
@@ -6,9 +7,10 @@ import warnings
 from pathlib import Path
 from olive.workflows import run as olive_run
 from olive.model import ONNXModelHandler
+from ioManifest import save_io_manifest
 
 
-def optimize(script_dir: str, model_input: str, model_output: Path, submodel_names: list[str]):
+def optimize(script_dir: str, model_input: str, model_output: Path, submodel_names: list[str], io_dtype: str = "float32"):
     model_info = {}
     model_dir = model_input
    
@@ -23,6 +25,10 @@ def optimize(script_dir: str, model_input: str, model_output: Path, submodel_nam
             olive_config = json.load(fin)
 
         olive_config["input_model"]["config"]["model_path"] = model_dir
+        if io_dtype == "float16":
+            io_dtype_config(olive_config)
+        if submodel_name == "transformer_replay" or (submodel_name == "transformer" and config.block_cache):
+            block_cache_config(olive_config, submodel_name)
         run_res = olive_run(olive_config)
         save_onnx_submodel(script_dir, submodel_name, model_info)
         print(f"Optimizing {submodel_name} complete.")
@@ -31,6 +37,28 @@ def optimize(script_dir: str, model_input: str, model_output: Path, submodel_nam
     return model_info
 
 
+def block_cache_config(olive_config, submodel_name: str):
+    # block_signal/block_residual [batch, video patches, inner_dim]: transformer outputs, transformer_replay takes block_residual after the transformer inputs
+    io_config = olive_config["input_model"]["config"]["io_config"]
+    dynamic_axes = io_config.setdefault("dynamic_axes", {})
+    for name in ("block_signal", "block_residual"):
+        dynamic_axes[name] = {"1": "transformer_block_sequence"}
+    if submodel_name == "transformer":
+        # Named like transformer_replay, the block cache forward hides the guidance parameter name
+        if "guidance" not in io_config["input_names"]:
+            io_config["input_names"].append("guidance")
+        io_config["output_names"] += ["block_signal", "block_residual"]
+        return
+    io_config["input_names"].append("block_residual")
+    io_config["output_names"].append("block_signal")
+
+
+def io_dtype_config(olive_config):
+    for olive_pass in olive_config["passes"].values():
+        if "keep_io_types" in olive_pass["config"]:
+            olive_pass["config"]["keep_io_types"] = False
+
+
 def save_onnx_models(model_dir, model_info, model_output, submodel_names):
     model_dir = Path(model_dir)
     model_output.mkdir(parents=True, exist_ok=True)
@@ -85,7 +113,10 @@ def parse_common_args(raw_args):
     parser.add_argument("--input", required=True, type=str)
     parser.add_argument("--output", default=None, type=Path)
     parser.add_argument("--modules", default="transformer,vae_decoder", help="The modules to convert `tokenizer,tokenizer_2,tokenizer_3,text_encoder,text_encoder_2,text_encoder_3,vae_encoder,vae_decoder,transformer`")
+    parser.add_argument("--block_cache", default=False, action="store_true", help="Also export transformer_replay (block_residual replayed in place of the block stack), the transformer gains block_signal/block_residual outputs")
+    parser.add_argument("--attention_chunk", default=0, type=int, help="Export the transformer attention in query chunks of N tokens (ONNX Loop), scores are [N, keys] per head instead of [queries, keys], 0 = full attention")
     parser.add_argument("--clean", default=False, action="store_true", help="Deletes the Olive cache")
+    parser.add_argument("--io_dtype", default="float32", choices=["float32", "float16"], help="Graph input/output type of the float16 models, float16 drops the float32 casts at the graph boundary (io_manifest.json lists the types)")
     return parser.parse_known_args(raw_args)
 
 
@@ -94,12 +125,17 @@ def main(raw_args=None):
     model_input = common_args.input
     model_output = common_args.output
     submodel_names = common_args.modules.split(",")
+    config.attention_chunk = common_args.attention_chunk
     script_dir = Path(__file__).resolve().parent
 
     if model_output is None:
         model_output = Path(model_input) / "_onnx"
         shutil.rmtree(model_output, ignore_errors=True)
 
+    config.block_cache = common_args.block_cache
+    if config.block_cache and "transformer" in submodel_names and "transformer_replay" not in submodel_names:
+        submodel_names.insert(submodel_names.index("transformer") + 1, "transformer_replay")
+
     if common_args.clean:
         clean(script_dir)
 
@@ -108,10 +144,14 @@ def main(raw_args=None):
     print(f'Input: {model_input}')
     print(f'Output: {model_output}')
     print(f'Modules: {submodel_names}')
+    print(f'Block Cache: {common_args.block_cache}')
+    print(f'Attention Chunk: {common_args.attention_chunk}')
+    print(f'IO Dtype: {common_args.io_dtype}')
     print('--------------------------------------')
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
-        optimize(script_dir, model_input, model_output, submodel_names)
+        optimize(script_dir, model_input, model_output, submodel_names, io_dtype=common_args.io_dtype)
+    save_io_manifest(model_output)
 
     clean(script_dir)
     print('Olive LTX-Video Conversion Complete.')
@@ -1,5 +1,6 @@
+import config
 import torch
-from typing import Union, Tuple
+from typing import Optional, Union, Tuple
 from diffusers import AutoencoderKLLTXVideo, HunyuanVideoTransformer3DModel
 from transformers import CLIPTextModel, CLIPTextModelWithProjection, T5EncoderModel
 
@@ -77,6 +78,10 @@ def transformer_inputs(batchsize, torch_dtype, is_conversion_inputs=False):
 
 def transformer_load(model_name):
     model = WrappedHunyuanVideoTransformer3DModel.from_pretrained(model_name, subfolder="transformer", torch_dtype=torch.float32)
+    if config.block_cache:
+        block_cache_load(model)
+    if config.attention_chunk:
+        attention_chunk_load(model)
     return model
 
 
@@ -88,3 +93,108 @@ def transformer_data_loader(data_dir, batchsize, *args, **kwargs):
     return RandomDataLoader(transformer_inputs, batchsize, torch.float16)
 
 
+# -----------------------------------------------------------------------------
+# BLOCK CACHE
+# -----------------------------------------------------------------------------
+class BlockSkip(torch.nn.Module):
+    # Replaces the first transformer block in transformer_replay, returns its inputs, norm1 stays for the block_signal
+    def __init__(self, block):
+        super().__init__()
+        self.norm1 = block.norm1
+
+    def forward(self, hidden_states, encoder_hidden_states, *args):
+        return hidden_states, encoder_hidden_states
+
+
+def block_cache_load(transformer, replay=False):
+    # block_signal: the first block modulated input, cheap and follows how much the step output changes
+    # block_residual: block stack output - input (video patches), added back to the block stack input by transformer_replay
+    first_block = transformer.transformer_blocks[0]
+    if replay:
+        first_block = BlockSkip(first_block)
+        transformer.transformer_blocks = torch.nn.ModuleList([first_block])
+        transformer.single_transformer_blocks = torch.nn.ModuleList()
+    config.block_cache_dim = transformer.proj_out.in_features
+    state = {}
+
+    def block_input_hook(module, args):
+        # args: hidden_states, encoder_hidden_states, temb, attention_mask, image_rotary_emb
+        state["input"] = args[0]
+        state["signal"] = module.norm1(args[0], emb=args[2])[0]
+    first_block.register_forward_pre_hook(block_input_hook)
+
+    def block_output_hook(module, args):
+        if replay:
+            return (args[0] + state["residual"], *args[1:])
+        state["residual"] = args[0] - state["input"]
+    transformer.norm_out.register_forward_pre_hook(block_output_hook)
+    forward = transformer.forward
+
+    def block_cache_forward(*args):
+        if replay:
+            state["residual"] = args[-1]
+            return forward(*args[:-1])[0], state["signal"]
+        return forward(*args)[0], state["signal"], state["residual"]
+    transformer.forward = block_cache_forward
+
+
+def block_cache_inputs(inputs):
+    # block_residual [batch, (1, 2, 2) video patches, block_cache_dim] appended after the transformer inputs
+    hidden_states = inputs["hidden_states"]
+    patches = hidden_states.shape[2] * (hidden_states.shape[3] // 2) * (hidden_states.shape[4] // 2)
+    return {**inputs, "block_residual": torch.rand((hidden_states.shape[0], patches, config.block_cache_dim), dtype=hidden_states.dtype)}
+
+
+def transformer_replay_inputs(batchsize, torch_dtype):
+    return block_cache_inputs(transformer_inputs(batchsize, torch_dtype))
+
+
+def transformer_replay_load(model_name):
+    model = WrappedHunyuanVideoTransformer3DModel.from_pretrained(model_name, subfolder="transformer", torch_dtype=torch.float32)
+    block_cache_load(model, True)
+    if config.attention_chunk:
+        attention_chunk_load(model)
+    return model
+
+
+def transformer_replay_conversion_inputs(model=None):
+    return tuple(transformer_replay_inputs(1, torch.float32).values())
+
+
+def transformer_replay_data_loader(data_dir, batchsize, *args, **kwargs):
+    return RandomDataLoader(transformer_replay_inputs, batchsize, torch.float16)
+
+
+# -----------------------------------------------------------------------------
+# CHUNKED ATTENTION
+# -----------------------------------------------------------------------------
+@torch.jit.script
+def query_chunk_attention(query: torch.Tensor, key: torch.Tensor, value: torch.Tensor, attn_mask: Optional[torch.Tensor], scale: Optional[float], chunk_size: int, chunk_mask: bool):
+    # Scripted, exported as an ONNX Loop over the dynamic query length: the scores are [chunk_size, keys] per head instead of [queries, keys]
+    outputs = []
+    for start in range(0, query.shape[-2], chunk_size):
+        mask = attn_mask
+        if mask is not None and chunk_mask:
+            mask = mask[..., start:start + chunk_size, :]
+        outputs.append(torch.nn.functional.scaled_dot_product_attention(query[..., start:start + chunk_size, :], key, value, attn_mask=mask, scale=scale))
+    return torch.cat(outputs, dim=-2)
+
+
+def chunked_scaled_dot_product_attention(query, key, value, attn_mask=None, dropout_p=0.0, is_causal=False, scale=None, **kwargs):
+    # Exact, every query chunk attends to all keys. Only a mask with a query dimension is chunked, broadcast masks are passed whole
+    chunk_mask = attn_mask is not None and attn_mask.shape[-2] != 1
+    return query_chunk_attention(query, key, value, attn_mask, scale, config.attention_chunk, chunk_mask)
+
+
+def attention_chunk_load(transformer):
+    # scaled_dot_product_attention runs in query chunks of config.attention_chunk tokens during the transformer forward, the attention processors are unchanged
+    forward = transformer.forward
+
+    def attention_chunk_forward(*args):
+        scaled_dot_product_attention = torch.nn.functional.scaled_dot_product_attention
+        torch.nn.functional.scaled_dot_product_attention = chunked_scaled_dot_product_attention
+        try:
+            return forward(*args)
+        finally:
+            torch.nn.functional.scaled_dot_product_attention = scaled_dot_product_attention
+    transformer.forward = attention_chunk_forward
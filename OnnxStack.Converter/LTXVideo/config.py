@@ -0,0 +1 @@
+attention_chunk = 0 # query tokens per attention chunk (ONNX Loop), 0 = full attention
@@ -1,5 +1,6 @@
+import config
 import torch
-from typing import Union, Tuple
+from typing import Optional, Union, Tuple
 from diffusers import AutoencoderKLLTXVideo, LTXVideoTransformer3DModel
 from transformers import CLIPTextModel, CLIPTextModelWithProjection, T5EncoderModel
 
@@ -86,6 +87,8 @@ def transformer_inputs(batchsize, torch_dtype, is_conversion_inputs=False):
 
 def transformer_load(model_name):
     model = WrappedLTXVideoTransformer3DModel.from_pretrained(model_name, subfolder="transformer", torch_dtype=torch.float32)
+    if config.attention_chunk:
+        attention_chunk_load(model)
     return model
 
 
@@ -97,3 +100,36 @@ def transformer_data_loader(data_dir, batchsize, *args, **kwargs):
     return RandomDataLoader(transformer_inputs, batchsize, torch.float16)
 
 
+# -----------------------------------------------------------------------------
+# CHUNKED ATTENTION
+# -----------------------------------------------------------------------------
+@torch.jit.script
+def query_chunk_attention(query: torch.Tensor, key: torch.Tensor, value: torch.Tensor, attn_mask: Optional[torch.Tensor], scale: Optional[float], chunk_size: int, chunk_mask: bool):
+    # Scripted, exported as an ONNX Loop over the dynamic query length: the scores are [chunk_size, keys] per head instead of [queries, keys]
+    outputs = []
+    for start in range(0, query.shape[-2], chunk_size):
+        mask = attn_mask
+        if mask is not None and chunk_mask:
+            mask = mask[..., start:start + chunk_size, :]
+        outputs.append(torch.nn.functional.scaled_dot_product_attention(query[..., start:start + chunk_size, :], key, value, attn_mask=mask, scale=scale))
+    return torch.cat(outputs, dim=-2)
+
+
+def chunked_scaled_dot_product_attention(query, key, value, attn_mask=None, dropout_p=0.0, is_causal=False, scale=None, **kwargs):
+    # Exact, every query chunk attends to all keys. Only a mask with a query dimension is chunked, broadcast masks are passed whole
+    chunk_mask = attn_mask is not None and attn_mask.shape[-2] != 1
+    return query_chunk_attention(query, key, value, attn_mask, scale, config.attention_chunk, chunk_mask)
+
+
+def attention_chunk_load(transformer):
+    # scaled_dot_product_attention runs in query chunks of config.attention_chunk tokens during the transformer forward, the attention processors are unchanged
+    forward = transformer.forward
+
+    def attention_chunk_forward(*args):
+        scaled_dot_product_attention = torch.nn.functional.scaled_dot_product_attention
+        torch.nn.functional.scaled_dot_product_attention = chunked_scaled_dot_product_attention
+        try:
+            return forward(*args)
+        finally:
+            torch.nn.functional.scaled_dot_product_attention = scaled_dot_product_attention
+    transformer.forward = attention_chunk_forward
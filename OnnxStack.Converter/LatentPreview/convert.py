@@ -14,6 +14,7 @@ from packaging import version
 from olive.common.utils import set_tempdir
 from olive.workflows import run as olive_run
 from olive.model import ONNXModelHandler
+from ioManifest import save_io_manifest
 
 
 def optimize(
@@ -137,6 +138,7 @@ def main(raw_args=None):
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
         optimize(script_dir, model_output, Path(model_output), provider)
+    save_io_manifest(model_output)
 
 
 if __name__ == "__main__":
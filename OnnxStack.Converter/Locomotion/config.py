@@ -1,9 +1,19 @@
 vae_sample_size = 512
 unet_sample_size = 64
 cross_attention_dim = 768
-context_size = 16
+context_size = 16 # frames traced during export, the unet frame axis (unet_frames) is dynamic
 #motion_adapter_name = "guoyww/animatediff-motion-adapter-v1-5-3"
 motion_adapter_name ="https://huggingface.co/ByteDance/AnimateDiff-Lightning/blob/main/animatediff_lightning_8step_diffusers.safetensors"
+split_motion_modules = False # unet/controlnet weights saved as spatial.onnx.data (shared by every motion adapter) and motion.onnx.data
+context_kv = False # unet with precomputed cross-attention key/value inputs (context_projection model), needs lora_export = "fuse"
+cross_attention_layers = 16 # cross-attention layers in the unet, one key_<n>/value_<n> input pair each with context_kv
+cross_attention_dims = [] # key/value dims per layer, recorded when the unet is loaded
+timestep_table = False # unet with an int64 timestep_index input, time embeddings of every discrete timestep precomputed
+timestep_table_size = 1000 # discrete training timesteps, timestep_index rows of the timestep table
+time_embed_dim = 0 # recorded when the unet is loaded
+deep_cache = False # also export unet_shallow (outermost blocks only, deep_cache input), the unet gains the deep_cache output
+deep_cache_channels = 0 # up_blocks[-2] output channels of the deep_cache feature, recorded when the unet is loaded
+lora_export = "fuse" # fuse: LoRAs baked into the unet, scale: unfused LoRAs with lora_scale_<n> inputs, adapter: scale + an ONNX Runtime adapter file per LoRA
 lora_adapters = [
     #"guoyww/animatediff-motion-lora-v1-5-3",
     #"guoyww/animatediff-motion-lora-zoom-out",
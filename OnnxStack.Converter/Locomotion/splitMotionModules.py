@@ -0,0 +1,116 @@
+import argparse
+import numpy as np
+import onnx
+from pathlib import Path
+from onnx import helper, TensorProto
+from swapWeights import create_weight_map, load_safetensors
+
+
+ALIGNMENT = 4096
+
+
+def tensor_itemsize(tensor: TensorProto):
+    return np.dtype(helper.tensor_dtype_to_np_dtype(tensor.data_type)).itemsize
+
+
+def split_motion_modules(model_path: Path, motion_weights: Path, output_dir: Path, spatial_name: str = "spatial", motion_name: str = "motion"):
+    # Rewrite the external data of a motion unet into two files, the SD1.5 spatial weights
+    # and the AnimateDiff motion module weights. The graph links both at load time, so the
+    # spatial file is shared by every motion adapter converted from the same base model
+    model_path = Path(model_path)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    motion_sources = {name: source for name, source in load_safetensors(motion_weights).items() if np.issubdtype(source.dtype, np.floating)}
+    weight_map = create_weight_map(model_path, motion_weights, set(motion_sources.keys()))
+    model = onnx.load(model_path, load_external_data=False)
+
+    # The restricted weight map has no coverage check, an unmatched motion weight would land in the shared spatial file
+    mapped_sources = set()
+    for mapping in weight_map.values():
+        if mapping["type"] == "tensor":
+            mapped_sources.update(candidate[0] for candidate in mapping["candidates"])
+        else:
+            mapped_sources.update(candidate[0] for column in mapping["columns"] for candidate in column)
+    unmatched = [name for name in motion_sources if name not in mapped_sources]
+    unmatched += [tensor.name for tensor in model.graph.initializer if "motion_modules" in tensor.name and tensor.name not in weight_map]
+    if unmatched:
+        raise ValueError(f"{len(unmatched)} motion module weights could not be located in {model_path}: {unmatched}")
+
+    data_files = {}
+    outputs = {
+        spatial_name: open(output_dir / f"{spatial_name}.onnx.data", "wb"),
+        motion_name: open(output_dir / f"{motion_name}.onnx.data", "wb")
+    }
+    sizes = {spatial_name: 0, motion_name: 0}
+    inline_motion_size = 0
+    try:
+        for tensor in model.graph.initializer:
+            if tensor.data_location != TensorProto.EXTERNAL:
+                # Small initializers stay in model.onnx, which is per motion adapter
+                if tensor.name in weight_map:
+                    inline_motion_size += int(np.prod(tensor.dims)) * tensor_itemsize(tensor)
+                continue
+
+            info = {entry.key: entry.value for entry in tensor.external_data}
+            location = info["location"]
+            if location not in data_files:
+                data_files[location] = np.memmap(model_path.parent / location, dtype=np.uint8, mode="r")
+            offset = int(info.get("offset", 0))
+            length = int(info["length"])
+
+            target = motion_name if tensor.name in weight_map else spatial_name
+            output = outputs[target]
+            padding = -output.tell() % ALIGNMENT
+            output.write(b"\0" * padding)
+            target_offset = output.tell()
+            output.write(data_files[location][offset:offset + length].tobytes())
+            sizes[target] += length
+
+            del tensor.external_data[:]
+            for key, value in (("location", f"{target}.onnx.data"), ("offset", str(target_offset)), ("length", str(length))):
+                entry = tensor.external_data.add()
+                entry.key = key
+                entry.value = value
+    finally:
+        for output in outputs.values():
+            output.close()
+
+    # Each motion weight written exactly once, the safetensors size in the graph float type
+    itemsize = next(tensor_itemsize(tensor) for tensor in model.graph.initializer if tensor.name in weight_map)
+    expected_size = sum(source.size for source in motion_sources.values()) * itemsize
+    if sizes[motion_name] + inline_motion_size != expected_size:
+        raise ValueError(f"Motion weights written: {sizes[motion_name] + inline_motion_size} bytes, expected {expected_size} bytes from {motion_weights}")
+
+    onnx.save(model, output_dir / model_path.name)
+    print(f"Spatial weights: {sizes[spatial_name] / 1024 ** 2:.0f}MB, Motion weights: {sizes[motion_name] / 1024 ** 2:.0f}MB")
+    return output_dir / model_path.name
+
+
+def parse_common_args(raw_args):
+    parser = argparse.ArgumentParser("Common arguments")
+    parser.add_argument("--input", required=True, type=Path, help="Converted unet/controlnet model.onnx")
+    parser.add_argument("--motion_weights", required=True, type=Path, help="Motion module safetensors the model was converted with")
+    parser.add_argument("--output", required=True, type=Path)
+    parser.add_argument("--spatial_name", default="spatial", type=str, help="Spatial weights file name")
+    parser.add_argument("--motion_name", default="motion", type=str, help="Motion weights file name")
+    return parser.parse_known_args(raw_args)
+
+
+def main(raw_args=None):
+    common_args, extra_args = parse_common_args(raw_args)
+
+    print('Motion Module Split')
+    print('--------------------------------------')
+    print(f'Input: {common_args.input}')
+    print(f'Motion Weights: {common_args.motion_weights}')
+    print(f'Output: {common_args.output}')
+    print('--------------------------------------')
+
+    split_motion_modules(common_args.input, common_args.motion_weights, common_args.output, common_args.spatial_name, common_args.motion_name)
+
+    print('Motion Module Split Complete.')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import math
+import time
+import argparse
+import numpy as np
+import onnxruntime
+from pathlib import Path
+from tabulate import tabulate
+
+
+def create_session(model_path: Path, threads: int):
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = threads
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return onnxruntime.InferenceSession(str(model_path), options, providers=["CPUExecutionProvider"])
+
+
+def unet_inputs(session, context_size: int, height: int, width: int):
+    dtypes = {"tensor(float)": np.float32, "tensor(float16)": np.float16, "tensor(int64)": np.int64}
+    inputs = {}
+    for input in session.get_inputs():
+        dtype = dtypes[input.type]
+        if input.name == "sample":
+            inputs[input.name] = np.random.rand(1, 4, context_size, height // 8, width // 8).astype(dtype)
+        elif input.name in ("timestep", "timestep_index"):
+            inputs[input.name] = np.array([999], dtype=dtype)
+        elif input.name == "encoder_hidden_states" or input.name.startswith(("key_", "value_")):
+            hidden_size = input.shape[2] if isinstance(input.shape[2], int) else 768
+            inputs[input.name] = np.random.rand(context_size, 77, hidden_size).astype(dtype)
+        elif input.name == "guidance_scale":
+            inputs[input.name] = np.array([7.5], dtype=dtype)
+        elif input.name.startswith("lora_scale_"):
+            inputs[input.name] = np.ones((1,), dtype=dtype)
+        elif input.name == "deep_cache":
+            raise ValueError("unet_shallow needs the deep_cache of the full unet, benchmark the unet model or use benchmarkDeepCache.py")
+        else:
+            raise ValueError(f"Unsupported input {input.name}, the benchmark expects a unet model")
+    return inputs
+
+
+def window_count(frames: int, context_size: int, stride: int):
+    # Sliding windows of context_size frames every stride frames, the last window is clamped to the end
+    return 1 + math.ceil(max(frames - context_size, 0) / stride)
+
+
+def benchmark_window(session, context_size: int, height: int, width: int, runs: int):
+    inputs = unet_inputs(session, context_size, height, width)
+    session.run(None, inputs)
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        session.run(None, inputs)
+        timings.append(time.perf_counter() - start)
+    return float(np.median(timings)) * 1000
+
+
+def benchmark(model_path: Path, frames: int, context_sizes: list, overlaps: list, height: int, width: int, runs: int, threads: int):
+    session = create_session(model_path, threads)
+    results = []
+    for context_size in context_sizes:
+        context_size = min(context_size, frames)
+        window_ms = benchmark_window(session, context_size, height, width, runs)
+        for overlap in overlaps:
+            if overlap >= context_size:
+                continue
+            windows = window_count(frames, context_size, context_size - overlap)
+            step_ms = windows * window_ms
+            results.append([context_size, overlap, windows, windows * context_size / frames, window_ms, step_ms, step_ms / frames])
+
+    results.sort(key=lambda result: result[5])
+    print(tabulate(results, headers=["Context", "Overlap", "Windows", "Frame Cost", "Window (ms)", "Step (ms)", "Frame (ms)"], floatfmt=".2f"))
+    return results
+
+
+def parse_common_args(raw_args):
+    parser = argparse.ArgumentParser("Common arguments")
+    parser.add_argument("--input", required=True, type=Path, help="Converted unet model.onnx")
+    parser.add_argument("--frames", default=64, type=int, help="Video length in frames")
+    parser.add_argument("--context_sizes", default="8,16,24", type=str, help="Comma separated context window sizes")
+    parser.add_argument("--overlaps", default="0,2,4,8", type=str, help="Comma separated window overlaps in frames")
+    parser.add_argument("--height", default=512, type=int)
+    parser.add_argument("--width", default=512, type=int)
+    parser.add_argument("--runs", default=3, type=int, help="Timed runs per context size")
+    parser.add_argument("--threads", default=0, type=int, help="CPU intra-op threads (0 = default)")
+    return parser.parse_known_args(raw_args)
+
+
+def main(raw_args=None):
+    common_args, extra_args = parse_common_args(raw_args)
+    context_sizes = [int(context_size) for context_size in common_args.context_sizes.split(",")]
+    overlaps = [int(overlap) for overlap in common_args.overlaps.split(",")]
+
+    print('Context Window Benchmark')
+    print('--------------------------------------')
+    print(f'Input: {common_args.input}')
+    print(f'Frames: {common_args.frames}')
+    print(f'Context Sizes: {context_sizes}')
+    print(f'Overlaps: {overlaps}')
+    print(f'Size: {common_args.width}x{common_args.height}')
+    print('--------------------------------------')
+
+    benchmark(common_args.input, common_args.frames, context_sizes, overlaps, common_args.height, common_args.width, common_args.runs, common_args.threads)
+
+    print('Context Window Benchmark Complete.')
+
+
+if __name__ == "__main__":
+    main()
@@ -8,9 +8,12 @@ import config
 from olive.workflows import run as olive_run
 from olive.model import ONNXModelHandler
 from huggingface_hub import hf_hub_download
+from convertLoraAdapter import create_lora_adapters
+from splitMotionModules import split_motion_modules
+from ioManifest import save_io_manifest
 
 
-def optimize(script_dir: str, model_input: str, model_output: Path, submodel_names: list[str]):
+def optimize(script_dir: str, model_input: str, model_output: Path, submodel_names: list[str], io_dtype: str = "float32"):
     model_info = {}
     model_dir = model_input
    
@@ -25,6 +28,16 @@ def optimize(script_dir: str, model_input: str, model_output: Path, submodel_nam
             olive_config = json.load(fin)
 
         olive_config["input_model"]["config"]["model_path"] = model_dir
+        if io_dtype == "float16":
+            io_dtype_config(olive_config)
+        if submodel_name in ("unet", "unet_shallow", "controlnet") and config.lora_export != "fuse":
+            olive_config["input_model"]["config"]["io_config"]["input_names"] += lora_scale_names()
+        if submodel_name == "context_projection" or (submodel_name in ("unet", "unet_shallow") and config.context_kv):
+            context_kv_config(olive_config, submodel_name)
+        if submodel_name in ("unet", "unet_shallow") and config.timestep_table:
+            timestep_table_config(olive_config)
+        if submodel_name in ("unet", "unet_shallow") and config.deep_cache:
+            deep_cache_config(olive_config, submodel_name)
         run_res = olive_run(olive_config)
         save_onnx_submodel(script_dir, submodel_name, model_info)
         print(f"Optimizing {submodel_name} complete.")
@@ -33,6 +46,46 @@ def optimize(script_dir: str, model_input: str, model_output: Path, submodel_nam
     return model_info
 
 
+def timestep_table_config(olive_config):
+    # int64 timestep_index in place of the float timestep
+    io_config = olive_config["input_model"]["config"]["io_config"]
+    dynamic_axes = io_config["dynamic_axes"]
+    for name, table_name in [("timestep", "timestep_index")]:
+        io_config["input_names"][io_config["input_names"].index(name)] = table_name
+        dynamic_axes[table_name] = dynamic_axes.pop(name)
+
+
+def deep_cache_config(olive_config, submodel_name: str):
+    # deep_cache [frames, channels, height, width]: unet output, unet_shallow input after the other inputs
+    io_config = olive_config["input_model"]["config"]["io_config"]
+    io_config["dynamic_axes"]["deep_cache"] = {"0": "unet_frames", "2": "unet_sample_height", "3": "unet_sample_width"}
+    if submodel_name == "unet":
+        io_config["output_names"].append("deep_cache")
+        return
+    io_config["input_names"].append("deep_cache")
+
+
+def context_kv_config(olive_config, submodel_name: str):
+    # key_<n>/value_<n> per cross-attention layer: context_projection outputs, unet inputs in place of encoder_hidden_states
+    io_config = olive_config["input_model"]["config"]["io_config"]
+    names = [f"{kind}_{index}" for index in range(config.cross_attention_layers) for kind in ("key", "value")]
+    dynamic_axes = io_config["dynamic_axes"]
+    for name in names:
+        dynamic_axes[name] = dict(dynamic_axes["encoder_hidden_states"])
+    if submodel_name == "context_projection":
+        io_config["output_names"] = names
+        return
+    index = io_config["input_names"].index("encoder_hidden_states")
+    io_config["input_names"][index:index + 1] = names
+    dynamic_axes.pop("encoder_hidden_states")
+
+
+def io_dtype_config(olive_config):
+    for olive_pass in olive_config["passes"].values():
+        if "keep_io_types" in olive_pass["config"]:
+            olive_pass["config"]["keep_io_types"] = False
+
+
 def save_onnx_models(script_dir, model_dir, model_info, model_output, submodel_names):
     model_dir = Path(model_dir)
     model_output.mkdir(parents=True, exist_ok=True)
@@ -55,6 +108,13 @@ def save_onnx_models(script_dir, model_dir, model_info, model_output, submodel_n
 
         # model.onnx & model.onnx.data
         src_path = model_info[submodel_name]["path"]
+        if submodel_name in ("unet", "unet_shallow", "controlnet") and config.lora_export == "adapter":
+            create_lora_adapters(src_path, script_dir / ".olive-cache" / "lora", dst_dir)
+        if submodel_name in ("unet", "unet_shallow", "controlnet") and config.split_motion_modules:
+            # spatial.onnx.data & motion.onnx.data
+            split_motion_modules(src_path, script_dir / ".olive-cache" / "weights" / "motion_modules.safetensors", dst_dir)
+            continue
+
         src_data_path = src_path.parent / "model.onnx.data"
         shutil.copy(src_path, dst_dir)
         if os.path.exists(src_data_path):
@@ -63,6 +123,11 @@ def save_onnx_models(script_dir, model_dir, model_info, model_output, submodel_n
     print(f"Model Output: {model_output}")
 
 
+def lora_scale_names():
+    # lcm-lora followed by the motion LoRAs
+    return [f"lora_scale_{index}" for index in range(len(config.lora_adapters) + 1)]
+
+
 def save_onnx_submodel(script_dir, submodel_name, model_info):
     footprints_file_path = (script_dir / ".olive-cache" / "models" / submodel_name / "footprints.json")
     with footprints_file_path.open("r") as footprint_file:
@@ -111,6 +176,7 @@ def parse_common_args(raw_args):
     parser.add_argument("--output", default=None, type=Path)
     parser.add_argument("--modules", default="tokenizer,resample,flow_estimation,text_encoder,vae_decoder,vae_encoder,unet,controlnet", help="The modules to convert")
     parser.add_argument("--clean", action="store_true", help="Deletes the Olive cache")
+    parser.add_argument("--io_dtype", default="float32", choices=["float32", "float16"], help="Graph input/output type of the float16 models, float16 drops the float32 casts at the graph boundary (io_manifest.json lists the types)")
     return parser.parse_known_args(raw_args)
 
 
@@ -125,6 +191,15 @@ def main(raw_args=None):
         model_output = Path(model_input) / "_onnx"
         shutil.rmtree(model_output, ignore_errors=True)
 
+    if config.lora_export not in ("fuse", "scale", "adapter"):
+        raise ValueError(f"Unknown lora_export '{config.lora_export}', expected fuse, scale or adapter")
+    if config.context_kv and config.lora_export != "fuse":
+        raise ValueError("context_kv needs lora_export = \"fuse\", context_projection has no lora_scale inputs")
+    if config.context_kv and "unet" in submodel_names and "context_projection" not in submodel_names:
+        submodel_names.insert(submodel_names.index("unet"), "context_projection")
+    if config.deep_cache and "unet" in submodel_names and "unet_shallow" not in submodel_names:
+        submodel_names.insert(submodel_names.index("unet") + 1, "unet_shallow")
+
     if common_args.clean:
         clean(script_dir)
 
@@ -133,12 +208,19 @@ def main(raw_args=None):
     print(f'Input: {model_input}')
     print(f'Output: {model_output}')
     print(f'Modules: {submodel_names}')
+    print(f'LoRA Export: {config.lora_export}')
+    print(f'Split Motion Modules: {config.split_motion_modules}')
+    print(f'Context KV: {config.context_kv}')
+    print(f'Timestep Table: {config.timestep_table}')
+    print(f'Deep Cache: {config.deep_cache}')
+    print(f'IO Dtype: {common_args.io_dtype}')
     print('--------------------------------------')
 
     download_models(script_dir, submodel_names)
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
-        optimize(script_dir, model_input, model_output, submodel_names)
+        optimize(script_dir, model_input, model_output, submodel_names, io_dtype=common_args.io_dtype)
+    save_io_manifest(model_output)
 
     clean(script_dir)
     print('Olive Locomotion Conversion Complete.')
@@ -0,0 +1,182 @@
+import argparse
+import numpy as np
+import onnx
+import onnxruntime
+from pathlib import Path
+from onnx import helper
+from swapWeights import load_safetensors, create_weight_map, tensor_transforms, apply_transform
+
+
+LORA_SUFFIXES = {
+    ".lora_A.weight": "down",
+    ".lora_B.weight": "up",
+    ".lora_down.weight": "down",
+    ".lora_up.weight": "up",
+    ".lora.down.weight": "down",
+    ".lora.up.weight": "up",
+    "_lora.down.weight": "down",
+    "_lora.up.weight": "up",
+    ".alpha": "alpha"
+}
+LORA_PREFIXES = ["base_model.model.", "unet.", "lora_unet_"]
+TRANSFORM_AXES = {"transpose": (1, 0), "nhwc": (0, 2, 3, 1)}
+
+
+def transform_axis(axis: int, transform: str):
+    # Position of a source tensor axis in the optimized initializer (swapWeights tensor_transforms)
+    return TRANSFORM_AXES[transform].index(axis) if transform in TRANSFORM_AXES else axis
+
+
+def create_lora_adapters(model_path: Path, lora_dir: Path, output_dir: Path):
+    # Expose the unfused LoRA weights of the optimized graph as overridable inputs
+    # and write one ONNX Runtime adapter file per LoRA
+    lora_paths = sorted(Path(lora_dir).glob("*.safetensors"))
+    model = onnx.load(model_path, load_external_data=False)
+
+    renames = {}
+    for lora_path in lora_paths:
+        weight_map = create_weight_map(model_path, lora_path)
+        for name, mapping in weight_map.items():
+            if mapping["type"] != "tensor":
+                raise ValueError(f"LoRA weight {name} was packed by the optimizer")
+            source_name, transform = mapping["candidates"][0]
+            # Linear (out, in) and conv (out, in, kh, kw) LoRA weights: rank on axis 0 of lora_A, axis 1 of lora_B
+            rank_axis = transform_axis(0 if ".lora_A." in source_name else 1, transform)
+            renames[name] = (source_name, rank_axis, f"{lora_path.stem}_rank")
+
+    for node in model.graph.node:
+        for index, input_name in enumerate(node.input):
+            if input_name in renames:
+                node.input[index] = renames[input_name][0]
+
+    for tensor in model.graph.initializer:
+        if tensor.name not in renames:
+            continue
+        source_name, rank_axis, rank_name = renames[tensor.name]
+        shape = list(tensor.dims)
+        shape[rank_axis] = rank_name
+        tensor.name = source_name
+        model.graph.input.append(helper.make_tensor_value_info(source_name, tensor.data_type, shape))
+
+    onnx.save(model, model_path)
+    print(f"LoRA inputs: {len(renames)}")
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for lora_path in lora_paths:
+        save_adapter(model_path, lora_path, lora_path.stem, output_dir / f"{lora_path.stem}.onnx_adapter")
+
+
+def lora_parameters(lora: dict, adapter_name: str, input_names: set):
+    # {input_name: tensor}, diffusers/kohya LoRA files get alpha / rank folded into lora_B
+    modules = {}
+    for name in input_names:
+        suffix = f".lora_A.{adapter_name}.weight"
+        if name.endswith(suffix):
+            module = name[:-len(suffix)]
+            modules[module] = module
+            modules[module.replace(".", "_")] = module
+
+    parameters = {}
+    parts = {}
+    for key, tensor in lora.items():
+        if key in input_names:
+            parameters[key] = tensor
+            continue
+
+        suffix = next((suffix for suffix in LORA_SUFFIXES if key.endswith(suffix)), None)
+        if suffix is None:
+            continue
+        module = key[:-len(suffix)]
+        for prefix in LORA_PREFIXES:
+            if module.startswith(prefix):
+                module = module[len(prefix):]
+        module = module.replace(".processor.", ".")
+        module = modules.get(module) or modules.get(f"{module}.0") or modules.get(module.replace(".", "_"))
+        if module is None:
+            print(f"Unmatched LoRA key {key}")
+            continue
+        parts.setdefault(module, {})[LORA_SUFFIXES[suffix]] = tensor
+
+    for module, module_parts in parts.items():
+        down = np.asarray(module_parts["down"], dtype=np.float32)
+        up = np.asarray(module_parts["up"], dtype=np.float32)
+        rank = down.shape[0]
+        alpha = float(np.asarray(module_parts["alpha"]).reshape(-1)[0]) if "alpha" in module_parts else rank
+        parameters[f"{module}.lora_A.{adapter_name}.weight"] = down
+        parameters[f"{module}.lora_B.{adapter_name}.weight"] = up * (alpha / rank)
+    return parameters
+
+
+def save_adapter(model_path: Path, lora_path: Path, adapter_name: str, output_path: Path, scale: float = 1.0):
+    model = onnx.load(model_path, load_external_data=False)
+    inputs = {
+        value.name: value for value in model.graph.input
+        if value.name.endswith(f".{adapter_name}.weight") and ".lora_" in value.name
+    }
+    if not inputs:
+        raise ValueError(f"{model_path} has no LoRA inputs for {adapter_name}")
+
+    parameters = lora_parameters(load_safetensors(lora_path), adapter_name, set(inputs.keys()))
+    rank = next((value.shape[0] for name, value in parameters.items() if ".lora_A." in name), None)
+    if rank is None:
+        raise ValueError(f"{lora_path} does not target any {adapter_name} module")
+
+    adapter_parameters = {}
+    for name, value in inputs.items():
+        tensor_type = value.type.tensor_type
+        dtype = helper.tensor_dtype_to_np_dtype(tensor_type.elem_type)
+        dims = [dim.dim_value if dim.HasField("dim_value") else None for dim in tensor_type.shape.dim]
+        if name not in parameters:
+            # Modules the LoRA does not target get a zero delta, the graph input shape with the symbolic rank filled in
+            shape = [rank if dim is None else dim for dim in dims]
+            adapter_parameters[name] = onnxruntime.OrtValue.ortvalue_from_numpy(np.zeros(shape, dtype=dtype))
+            continue
+
+        # The same layout transform the optimizer applied to the exported LoRA weight (transpose, nhwc), the LoRA strength is folded into lora_B
+        parameter = parameters[name] * scale if ".lora_B." in name else parameters[name]
+        transform, value = next(((transform, value) for transform, value in tensor_transforms(parameter) if value.ndim == len(dims) and all(dim in (None, size) for dim, size in zip(dims, value.shape))), (None, None))
+        if transform is None:
+            raise ValueError(f"{lora_path} weight {name} {parameter.shape} does not match the model input {dims}")
+        adapter_parameters[name] = onnxruntime.OrtValue.ortvalue_from_numpy(apply_transform(parameter, transform, value.shape, dtype))
+
+    adapter_format = onnxruntime.AdapterFormat()
+    adapter_format.set_adapter_version(1)
+    adapter_format.set_model_version(1)
+    adapter_format.set_parameters(adapter_parameters)
+    adapter_format.export_adapter(str(output_path))
+    print(f"Adapter {adapter_name}: {output_path}")
+
+
+def parse_common_args(raw_args):
+    parser = argparse.ArgumentParser("Common arguments")
+    parser.add_argument("--input", required=True, type=Path, help="Converted unet/controlnet model.onnx exported with lora_export = \"adapter\"")
+    parser.add_argument("--lora", required=True, type=Path, help="LoRA safetensors file")
+    parser.add_argument("--adapter", default="motion_lora_0", type=str, help="The LoRA slot to target (motion_lora_<n>)")
+    parser.add_argument("--scale", default=1.0, type=float, help="LoRA strength folded into the adapter weights")
+    parser.add_argument("--output", default=None, type=Path)
+    return parser.parse_known_args(raw_args)
+
+
+def main(raw_args=None):
+    common_args, extra_args = parse_common_args(raw_args)
+    model_output = common_args.output
+    if model_output is None:
+        model_output = common_args.input.parent / f"{common_args.lora.stem}.onnx_adapter"
+
+    print('LoRA Adapter Conversion')
+    print('--------------------------------------')
+    print(f'Input: {common_args.input}')
+    print(f'LoRA: {common_args.lora}')
+    print(f'Adapter: {common_args.adapter}')
+    print(f'Scale: {common_args.scale}')
+    print(f'Output: {model_output}')
+    print('--------------------------------------')
+
+    save_adapter(common_args.input, common_args.lora, common_args.adapter, model_output, common_args.scale)
+
+    print('LoRA Adapter Conversion Complete.')
+
+
+if __name__ == "__main__":
+    main()
@@ -37,6 +37,7 @@ def parse_common_args(raw_args):
     parser.add_argument("--output", default=None, type=Path)
     parser.add_argument("--modules", default="tokenizer,resample,flow_estimation,text_encoder,vae_encoder,vae_decoder,unet,controlnet", help="The modules to convert `tokenizer,resample,flow_estimation,text_encoder,vae_encoder,vae_decoder,unet,controlnet`")
     parser.add_argument("--clean", default=False, action="store_true", help="Deletes the Olive cache")
+    parser.add_argument("--io_dtype", default="float32", choices=["float32", "float16"], help="Graph input/output type of the float16 models, float16 drops the float32 casts at the graph boundary (io_manifest.json lists the types)")
     return parser.parse_known_args(raw_args)
 
 
@@ -1,8 +1,12 @@
 import config
 import torch
+from pathlib import Path
 from typing import Union, Tuple
 from diffusers import  UNetMotionModel, MotionAdapter, AnimateDiffPipeline, UNet2DConditionModel, AutoencoderKL
+from diffusers.models.attention_processor import Attention
 from transformers.models.clip.modeling_clip import CLIPTextModel
+from peft.tuners.lora import LoraLayer
+from safetensors.torch import save_file
 
 # Helper latency-only dataloader that creates random tensors with no label
 class RandomDataLoader:
@@ -84,6 +88,81 @@ def vae_decoder_data_loader(data_dir, batchsize, *args, **kwargs):
 
 
 
+# -----------------------------------------------------------------------------
+# MOTION MODULES
+# -----------------------------------------------------------------------------
+def save_motion_weights(unet):
+    # Motion module weights as exported, splitMotionModules moves their initializers to motion.onnx.data
+    weights_dir = Path(__file__).resolve().parent / ".olive-cache" / "weights"
+    weights_dir.mkdir(parents=True, exist_ok=True)
+    weights = {key: value.float().contiguous() for key, value in unet.state_dict().items() if ".motion_modules." in key}
+    save_file(weights, weights_dir / "motion_modules.safetensors")
+
+
+
+# -----------------------------------------------------------------------------
+# LORA
+# -----------------------------------------------------------------------------
+def lora_adapters():
+    adapters = [("lcm-lora", config.adapter_scale)]
+    adapters += [(f"motion_lora_{index}", config.lora_adapter_scales[index]) for index in range(len(config.lora_adapters))]
+    return adapters
+
+
+def lora_inputs(torch_dtype):
+    if config.lora_export == "fuse":
+        return {}
+    return {f"lora_scale_{index}": torch.tensor([scale], dtype=torch_dtype) for index, (name, scale) in enumerate(lora_adapters())}
+
+
+def save_lora_weights(unet, lora):
+    # PEFT named LoRA weights, convertDiffusersToOnnx matches these to the optimized graph
+    lora_dir = Path(__file__).resolve().parent / ".olive-cache" / "lora"
+    lora_dir.mkdir(parents=True, exist_ok=True)
+    state_dict = unet.state_dict()
+    for name in lora:
+        weights = {key: value.float().contiguous() for key, value in state_dict.items() if f".{name}." in key}
+        save_file(weights, lora_dir / f"{name}.safetensors")
+
+
+def lora_load(pipe):
+    adapters = lora_adapters()
+    lora = [name for name, scale in adapters]
+    lora_weights = [scale for name, scale in adapters]
+    if not lora:
+        return
+
+    if config.lora_export == "fuse":
+        print(f"Active Lora: {lora}, {lora_weights}")
+        pipe.set_adapters(lora, lora_weights)
+        pipe.fuse_lora()
+        return
+
+    # Unfused: W @ x + lora_scale_<n> * B @ (A @ x), alpha / rank is folded into B
+    print(f"Lora Inputs: {lora}")
+    pipe.set_adapters(lora, [1.0] * len(lora))
+    lora_modules = [module for module in pipe.unet.modules() if isinstance(module, LoraLayer)]
+    with torch.no_grad():
+        for module in lora_modules:
+            for name in lora:
+                if name in module.lora_B:
+                    module.lora_B[name].weight *= module.scaling[name]
+                    module.scaling[name] = 1.0
+
+    if config.lora_export == "adapter":
+        save_lora_weights(pipe.unet, lora)
+
+    forward = pipe.unet.forward
+    def lora_forward(*args):
+        for module in lora_modules:
+            for name, lora_scale in zip(lora, args[-len(lora):]):
+                if name in module.scaling:
+                    module.scaling[name] = lora_scale
+        return forward(*args[:-len(lora)])
+    pipe.unet.forward = lora_forward
+
+
+
 # -----------------------------------------------------------------------------
 # UNET
 # -----------------------------------------------------------------------------
@@ -93,6 +172,11 @@ def unet_inputs(batchsize, torch_dtype):
         "timestep": torch.rand((1), dtype=torch_dtype),
         "encoder_hidden_states": torch.rand((config.context_size, 77, config.cross_attention_dim), dtype=torch_dtype),
     }
+    inputs.update(lora_inputs(torch_dtype))
+    if config.context_kv:
+        inputs = context_kv_inputs(inputs)
+    if config.timestep_table:
+        inputs = timestep_table_inputs(inputs)
     return inputs
 
 
@@ -101,17 +185,18 @@ def unet_load(model_name):
     pipe = AnimateDiffPipeline.from_pretrained(model_name, motion_adapter=motion_adapter)
     pipe.load_lora_weights("wangfuyun/AnimateLCM", weight_name="AnimateLCM_sd15_t2v_lora.safetensors", adapter_name="lcm-lora")
 
-    lora = ["lcm-lora"]
-    lora_weights = [config.adapter_scale]
     for index, motion_lora in enumerate(config.lora_adapters):
-        name = f"motion_lora_{index}"
-        lora.append(name)
-        lora_weights.append(config.lora_adapter_scales[index])
-        pipe.load_lora_weights(motion_lora, adapter_name=name)
-
-    print(f"Active Lora: {lora}, {lora_weights}")
-    pipe.set_adapters(lora, lora_weights)
-    pipe.fuse_lora()
+        pipe.load_lora_weights(motion_lora, adapter_name=f"motion_lora_{index}")
+
+    lora_load(pipe)
+    if config.split_motion_modules:
+        save_motion_weights(pipe.unet)
+    if config.context_kv:
+        context_kv_load(pipe.unet)
+    if config.timestep_table:
+        timestep_table_load(pipe.unet)
+    if config.deep_cache:
+        deep_cache_load(pipe.unet)
     return pipe.unet
 
 
@@ -125,6 +210,241 @@ def unet_data_loader(data_dir, batchsize, *args, **kwargs):
 
 
 
+# -----------------------------------------------------------------------------
+# CONTEXT PROJECTION
+# -----------------------------------------------------------------------------
+class ContextAttnProcessor:
+    # AttnProcessor2_0 for cross-attention, key/value are the precomputed context_projection outputs
+    def __init__(self):
+        self.key = None
+        self.value = None
+
+    def __call__(self, attn, hidden_states, encoder_hidden_states=None, attention_mask=None, temb=None, *args, **kwargs):
+        residual = hidden_states
+        input_ndim = hidden_states.ndim
+        if input_ndim == 4:
+            batch_size, channel, height, width = hidden_states.shape
+            hidden_states = hidden_states.view(batch_size, channel, height * width).transpose(1, 2)
+
+        batch_size = hidden_states.shape[0]
+        if attention_mask is not None:
+            attention_mask = attn.prepare_attention_mask(attention_mask, self.key.shape[1], batch_size)
+            attention_mask = attention_mask.view(batch_size, attn.heads, -1, attention_mask.shape[-1])
+
+        query = attn.to_q(hidden_states)
+        head_dim = query.shape[-1] // attn.heads
+        query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        key = self.key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        value = self.value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+
+        hidden_states = torch.nn.functional.scaled_dot_product_attention(query, key, value, attn_mask=attention_mask, dropout_p=0.0, is_causal=False)
+        hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim).to(query.dtype)
+        hidden_states = attn.to_out[0](hidden_states)
+        hidden_states = attn.to_out[1](hidden_states)
+
+        if input_ndim == 4:
+            hidden_states = hidden_states.transpose(-1, -2).reshape(batch_size, channel, height, width)
+        if attn.residual_connection:
+            hidden_states = hidden_states + residual
+        return hidden_states / attn.rescale_output_factor
+
+
+def cross_attention_modules(model):
+    modules = [module for module in model.modules() if isinstance(module, Attention) and module.is_cross_attention]
+    if len(modules) != config.cross_attention_layers:
+        raise ValueError(f"config.cross_attention_layers is {config.cross_attention_layers}, the unet has {len(modules)} cross-attention layers")
+    return modules
+
+
+class ContextProjection(torch.nn.Module):
+    # Key/value projections of every cross-attention layer, computed once per prompt instead of every step
+    def __init__(self, unet):
+        super().__init__()
+        self.attentions = torch.nn.ModuleList(cross_attention_modules(unet))
+
+    def forward(self, encoder_hidden_states):
+        outputs = []
+        for attention in self.attentions:
+            outputs += [attention.to_k(encoder_hidden_states), attention.to_v(encoder_hidden_states)]
+        return tuple(outputs)
+
+
+def context_kv_load(unet):
+    # encoder_hidden_states input replaced by key_<n>/value_<n> per cross-attention layer, weight names are unchanged
+    attentions = cross_attention_modules(unet)
+    processors = [ContextAttnProcessor() for attention in attentions]
+    for attention, processor in zip(attentions, processors):
+        attention.set_processor(processor)
+    config.cross_attention_dims = [attention.to_k.out_features for attention in attentions]
+    forward = unet.forward
+
+    def context_kv_forward(sample, timestep, *args):
+        cross_attention_kv, args = args[:len(processors) * 2], args[len(processors) * 2:]
+        for processor, key, value in zip(processors, cross_attention_kv[0::2], cross_attention_kv[1::2]):
+            processor.key, processor.value = key, value
+        # Placeholder, the cross-attention layers are the only encoder_hidden_states consumers
+        encoder_hidden_states = torch.zeros((cross_attention_kv[0].shape[0], 1, config.cross_attention_dim), dtype=sample.dtype)
+        return forward(sample, timestep, encoder_hidden_states, *args)
+    unet.forward = context_kv_forward
+
+
+def context_kv_inputs(inputs):
+    # encoder_hidden_states [batch, sequence, cross_attention_dim] -> key_<n>/value_<n> [batch, sequence, dim] at the same position
+    context_inputs = {}
+    for name, value in inputs.items():
+        if name != "encoder_hidden_states":
+            context_inputs[name] = value
+            continue
+        for index, dim in enumerate(config.cross_attention_dims):
+            context_inputs[f"key_{index}"] = torch.rand((*value.shape[:2], dim), dtype=value.dtype)
+            context_inputs[f"value_{index}"] = torch.rand((*value.shape[:2], dim), dtype=value.dtype)
+    return context_inputs
+
+
+def context_projection_inputs(batchsize, torch_dtype):
+    return {
+        "encoder_hidden_states": torch.rand((config.context_size, 77, config.cross_attention_dim), dtype=torch_dtype)
+    }
+
+
+def context_projection_load(model_name):
+    return ContextProjection(unet_load(model_name))
+
+
+def context_projection_conversion_inputs(model=None):
+    return tuple(context_projection_inputs(1, torch.float32).values())
+
+
+def context_projection_data_loader(data_dir, batchsize, *args, **kwargs):
+    return RandomDataLoader(context_projection_inputs, batchsize, torch.float16)
+
+
+
+# -----------------------------------------------------------------------------
+# TIMESTEP TABLE
+# -----------------------------------------------------------------------------
+class TimestepTable(torch.nn.Module):
+    # Replaces time_embedding, time_embedding(time_proj(t)) of every discrete timestep is an initializer gathered by timestep_index
+    def __init__(self, table):
+        super().__init__()
+        self.register_buffer("table", table)
+        self.emb = None
+
+    def forward(self, t_emb, condition=None):
+        return self.emb.expand(t_emb.shape[0], -1)
+
+
+def timestep_table_load(unet):
+    # timestep input replaced by int64 timestep_index [batch], the sinusoidal time_proj and time_embedding MLP are not exported
+    if unet.time_embedding.cond_proj is not None:
+        raise ValueError("timestep_table does not support a timestep_cond unet (LCM guidance embedding)")
+    if config.lora_export != "fuse" and any(isinstance(module, LoraLayer) for module in unet.time_embedding.modules()):
+        raise ValueError("timestep_table needs lora_export = \"fuse\", a LoRA on time_embedding would be baked into the table")
+    with torch.no_grad():
+        timesteps = torch.arange(config.timestep_table_size)
+        table = unet.time_embedding(unet.time_proj(timesteps).to(unet.dtype))
+    unet.time_proj = torch.nn.Identity()
+    unet.time_embedding = TimestepTable(table)
+    config.time_embed_dim = table.shape[1]
+    forward = unet.forward
+
+    def timestep_table_forward(sample, timestep_index, *args):
+        unet.time_embedding.emb = unet.time_embedding.table[timestep_index]
+        # Placeholder, only its batch reaches TimestepTable
+        timestep = torch.zeros(timestep_index.shape, dtype=sample.dtype)
+        return forward(sample, timestep, *args)
+    unet.forward = timestep_table_forward
+
+
+def timestep_table_inputs(inputs):
+    # timestep -> int64 timestep_index at the same position
+    table_inputs = {}
+    for name, value in inputs.items():
+        if name == "timestep":
+            table_inputs["timestep_index"] = torch.randint(0, config.timestep_table_size, value.shape)
+        else:
+            table_inputs[name] = value
+    return table_inputs
+
+
+
+# -----------------------------------------------------------------------------
+# DEEP CACHE
+# -----------------------------------------------------------------------------
+class DeepCacheSkip(torch.nn.Module):
+    # Replaces a block the shallow unet does not run: returns its input (down blocks with one placeholder per residual), up_blocks[-2] returns the deep_cache input
+    def __init__(self, block, residuals=0):
+        super().__init__()
+        self.resnets = [None] * len(block.resnets)
+        self.residuals = residuals
+        self.cache = None
+
+    def forward(self, hidden_states, *args, **kwargs):
+        if self.cache is not None:
+            return self.cache
+        if self.residuals:
+            return hidden_states, (hidden_states,) * self.residuals
+        return hidden_states
+
+
+def deep_cache_load(unet):
+    # Adds the deep_cache output: up_blocks[-2] output, the input of the outermost up block
+    config.deep_cache_channels = unet.config.block_out_channels[1]
+    forward = unet.forward
+
+    def deep_cache_forward(*args):
+        cache = []
+        handle = unet.up_blocks[-2].register_forward_hook(lambda module, inputs, output: cache.append(output))
+        sample = forward(*args)
+        handle.remove()
+        sample = sample if torch.is_tensor(sample) else sample[0]
+        return sample, cache[-1]
+    unet.forward = deep_cache_forward
+
+
+def deep_cache_shallow_load(unet):
+    # Shallow unet: conv_in, down_blocks[0], up_blocks[-1] and conv_out, the deeper blocks are skipped and their up_blocks[-2] output is the deep_cache input
+    for index, block in enumerate(unet.down_blocks[1:], 1):
+        residuals = len(block.resnets) + (len(block.downsamplers) if block.downsamplers is not None else 0)
+        unet.down_blocks[index] = DeepCacheSkip(block, residuals)
+    unet.mid_block = DeepCacheSkip(unet.mid_block)
+    for index, block in enumerate(unet.up_blocks[:-1]):
+        unet.up_blocks[index] = DeepCacheSkip(block)
+    forward = unet.forward
+
+    def deep_cache_shallow_forward(*args):
+        unet.up_blocks[-2].cache = args[-1]
+        # The deep_cache output of the full unet is the input again, only the sample is returned
+        return forward(*args[:-1])[0]
+    unet.forward = deep_cache_shallow_forward
+
+
+def deep_cache_inputs(inputs):
+    # deep_cache [frames, channels, height, width] appended: the up_blocks[-2] output of the last full unet step
+    sample = inputs["sample"]
+    inputs["deep_cache"] = torch.rand((sample.shape[0] * sample.shape[2], config.deep_cache_channels, *sample.shape[-2:]), dtype=sample.dtype)
+    return inputs
+
+
+def unet_shallow_inputs(batchsize, torch_dtype):
+    return deep_cache_inputs(unet_inputs(batchsize, torch_dtype))
+
+
+def unet_shallow_load(model_name):
+    model = unet_load(model_name)
+    deep_cache_shallow_load(model)
+    return model
+
+
+def unet_shallow_conversion_inputs(model=None):
+    return tuple(unet_shallow_inputs(1, torch.float32).values())
+
+
+def unet_shallow_data_loader(data_dir, batchsize, *args, **kwargs):
+    return RandomDataLoader(unet_shallow_inputs, batchsize, torch.float16)
+
+
+
 # -----------------------------------------------------------------------------
 # CONTROLNET - UNET
 # -----------------------------------------------------------------------------
@@ -164,7 +484,7 @@ class UNetMotionModel(UNetMotionModel):
 
 
 def controlnet_unet_inputs(batchsize, torch_dtype):
-    return {
+    inputs = {
         "sample": torch.rand((1, 4, config.context_size, config.unet_sample_size, config.unet_sample_size), dtype=torch_dtype),
         "timestep": torch.rand((1,), dtype=torch_dtype),
         "encoder_hidden_states": torch.rand((config.context_size, 77, config.cross_attention_dim), dtype=torch_dtype),
@@ -182,6 +502,8 @@ def controlnet_unet_inputs(batchsize, torch_dtype):
         "down_block_11_additional_residual": torch.rand((config.context_size, config.unet_sample_size * 20, config.unet_sample_size // 8, config.unet_sample_size // 8), dtype=torch_dtype),
         "mid_block_additional_residual": torch.rand((config.context_size, config.unet_sample_size * 20, config.unet_sample_size // 8, config.unet_sample_size // 8), dtype=torch_dtype)
     }
+    inputs.update(lora_inputs(torch_dtype))
+    return inputs
 
 
 def controlnet_unet_load(model_name):
@@ -191,17 +513,12 @@ def controlnet_unet_load(model_name):
     pipe = AnimateDiffPipeline.from_pretrained(model_name, unet=motionModel, motion_adapter=adapter)
     pipe.load_lora_weights("wangfuyun/AnimateLCM", weight_name="AnimateLCM_sd15_t2v_lora.safetensors", adapter_name="lcm-lora")
    
-    lora = ["lcm-lora"]
-    lora_weights = [config.adapter_scale]
     for index, motion_lora in enumerate(config.lora_adapters):
-        name = f"motion_lora_{index}"
-        lora.append(name)
-        lora_weights.append(config.lora_adapter_scales[index])
-        pipe.load_lora_weights(motion_lora, adapter_name=name)
-
-    print(f"Active Lora: {lora}, {lora_weights}")
-    pipe.set_adapters(lora, lora_weights)
-    pipe.fuse_lora()
+        pipe.load_lora_weights(motion_lora, adapter_name=f"motion_lora_{index}")
+
+    lora_load(pipe)
+    if config.split_motion_modules:
+        save_motion_weights(pipe.unet)
     return pipe.unet
 
 
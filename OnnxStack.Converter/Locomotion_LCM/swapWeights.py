@@ -0,0 +1,328 @@
+import json
+import shutil
+import hashlib
+import argparse
+import numpy as np
+import onnx
+from pathlib import Path
+from onnx import helper, numpy_helper, TensorProto
+from concurrent.futures import ThreadPoolExecutor
+
+
+FLOAT_TYPES = (TensorProto.FLOAT, TensorProto.FLOAT16)
+SAFETENSORS_DTYPES = {
+    "F64": np.float64,
+    "F32": np.float32,
+    "F16": np.float16,
+    "BF16": np.uint16,
+    "I64": np.int64,
+    "I32": np.int32,
+    "I16": np.int16,
+    "I8": np.int8,
+    "U8": np.uint8,
+    "BOOL": np.bool_
+}
+
+
+def load_safetensors(model_path: Path):
+    # Memory-map every tensor of a *.safetensors file or folder, no torch required
+    model_path = Path(model_path)
+    tensors = {}
+    files = [model_path] if model_path.is_file() else sorted(model_path.glob("*.safetensors"))
+    for file in files:
+        with open(file, "rb") as f:
+            header_size = int.from_bytes(f.read(8), "little")
+            header = json.loads(f.read(header_size))
+        data = np.memmap(file, dtype=np.uint8, mode="r", offset=8 + header_size)
+        for name, info in header.items():
+            if name == "__metadata__":
+                continue
+            start, end = info["data_offsets"]
+            tensor = data[start:end].view(SAFETENSORS_DTYPES[info["dtype"]]).reshape(info["shape"])
+            if info["dtype"] == "BF16":
+                tensor = (tensor.astype(np.uint32) << 16).view(np.float32)
+            tensors[name] = tensor
+    return tensors
+
+
+def load_initializers(model_path: Path):
+    # Returns {name: (TensorProto, ndarray)}, external data is memory-mapped
+    model = onnx.load(model_path, load_external_data=False)
+    data_files = {}
+    initializers = {}
+    for tensor in model.graph.initializer:
+        dtype = helper.tensor_dtype_to_np_dtype(tensor.data_type)
+        if tensor.data_location == TensorProto.EXTERNAL:
+            info = {entry.key: entry.value for entry in tensor.external_data}
+            location = Path(model_path).parent / info["location"]
+            if location not in data_files:
+                data_files[location] = np.memmap(location, dtype=np.uint8, mode="r")
+            offset = int(info.get("offset", 0))
+            length = int(info["length"])
+            array = data_files[location][offset:offset + length].view(dtype).reshape(tensor.dims)
+        else:
+            array = numpy_helper.to_array(tensor)
+        initializers[tensor.name] = (tensor, array)
+    return initializers
+
+
+def tensor_transforms(array: np.ndarray):
+    yield "identity", array
+    if array.ndim == 2:
+        yield "transpose", array.T
+    if array.ndim == 4:
+        yield "nhwc", array.transpose(0, 2, 3, 1)
+
+
+def apply_transform(array: np.ndarray, transform: str, shape, dtype):
+    for name, value in tensor_transforms(array):
+        if name == transform:
+            return np.ascontiguousarray(cast(value, dtype)).reshape(shape)
+    raise ValueError(f"Unknown transform {transform}")
+
+
+def cast(array: np.ndarray, dtype):
+    # Same clamping as onnxruntime float16 conversion, tiny/huge values are not flushed to 0/inf
+    if dtype == np.float16 and array.dtype != np.float16:
+        array = np.asarray(array, dtype=np.float32)
+        array = np.where((array > 0) & (array < 5.96e-08), 5.96e-08, array)
+        array = np.where((array < 0) & (array > -5.96e-08), -5.96e-08, array)
+        array = np.clip(array, -65504.0, 65504.0)
+    return array.astype(dtype, copy=False)
+
+
+def hash_array(array: np.ndarray):
+    return hashlib.blake2b(np.ascontiguousarray(array).tobytes(), digest_size=16).digest()
+
+
+def create_weight_map(template_path: Path, template_weights: Path, source_names: set = None):
+    # Match every float initializer of the optimized template graph back to the PyTorch
+    # tensors it was built from. Optimizations only cast, transpose, pack or permute the
+    # weights, so each initializer is either a transformed tensor or a gather of rows.
+    # source_names restricts the map to a subset of weights (no coverage check)
+    sources = load_safetensors(template_weights)
+    if not sources:
+        raise ValueError(f"No safetensors found in {template_weights}")
+    if source_names is not None:
+        sources = {name: source for name, source in sources.items() if name in source_names}
+
+    sizes = set(source.size for source in sources.values())
+    row_sizes = set(source.shape[1] for source in sources.values() if source.ndim == 2)
+    initializers = load_initializers(template_path)
+    float_initializers = {
+        name: array for name, (tensor, array) in initializers.items()
+        if tensor.data_type in FLOAT_TYPES and array.size > 1
+        and (source_names is None or array.size in sizes or (array.ndim == 2 and array.shape[0] in row_sizes))
+    }
+    dtypes = set(array.dtype for array in float_initializers.values())
+
+    # Tensor index: (dtype, hash) -> [(source, transform)]
+    tensor_index = {}
+    for source_name, source in sources.items():
+        if not np.issubdtype(source.dtype, np.floating):
+            continue
+        for dtype in dtypes:
+            for transform, value in tensor_transforms(source):
+                key = (dtype, hash_array(cast(value, dtype)))
+                tensor_index.setdefault(key, []).append((source_name, transform))
+
+    weight_map = {}
+    used_sources = set()
+    unmatched = []
+    for name, array in float_initializers.items():
+        candidates = tensor_index.get((array.dtype, hash_array(array)))
+        if candidates is None:
+            unmatched.append(name)
+            continue
+        candidates = sorted(candidates, key=lambda c: c[0] != name)
+        weight_map[name] = {"type": "tensor", "candidates": candidates}
+        used_sources.update(candidate[0] for candidate in candidates)
+
+    # Packed weights (QKV/KV): every column is a row of a Linear weight
+    row_indexes = {}
+    remaining = []
+    for name in unmatched:
+        array = float_initializers[name]
+        if array.ndim != 2:
+            remaining.append(name)
+            continue
+        key = (array.shape[0], array.dtype)
+        if key not in row_indexes:
+            row_index = {}
+            for source_name, source in sources.items():
+                if source.ndim == 2 and source.shape[1] == array.shape[0] and np.issubdtype(source.dtype, np.floating):
+                    rows = np.ascontiguousarray(cast(source, array.dtype))
+                    for row in range(rows.shape[0]):
+                        row_index.setdefault(hash_array(rows[row]), []).append((source_name, row))
+            row_indexes[key] = row_index
+
+        # A restricted map only knows some of the packed rows, the others stay empty
+        columns = []
+        columns_t = np.ascontiguousarray(array.T)
+        for column in columns_t:
+            candidates = row_indexes[key].get(hash_array(column))
+            if candidates is None and source_names is None:
+                break
+            columns.append(candidates or [])
+
+        if len(columns) != array.shape[1] or not any(columns):
+            remaining.append(name)
+            continue
+
+        weight_map[name] = {"type": "columns", "columns": columns}
+        used_sources.update(candidate[0] for column in columns for candidate in column)
+
+    # Packed biases follow the column layout of their packed weight
+    packed_weights = [mapping for mapping in weight_map.values() if mapping["type"] == "columns"]
+    unmatched = []
+    for name in remaining:
+        array = float_initializers[name]
+        mapping = None
+        if array.ndim == 1:
+            for packed_weight in packed_weights:
+                bias_columns = bias_candidates(packed_weight["columns"], sources)
+                if len(bias_columns) != array.shape[0]:
+                    continue
+                values = cast(np.array([sources[column[0][0]][column[0][1]] for column in bias_columns]), array.dtype)
+                if np.array_equal(values, array):
+                    mapping = {"type": "columns", "columns": bias_columns}
+                    break
+        if mapping is None:
+            unmatched.append(name)
+            continue
+        weight_map[name] = mapping
+        used_sources.update(candidate[0] for column in mapping["columns"] for candidate in column)
+
+    missing = [name for name, source in sources.items() if np.issubdtype(source.dtype, np.floating) and name not in used_sources]
+    if missing and source_names is None:
+        raise ValueError(f"{len(missing)} weights could not be located in the template graph, e.g. {missing[:5]}")
+
+    print(f"Weight map: {len(weight_map)} initializers mapped, {len(unmatched)} architecture constants")
+    return weight_map
+
+
+def bias_candidates(columns, sources):
+    bias_columns = []
+    for candidates in columns:
+        bias = []
+        for source_name, row in candidates:
+            if not source_name.endswith(".weight"):
+                return []
+            bias_name = source_name[:-len("weight")] + "bias"
+            if bias_name not in sources:
+                return []
+            bias.append((bias_name, row))
+        bias_columns.append(bias)
+    return bias_columns
+
+
+def create_tensor(mapping, sources, shape, dtype, name):
+    if mapping["type"] == "tensor":
+        values = [apply_transform(sources[source_name], transform, shape, dtype) for source_name, transform in mapping["candidates"]]
+        for value in values[1:]:
+            if not np.array_equal(values[0], value):
+                raise ValueError(f"Ambiguous weight mapping for {name}")
+        return values[0]
+
+    columns = []
+    for candidates in mapping["columns"]:
+        source_name, row = candidates[0]
+        column = cast(sources[source_name][row], dtype)
+        for source_name, row in candidates[1:]:
+            if not np.array_equal(column, cast(sources[source_name][row], dtype)):
+                raise ValueError(f"Ambiguous weight mapping for {name}")
+        columns.append(column)
+    return np.ascontiguousarray(np.stack(columns, axis=-1)).reshape(shape)
+
+
+def save_variant(template_path: Path, weight_map, variant_weights: Path, output_dir: Path):
+    # Stream the variant weights into a copy of the template, graph and layout are reused as-is
+    sources = load_safetensors(variant_weights)
+    template_path = Path(template_path)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    output_path = output_dir / template_path.name
+
+    model = onnx.load(template_path, load_external_data=False)
+    tensors = {tensor.name: tensor for tensor in model.graph.initializer}
+    for name, mapping in weight_map.items():
+        candidates = mapping["candidates"] if mapping["type"] == "tensor" else [c for column in mapping["columns"] for c in column]
+        for source_name, _ in candidates:
+            if source_name not in sources:
+                raise ValueError(f"{variant_weights} is missing weight {source_name}")
+
+    external = any(tensor.data_location == TensorProto.EXTERNAL for tensor in tensors.values())
+    if external:
+        data_files = {}
+        shutil.copy(template_path, output_path)
+        for name, mapping in weight_map.items():
+            tensor = tensors[name]
+            info = {entry.key: entry.value for entry in tensor.external_data}
+            location = info["location"]
+            if location not in data_files:
+                shutil.copy(template_path.parent / location, output_dir / location)
+                data_files[location] = np.memmap(output_dir / location, dtype=np.uint8, mode="r+")
+            dtype = helper.tensor_dtype_to_np_dtype(tensor.data_type)
+            value = create_tensor(mapping, sources, tuple(tensor.dims), dtype, name)
+            offset = int(info.get("offset", 0))
+            data_files[location][offset:offset + int(info["length"])] = value.view(np.uint8).reshape(-1)
+        for data_file in data_files.values():
+            data_file.flush()
+    else:
+        for name, mapping in weight_map.items():
+            tensor = tensors[name]
+            dtype = helper.tensor_dtype_to_np_dtype(tensor.data_type)
+            value = create_tensor(mapping, sources, tuple(tensor.dims), dtype, name)
+            tensor.CopyFrom(numpy_helper.from_array(value, name))
+        onnx.save(model, output_path)
+    return output_path
+
+
+def save_variants(template_path: Path, weight_map, variants: dict, workers: int):
+    # variants: {variant_weights: output_dir}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(save_variant, template_path, weight_map, variant_weights, output_dir): variant_weights
+            for variant_weights, output_dir in variants.items()
+        }
+        results = {}
+        for future, variant_weights in futures.items():
+            try:
+                results[variant_weights] = future.result()
+            except ValueError as ex:
+                print(f"Weight swap failed for {variant_weights}: {ex}")
+                results[variant_weights] = None
+        return results
+
+
+def parse_common_args(raw_args):
+    parser = argparse.ArgumentParser("Common arguments")
+    parser.add_argument("--template", required=True, type=Path, help="Converted template model.onnx")
+    parser.add_argument("--template_weights", required=True, type=Path, help="Diffusers folder the template was converted from")
+    parser.add_argument("--input", required=True, type=str, help="Comma separated Diffusers folders to swap into the template")
+    parser.add_argument("--output", required=True, type=Path)
+    parser.add_argument("--workers", default=4, type=int, help="Number of variants written in parallel")
+    return parser.parse_known_args(raw_args)
+
+
+def main(raw_args=None):
+    common_args, extra_args = parse_common_args(raw_args)
+    variant_inputs = [Path(variant) for variant in common_args.input.split(",")]
+
+    print('Template Weight Swap')
+    print('--------------------------------------')
+    print(f'Template: {common_args.template}')
+    print(f'Template Weights: {common_args.template_weights}')
+    print(f'Input: {[str(variant) for variant in variant_inputs]}')
+    print(f'Output: {common_args.output}')
+    print('--------------------------------------')
+
+    weight_map = create_weight_map(common_args.template, common_args.template_weights)
+    variants = {variant: common_args.output / variant.name for variant in variant_inputs}
+    save_variants(common_args.template, weight_map, variants, common_args.workers)
+
+    print('Template Weight Swap Complete.')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import os
+import shutil
+import argparse
+import numpy as np
+import onnx
+from pathlib import Path
+from onnx import numpy_helper, TensorProto
+from concurrent.futures import ThreadPoolExecutor
+from swapWeights import FLOAT_TYPES, load_initializers, cast
+
+
+def merge_chunk(method: str, alpha: float, chunks: list):
+    a = chunks[0].astype(np.float32)
+    if method == "weighted_sum":
+        return a * (1.0 - alpha) + chunks[1].astype(np.float32) * alpha
+    return a + (chunks[1].astype(np.float32) - chunks[2].astype(np.float32)) * alpha
+
+
+def validate_submodel(models: list, submodel_name: str):
+    # Same initializer names, types and shapes, the merged set reuses the first graph as-is
+    expected = [(tensor.name, tensor.data_type, tuple(tensor.dims)) for tensor in models[0].graph.initializer]
+    for model in models[1:]:
+        initializers = [(tensor.name, tensor.data_type, tuple(tensor.dims)) for tensor in model.graph.initializer]
+        if initializers != expected:
+            raise ValueError(f"{submodel_name} topology does not match, models must be converted from the same architecture")
+
+
+def merge_submodel(submodel_inputs: list, submodel_output: Path, method: str, alpha: float, workers: int, chunk_size: int):
+    models = [onnx.load(path, load_external_data=False) for path in submodel_inputs]
+    validate_submodel(models, submodel_output.name)
+    initializers = [load_initializers(path) for path in submodel_inputs]
+
+    submodel_output.mkdir(parents=True, exist_ok=True)
+    model = models[0]
+    data_files = {}
+    for tensor in model.graph.initializer:
+        if tensor.data_location != TensorProto.EXTERNAL:
+            continue
+        location = next(entry.value for entry in tensor.external_data if entry.key == "location")
+        if location not in data_files:
+            size = os.path.getsize(Path(submodel_inputs[0]).parent / location)
+            data_files[location] = np.memmap(submodel_output / location, dtype=np.uint8, mode="w+", shape=(size,))
+
+    # Small tensors embedded in the graph
+    for tensor in model.graph.initializer:
+        if tensor.data_location != TensorProto.EXTERNAL and tensor.data_type in FLOAT_TYPES:
+            arrays = [initializer[tensor.name][1] for initializer in initializers]
+            value = cast(merge_chunk(method, alpha, arrays), arrays[0].dtype)
+            tensor.CopyFrom(numpy_helper.from_array(value.reshape(tuple(tensor.dims)), tensor.name))
+
+    def merge_tensor(tensor):
+        arrays = [initializer[tensor.name][1] for initializer in initializers]
+        is_float = tensor.data_type in FLOAT_TYPES
+        info = {entry.key: entry.value for entry in tensor.external_data}
+        offset = int(info.get("offset", 0))
+        output = data_files[info["location"]][offset:offset + int(info["length"])]
+        if not is_float:
+            output[:] = arrays[0].view(np.uint8).reshape(-1)
+            return
+
+        # Chunked so memory stays bounded to workers * chunk_size
+        output = output.view(arrays[0].dtype)
+        arrays = [array.reshape(-1) for array in arrays]
+        for start in range(0, output.size, chunk_size):
+            end = min(start + chunk_size, output.size)
+            output[start:end] = cast(merge_chunk(method, alpha, [array[start:end] for array in arrays]), output.dtype)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(merge_tensor, [tensor for tensor in model.graph.initializer if tensor.data_location == TensorProto.EXTERNAL]))
+
+    for data_file in data_files.values():
+        data_file.flush()
+    onnx.save(model, submodel_output / Path(submodel_inputs[0]).name)
+
+
+def merge(model_inputs: list, model_output: Path, method: str, alpha: float, modules: list, workers: int, chunk_size: int):
+    model_inputs = [Path(model_input) for model_input in model_inputs]
+    model_output.mkdir(parents=True, exist_ok=True)
+
+    for entry in sorted(model_inputs[0].iterdir()):
+        submodel_path = entry / "model.onnx"
+        if not entry.is_dir() or not submodel_path.exists() or (modules and entry.name not in modules):
+            # tokenizer, scheduler, model_index.json etc. come from the first model
+            if entry.is_dir():
+                shutil.copytree(entry, model_output / entry.name, dirs_exist_ok=True)
+            else:
+                shutil.copy(entry, model_output)
+            continue
+
+        print(f"Merging {entry.name}...")
+        submodel_inputs = [model_input / entry.name / "model.onnx" for model_input in model_inputs]
+        for submodel_input in submodel_inputs:
+            if not submodel_input.exists():
+                raise ValueError(f"{submodel_input} not found")
+
+        submodel_output = model_output / entry.name
+        merge_submodel(submodel_inputs, submodel_output, method, alpha, workers, chunk_size)
+        for file in entry.iterdir():
+            if file.is_file() and not file.name.startswith("model.onnx"):
+                shutil.copy(file, submodel_output)
+        print(f"Merging {entry.name} complete.")
+
+
+def parse_common_args(raw_args):
+    parser = argparse.ArgumentParser("Common arguments")
+    parser.add_argument("--input", required=True, type=str, help="Comma separated converted ONNX model folders, A,B for weighted_sum or A,B,C for add_difference")
+    parser.add_argument("--output", required=True, type=Path)
+    parser.add_argument("--method", default="weighted_sum", choices=["weighted_sum", "add_difference"], help="weighted_sum: A * (1 - alpha) + B * alpha, add_difference: A + (B - C) * alpha")
+    parser.add_argument("--alpha", default=0.5, type=float, help="Merge ratio")
+    parser.add_argument("--modules", default=None, type=str, help="The modules to merge, other modules are copied from the first model (default all)")
+    parser.add_argument("--workers", default=8, type=int, help="Number of tensors merged in parallel")
+    parser.add_argument("--chunk_size", default=16 * 1024 * 1024, type=int, help="Elements per merge chunk")
+    return parser.parse_known_args(raw_args)
+
+
+def main(raw_args=None):
+    common_args, extra_args = parse_common_args(raw_args)
+    model_inputs = common_args.input.split(",")
+    modules = common_args.modules.split(",") if common_args.modules else None
+    expected_inputs = 2 if common_args.method == "weighted_sum" else 3
+    if len(model_inputs) != expected_inputs:
+        raise ValueError(f"{common_args.method} requires {expected_inputs} input models")
+
+    print('Checkpoint Merge')
+    print('--------------------------------------')
+    print(f'Input: {model_inputs}')
+    print(f'Output: {common_args.output}')
+    print(f'Method: {common_args.method}')
+    print(f'Alpha: {common_args.alpha}')
+    print(f'Modules: {modules}')
+    print('--------------------------------------')
+
+    merge(model_inputs, common_args.output, common_args.method, common_args.alpha, modules, common_args.workers, common_args.chunk_size)
+
+    print('Checkpoint Merge Complete.')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+import shutil
+import argparse
+import numpy as np
+import onnx
+from pathlib import Path
+from onnx import numpy_helper, TensorProto
+from concurrent.futures import ThreadPoolExecutor
+from swapWeights import load_safetensors, load_initializers, create_weight_map, apply_transform, cast
+
+
+LORA_SUFFIXES = {
+    ".lora_A.weight": "down",
+    ".lora_B.weight": "up",
+    ".lora_down.weight": "down",
+    ".lora_up.weight": "up",
+    ".lora.down.weight": "down",
+    ".lora.up.weight": "up",
+    "_lora.down.weight": "down",
+    "_lora.up.weight": "up",
+    ".alpha": "alpha"
+}
+LORA_PREFIXES = ["base_model.model.", "unet.", "transformer.", "lora_unet_", "lora_transformer_"]
+
+
+def parse_lora(lora_path: Path, weight_names: set):
+    # Returns {weight_name: {"down", "up", "alpha"}} for diffusers, PEFT and kohya key formats
+    underscore_names = {name[:-len(".weight")].replace(".", "_"): name for name in weight_names if name.endswith(".weight")}
+    modules = {}
+    unmatched = []
+    for key, tensor in load_safetensors(lora_path).items():
+        suffix = next((suffix for suffix in LORA_SUFFIXES if key.endswith(suffix)), None)
+        if suffix is None:
+            continue
+
+        module = key[:-len(suffix)]
+        for prefix in LORA_PREFIXES:
+            if module.startswith(prefix):
+                module = module[len(prefix):]
+        module = module.replace(".processor.", ".")
+
+        weight_name = f"{module}.weight"
+        if weight_name not in weight_names and f"{module}.0.weight" in weight_names:
+            weight_name = f"{module}.0.weight"
+        if weight_name not in weight_names:
+            weight_name = underscore_names.get(module.replace(".", "_"))
+        if weight_name is None:
+            unmatched.append(key)
+            continue
+        modules.setdefault(weight_name, {})[LORA_SUFFIXES[suffix]] = tensor
+
+    if unmatched:
+        print(f"{lora_path.name}: {len(unmatched)} keys do not match the model, e.g. {unmatched[:3]}")
+    return {name: parts for name, parts in modules.items() if "down" in parts and "up" in parts}
+
+
+def lora_delta(parts, scale: float, shape):
+    # W' = W + scale * (alpha / rank) * up @ down
+    up = np.asarray(parts["up"], dtype=np.float32)
+    down = np.asarray(parts["down"], dtype=np.float32)
+    rank = down.shape[0]
+    alpha = float(np.asarray(parts["alpha"]).reshape(-1)[0]) if "alpha" in parts else rank
+    delta = up.reshape(up.shape[0], rank) @ down.reshape(rank, -1)
+    return (delta * (scale * alpha / rank)).reshape(shape)
+
+
+def merge_initializer(base: np.ndarray, mapping, deltas: dict):
+    merged = base.astype(np.float32)
+    if mapping["type"] == "tensor":
+        source_name, transform = mapping["candidates"][0]
+        merged += apply_transform(deltas[source_name], transform, merged.shape, np.float32)
+    else:
+        columns = {}
+        for column, candidates in enumerate(mapping["columns"]):
+            if candidates:
+                source_name, row = candidates[0]
+                columns.setdefault(source_name, []).append((column, row))
+        for source_name, indices in columns.items():
+            column, row = np.array(indices).T
+            merged[:, column] += deltas[source_name][row].T
+    return cast(merged, base.dtype)
+
+
+def merge(model_input: Path, model_weights: Path, loras: list, model_output: Path, workers: int):
+    model_input = Path(model_input)
+    model_output = Path(model_output)
+    weights = load_safetensors(model_weights)
+
+    # Sum every LoRA per target weight
+    deltas = {}
+    for lora_path, scale in loras:
+        modules = parse_lora(Path(lora_path), set(weights.keys()))
+        print(f"{Path(lora_path).name}: {len(modules)} weights, scale {scale}")
+        for weight_name, parts in modules.items():
+            delta = lora_delta(parts, scale, weights[weight_name].shape)
+            deltas[weight_name] = deltas[weight_name] + delta if weight_name in deltas else delta
+
+    weight_map = create_weight_map(model_input, model_weights, set(deltas.keys()))
+    targets = {}
+    for name, mapping in weight_map.items():
+        if mapping["type"] == "tensor" and len(mapping["candidates"]) > 1:
+            print(f"Skipping {name}, initializer is shared by {[c[0] for c in mapping['candidates']]}")
+            continue
+        targets[name] = mapping
+
+    located = set()
+    for mapping in targets.values():
+        candidates = mapping["candidates"] if mapping["type"] == "tensor" else [column[0] for column in mapping["columns"] if column]
+        located.update(candidate[0] for candidate in candidates)
+    missing = [name for name in deltas if name not in located]
+    if missing:
+        print(f"{len(missing)} LoRA weights could not be located in the graph, e.g. {missing[:3]}")
+
+    initializers = load_initializers(model_input)
+    model_output.mkdir(parents=True, exist_ok=True)
+    output_path = model_output / model_input.name
+    model = onnx.load(model_input, load_external_data=False)
+    tensors = {tensor.name: tensor for tensor in model.graph.initializer}
+    external = any(tensor.data_location == TensorProto.EXTERNAL for tensor in tensors.values())
+
+    data_files = {}
+    if external:
+        shutil.copy(model_input, output_path)
+        for tensor in tensors.values():
+            if tensor.data_location != TensorProto.EXTERNAL:
+                continue
+            location = next(entry.value for entry in tensor.external_data if entry.key == "location")
+            if location not in data_files:
+                shutil.copy(model_input.parent / location, model_output / location)
+                data_files[location] = np.memmap(model_output / location, dtype=np.uint8, mode="r+")
+
+    def merge_tensor(name):
+        value = merge_initializer(initializers[name][1], targets[name], deltas)
+        tensor = tensors[name]
+        if tensor.data_location == TensorProto.EXTERNAL:
+            info = {entry.key: entry.value for entry in tensor.external_data}
+            offset = int(info.get("offset", 0))
+            data_files[info["location"]][offset:offset + int(info["length"])] = value.view(np.uint8).reshape(-1)
+        else:
+            tensor.CopyFrom(numpy_helper.from_array(value, name))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(merge_tensor, targets.keys()))
+
+    for data_file in data_files.values():
+        data_file.flush()
+    if not external:
+        onnx.save(model, output_path)
+
+    print(f"Merged {len(targets)} initializers")
+    return output_path
+
+
+def parse_lora_args(lora_arg: str):
+    loras = []
+    for lora in lora_arg.split(","):
+        path, _, scale = lora.rpartition(":")
+        try:
+            loras.append((path, float(scale)))
+        except ValueError:
+            loras.append((lora, 1.0))
+    return loras
+
+
+def parse_common_args(raw_args):
+    parser = argparse.ArgumentParser("Common arguments")
+    parser.add_argument("--input", required=True, type=Path, help="Converted unet/transformer model.onnx")
+    parser.add_argument("--weights", required=True, type=Path, help="Diffusers unet/transformer folder the model was converted from")
+    parser.add_argument("--lora", required=True, type=str, help="Comma separated LoRA files and scales (file:scale)")
+    parser.add_argument("--output", required=True, type=Path)
+    parser.add_argument("--workers", default=8, type=int, help="Number of initializers merged in parallel")
+    return parser.parse_known_args(raw_args)
+
+
+def main(raw_args=None):
+    common_args, extra_args = parse_common_args(raw_args)
+    loras = parse_lora_args(common_args.lora)
+
+    print('LoRA Merge')
+    print('--------------------------------------')
+    print(f'Input: {common_args.input}')
+    print(f'Weights: {common_args.weights}')
+    print(f'LoRA: {loras}')
+    print(f'Output: {common_args.output}')
+    print('--------------------------------------')
+
+    merge(common_args.input, common_args.weights, loras, common_args.output, common_args.workers)
+
+    print('LoRA Merge Complete.')
+
+
+if __name__ == "__main__":
+    main()
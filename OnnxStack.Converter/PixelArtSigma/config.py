@@ -2,4 +2,8 @@ vae_sample_size = 1024
 unet_channels = 4
 unet_sample_size = 128
 text_length = 4096
-text_max_sequence = 300
\ No newline at end of file
+text_max_sequence = 300
+guided = False
+context_kv = False
+cross_attention_layers = 28 # cross-attention layers in the transformer, one key_<n>/value_<n> input pair each with context_kv
+cross_attention_dims = [] # key/value dims per layer, recorded when the transformer is loaded
@@ -5,6 +5,7 @@ import shutil
 import sys
 import warnings
 from pathlib import Path
+import config
 
 from packaging import version
 import onnx
@@ -13,6 +14,7 @@ from onnxruntime_extensions import make_onnx_model
 from olive.common.utils import set_tempdir
 from olive.workflows import run as olive_run
 from olive.model import ONNXModelHandler
+from ioManifest import save_io_manifest
 
 
 def optimize(
@@ -47,6 +49,14 @@ def optimize(
             olive_config = json.load(fin)
 
         olive_config["input_model"]["config"]["model_path"] = model_dir
+        if submodel_name == "unet" and config.guided:
+            olive_config["input_model"]["config"]["io_config"]["input_names"].append("guidance_scale")
+            # [uncond, cond] embeddings are twice the latent batch
+            dynamic_axes = olive_config["input_model"]["config"]["io_config"]["dynamic_axes"]
+            dynamic_axes["encoder_hidden_states"]["0"] = "guided_batch"
+            dynamic_axes["encoder_attention_mask"]["0"] = "guided_batch"
+        if submodel_name == "context_projection" or (submodel_name == "unet" and config.context_kv):
+            context_kv_config(olive_config, submodel_name)
         run_res = olive_run(olive_config)
         save_onnx_submodel(script_dir, submodel_name, model_info, provider)
 
@@ -54,6 +64,21 @@ def optimize(
     return model_info
 
 
+def context_kv_config(olive_config, submodel_name: str):
+    # key_<n>/value_<n> per cross-attention layer: context_projection outputs, unet inputs in place of encoder_hidden_states
+    io_config = olive_config["input_model"]["config"]["io_config"]
+    names = [f"{kind}_{index}" for index in range(config.cross_attention_layers) for kind in ("key", "value")]
+    dynamic_axes = io_config["dynamic_axes"]
+    for name in names:
+        dynamic_axes[name] = {axis: dynamic_axes["encoder_hidden_states"][axis] for axis in ("0", "1")}
+    if submodel_name == "context_projection":
+        io_config["output_names"] = names
+        return
+    index = io_config["input_names"].index("encoder_hidden_states")
+    io_config["input_names"][index:index + 1] = names
+    dynamic_axes.pop("encoder_hidden_states")
+
+
 def save_onnx_Models(model_dir, model_info, model_output, submodel_names):
     model_dir = Path(model_dir)
     for conversion_type in ["optimized", "unoptimized"]:
@@ -189,6 +214,8 @@ def parse_common_args(raw_args):
     parser.add_argument("--clean", action="store_true", help="Deletes the Olive cache")
     parser.add_argument("--tempdir", default=None, type=str, help="Root directory for tempfile directories and files")
     parser.add_argument("--only_unet", action="store_true", help="Only convert UNET model")
+    parser.add_argument("--guided", action="store_true", help="Export the unet with classifier-free guidance fused (guidance_scale input)")
+    parser.add_argument("--context_kv", action="store_true", help="Export the unet with key_<n>/value_<n> cross-attention inputs, precomputed once per prompt by the context_projection model")
     
     return parser.parse_known_args(raw_args)
 
@@ -200,6 +227,8 @@ def main(raw_args=None):
     model_input = common_args.model_input
     model_output = common_args.model_output
     script_dir = Path(__file__).resolve().parent
+    config.guided = common_args.guided
+    config.context_kv = common_args.context_kv
 
     if model_output is None:
         model_output = Path(model_input) / "_onnx"
@@ -220,9 +249,13 @@ def main(raw_args=None):
     if common_args.only_unet:
         submodel_names = ["unet"]
 
+    if config.context_kv:
+        submodel_names.insert(submodel_names.index("unet"), "context_projection")
+
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
         optimize(script_dir, common_args.model_input, model_output, provider, submodel_names)
+    save_io_manifest(model_output)
 
 
 if __name__ == "__main__":
@@ -2,6 +2,7 @@ import config
 import torch
 from typing import Union, Tuple
 from diffusers import AutoencoderKL, PixArtTransformer2DModel
+from diffusers.models.attention_processor import Attention
 from transformers import T5EncoderModel
 
 # Helper latency-only dataloader that creates random tensors with no label
@@ -111,6 +112,26 @@ class WrappedPixArtTransformer2DModel(PixArtTransformer2DModel):
         )
 
 
+class GuidedPixArtTransformer2DModel(WrappedPixArtTransformer2DModel):
+    def forward(
+        self,
+        hidden_states: torch.FloatTensor, 
+        encoder_hidden_states: torch.FloatTensor,
+        encoder_attention_mask: torch.FloatTensor,
+        timestep: torch.LongTensor,
+        guidance_scale: torch.FloatTensor
+    ) -> torch.FloatTensor:
+        # encoder_hidden_states and encoder_attention_mask are [uncond, cond], returns uncond + guidance_scale * (cond - uncond)
+        noise_pred = super().forward(
+            hidden_states = torch.cat([hidden_states] * 2),
+            encoder_hidden_states = encoder_hidden_states,
+            encoder_attention_mask = encoder_attention_mask,
+            timestep = torch.cat([timestep] * 2)
+        )[0]
+        noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
+        return noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
+
+
 def unet_inputs(batchsize, torch_dtype, is_conversion_inputs=False):
     inputs = {
         "hidden_states": torch.rand((batchsize, config.unet_channels, config.unet_sample_size, config.unet_sample_size), dtype=torch_dtype),
@@ -118,11 +139,20 @@ def unet_inputs(batchsize, torch_dtype, is_conversion_inputs=False):
         "encoder_attention_mask": torch.rand((batchsize, config.text_max_sequence), dtype=torch_dtype),
         "timestep": torch.rand((batchsize), dtype=torch_dtype)
     }
+    if config.guided:
+        inputs["encoder_hidden_states"] = torch.rand((batchsize * 2, config.text_max_sequence, config.text_length), dtype=torch_dtype)
+        inputs["encoder_attention_mask"] = torch.rand((batchsize * 2, config.text_max_sequence), dtype=torch_dtype)
+        inputs["guidance_scale"] = torch.tensor([4.5], dtype=torch_dtype)
+    if config.context_kv:
+        inputs = context_kv_inputs(inputs)
     return inputs
 
 
 def unet_load(model_name):
-    model = WrappedPixArtTransformer2DModel.from_pretrained(model_name, subfolder="transformer")
+    model_class = GuidedPixArtTransformer2DModel if config.guided else WrappedPixArtTransformer2DModel
+    model = model_class.from_pretrained(model_name, subfolder="transformer")
+    if config.context_kv:
+        context_kv_load(model)
     return model
 
 
@@ -131,4 +161,117 @@ def unet_conversion_inputs(model=None):
 
 
 def unet_data_loader(data_dir, batchsize, *args, **kwargs):
-    return RandomDataLoader(unet_inputs, batchsize, torch.float16)
\ No newline at end of file
+    return RandomDataLoader(unet_inputs, batchsize, torch.float16)
+
+
+
+# -----------------------------------------------------------------------------
+# CONTEXT PROJECTION
+# -----------------------------------------------------------------------------
+class ContextAttnProcessor:
+    # AttnProcessor2_0 for cross-attention, key/value are the precomputed context_projection outputs
+    def __init__(self):
+        self.key = None
+        self.value = None
+
+    def __call__(self, attn, hidden_states, encoder_hidden_states=None, attention_mask=None, temb=None, *args, **kwargs):
+        residual = hidden_states
+        input_ndim = hidden_states.ndim
+        if input_ndim == 4:
+            batch_size, channel, height, width = hidden_states.shape
+            hidden_states = hidden_states.view(batch_size, channel, height * width).transpose(1, 2)
+
+        batch_size = hidden_states.shape[0]
+        if attention_mask is not None:
+            attention_mask = attn.prepare_attention_mask(attention_mask, self.key.shape[1], batch_size)
+            attention_mask = attention_mask.view(batch_size, attn.heads, -1, attention_mask.shape[-1])
+
+        query = attn.to_q(hidden_states)
+        head_dim = query.shape[-1] // attn.heads
+        query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        key = self.key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        value = self.value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+
+        hidden_states = torch.nn.functional.scaled_dot_product_attention(query, key, value, attn_mask=attention_mask, dropout_p=0.0, is_causal=False)
+        hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim).to(query.dtype)
+        hidden_states = attn.to_out[0](hidden_states)
+        hidden_states = attn.to_out[1](hidden_states)
+
+        if input_ndim == 4:
+            hidden_states = hidden_states.transpose(-1, -2).reshape(batch_size, channel, height, width)
+        if attn.residual_connection:
+            hidden_states = hidden_states + residual
+        return hidden_states / attn.rescale_output_factor
+
+
+def cross_attention_modules(model):
+    modules = [module for module in model.modules() if isinstance(module, Attention) and module.is_cross_attention]
+    if len(modules) != config.cross_attention_layers:
+        raise ValueError(f"config.cross_attention_layers is {config.cross_attention_layers}, the transformer has {len(modules)} cross-attention layers")
+    return modules
+
+
+class ContextProjection(torch.nn.Module):
+    # caption_projection and the key/value projections of every cross-attention layer, computed once per prompt instead of every step
+    def __init__(self, transformer):
+        super().__init__()
+        self.caption_projection = transformer.caption_projection
+        self.attentions = torch.nn.ModuleList(cross_attention_modules(transformer))
+
+    def forward(self, encoder_hidden_states):
+        encoder_hidden_states = self.caption_projection(encoder_hidden_states)
+        outputs = []
+        for attention in self.attentions:
+            outputs += [attention.to_k(encoder_hidden_states), attention.to_v(encoder_hidden_states)]
+        return tuple(outputs)
+
+
+def context_kv_load(transformer):
+    # encoder_hidden_states input replaced by key_<n>/value_<n> per cross-attention layer, weight names are unchanged
+    attentions = cross_attention_modules(transformer)
+    processors = [ContextAttnProcessor() for attention in attentions]
+    for attention, processor in zip(attentions, processors):
+        attention.set_processor(processor)
+    config.cross_attention_dims = [attention.to_k.out_features for attention in attentions]
+    forward = transformer.forward
+
+    def context_kv_forward(hidden_states, *args):
+        cross_attention_kv, args = args[:len(processors) * 2], args[len(processors) * 2:]
+        for processor, key, value in zip(processors, cross_attention_kv[0::2], cross_attention_kv[1::2]):
+            processor.key, processor.value = key, value
+        # Placeholder, the cross-attention layers are the only encoder_hidden_states consumers
+        encoder_hidden_states = torch.zeros((cross_attention_kv[0].shape[0], 1, config.text_length), dtype=hidden_states.dtype)
+        return forward(hidden_states, encoder_hidden_states, *args)
+    transformer.forward = context_kv_forward
+
+
+def context_kv_inputs(inputs):
+    # encoder_hidden_states [batch, sequence, text_length] -> key_<n>/value_<n> [batch, sequence, dim] at the same position
+    context_inputs = {}
+    for name, value in inputs.items():
+        if name != "encoder_hidden_states":
+            context_inputs[name] = value
+            continue
+        for index, dim in enumerate(config.cross_attention_dims):
+            context_inputs[f"key_{index}"] = torch.rand((*value.shape[:2], dim), dtype=value.dtype)
+            context_inputs[f"value_{index}"] = torch.rand((*value.shape[:2], dim), dtype=value.dtype)
+    return context_inputs
+
+
+def context_projection_inputs(batchsize, torch_dtype):
+    return {
+        "encoder_hidden_states": torch.rand((batchsize, config.text_max_sequence, config.text_length), dtype=torch_dtype)
+    }
+
+
+def context_projection_load(model_name):
+    model = PixArtTransformer2DModel.from_pretrained(model_name, subfolder="transformer")
+    return ContextProjection(model)
+
+
+def context_projection_conversion_inputs(model=None):
+    return tuple(context_projection_inputs(1, torch.float32).values())
+
+
+def context_projection_data_loader(data_dir, batchsize, *args, **kwargs):
+    return RandomDataLoader(context_projection_inputs, batchsize, torch.float16)
\ No newline at end of file
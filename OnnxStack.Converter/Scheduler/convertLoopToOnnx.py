@@ -0,0 +1,193 @@
+import argparse
+import numpy as np
+import onnx
+from pathlib import Path
+from onnx import helper, numpy_helper, TensorProto
+from convertSchedulerToOnnx import StepGraph, build_step, tensor_dims, COEFFICIENTS
+
+
+SCHEDULES = ["lcm", "euler_trailing", "flow_match"]
+SCHEDULE_STEPS = {"lcm": "lcm", "euler_trailing": "euler", "flow_match": "flow_match"}
+
+
+def alphas_cumprod(beta_schedule: str, beta_start: float, beta_end: float, train_steps: int = 1000):
+    if beta_schedule == "scaled_linear":
+        betas = np.linspace(beta_start ** 0.5, beta_end ** 0.5, train_steps, dtype=np.float64) ** 2
+    else:
+        betas = np.linspace(beta_start, beta_end, train_steps, dtype=np.float64)
+    return np.cumprod(1.0 - betas)
+
+
+def lcm_schedule(steps: int, beta_schedule: str, beta_start: float, beta_end: float, original_steps: int = 50):
+    # LCMScheduler: skipped origin timesteps, boundary condition scalings with timestep_scaling 10
+    alphas = alphas_cumprod(beta_schedule, beta_start, beta_end)
+    origin_timesteps = np.arange(1, original_steps + 1) * (1000 // original_steps) - 1
+    indices = np.floor(np.linspace(0, len(origin_timesteps), num=steps, endpoint=False)).astype(np.int64)
+    timesteps = origin_timesteps[::-1][indices]
+    scaled_timesteps = timesteps * 10.0
+    alpha_prod_t_prev = np.append(alphas[timesteps[1:]], 1.0)
+    return {
+        "timestep": timesteps.astype(np.float64),
+        "alpha_prod_t": alphas[timesteps],
+        "alpha_prod_t_prev": alpha_prod_t_prev,
+        "c_skip": 0.25 / (scaled_timesteps ** 2 + 0.25),
+        "c_out": scaled_timesteps / np.sqrt(scaled_timesteps ** 2 + 0.25)
+    }
+
+
+def euler_trailing_schedule(steps: int, beta_schedule: str, beta_start: float, beta_end: float):
+    # EulerDiscreteScheduler, timestep_spacing = "trailing" (AnimateDiff-Lightning, SDXL-Lightning)
+    alphas = alphas_cumprod(beta_schedule, beta_start, beta_end)
+    timesteps = (np.round(np.arange(1000, 0, -1000 / steps)) - 1).astype(np.int64)
+    sigmas = np.sqrt((1 - alphas[timesteps]) / alphas[timesteps])
+    return {
+        "timestep": timesteps.astype(np.float64),
+        "sigma": sigmas,
+        "sigma_next": np.append(sigmas[1:], 0.0)
+    }
+
+
+def flow_match_schedule(steps: int, shift: float):
+    # FlowMatchEulerDiscreteScheduler, Flux transformers take the sigma as timestep
+    sigmas = np.linspace(1.0, 1.0 / steps, steps, dtype=np.float64)
+    sigmas = shift * sigmas / (1 + (shift - 1) * sigmas)
+    return {
+        "timestep": sigmas,
+        "sigma": sigmas,
+        "sigma_next": np.append(sigmas[1:], 0.0)
+    }
+
+
+def create_schedule(schedule: str, steps: int, beta_schedule: str, beta_start: float, beta_end: float, shift: float):
+    if schedule == "lcm":
+        return lcm_schedule(steps, beta_schedule, beta_start, beta_end)
+    if schedule == "euler_trailing":
+        return euler_trailing_schedule(steps, beta_schedule, beta_start, beta_end)
+    if schedule == "flow_match":
+        return flow_match_schedule(steps, shift)
+    raise ValueError(f"Unknown schedule {schedule}, expected one of {SCHEDULES}")
+
+
+def create_loop_model(denoiser_path: Path, schedule: str, tables: dict, prediction_type: str):
+    # denoiser + step as the body of an ONNX Loop over the timestep table, one session.run per generation
+    model = onnx.load(denoiser_path, load_external_data=False)
+    graph = model.graph
+    scheduler = SCHEDULE_STEPS[schedule]
+    steps = len(tables["timestep"])
+    graph_inputs = {value.name: value for value in graph.input}
+    latent_name = "sample" if "sample" in graph_inputs else "hidden_states"
+    latent_type = graph_inputs[latent_name].type.tensor_type.elem_type
+    latent_dims = tensor_dims(graph_inputs[latent_name])
+    timestep_type = graph_inputs["timestep"].type.tensor_type.elem_type
+    output_name = graph.output[0].name
+
+    body = StepGraph("loop")
+    body_latents = "loop_latents"
+    initializers = []
+
+    def table(name, values, dtype):
+        table_name = f"loop_{name}_table"
+        initializers.append(numpy_helper.from_array(values.astype(helper.tensor_dtype_to_np_dtype(dtype)), table_name))
+        return body.op("Reshape", body.op("Gather", table_name, "loop_iteration"), "loop_shape")
+
+    initializers.append(numpy_helper.from_array(np.array([1], dtype=np.int64), "loop_shape"))
+    renames = {"timestep": table("timestep", tables["timestep"], timestep_type)}
+    for name in COEFFICIENTS[scheduler]:
+        if name == "noise":
+            # Host noise for every step: [steps, *latent_shape]
+            renames[name] = body.op("Gather", "noise", "loop_iteration")
+        else:
+            renames[name] = table(name, tables[name], latent_type)
+
+    denoiser_latents = body_latents
+    if scheduler == "euler":
+        sigma_sq_plus_one = body.op("Add", body.op("Mul", renames["sigma"], renames["sigma"]), body.const(1.0, latent_type))
+        denoiser_latents = body.op("Div", body_latents, body.op("Sqrt", sigma_sq_plus_one))
+
+    denoiser_nodes = list(graph.node)
+    for node in denoiser_nodes:
+        for index, input_name in enumerate(node.input):
+            if input_name == latent_name:
+                node.input[index] = denoiser_latents
+            elif input_name == "timestep":
+                node.input[index] = renames["timestep"]
+
+    step = StepGraph(f"{scheduler}_step")
+    build_step(step, scheduler, prediction_type, latent_type)
+    renames.update({"sample": body_latents, "model_output": output_name, "prev_sample": "loop_prev_sample", "denoised": "loop_denoised"})
+    for node in step.nodes:
+        node.input[:] = [renames.get(input, input) for input in node.input]
+        node.output[:] = [renames.get(output, output) for output in node.output]
+    condition = helper.make_node("Identity", ["loop_condition"], ["loop_condition_out"], name="loop_condition")
+
+    body_graph = helper.make_graph(
+        body.nodes + denoiser_nodes + step.nodes + [condition],
+        "loop_body",
+        [
+            helper.make_tensor_value_info("loop_iteration", TensorProto.INT64, []),
+            helper.make_tensor_value_info("loop_condition", TensorProto.BOOL, []),
+            helper.make_tensor_value_info(body_latents, latent_type, latent_dims)
+        ],
+        [
+            helper.make_tensor_value_info("loop_condition_out", TensorProto.BOOL, []),
+            helper.make_tensor_value_info("loop_prev_sample", latent_type, latent_dims)
+        ],
+        body.initializers + step.initializers,
+        value_info=list(graph.value_info)
+    )
+
+    loop = helper.make_node("Loop", ["loop_steps", "loop_true", latent_name], ["latents"], name="loop", body=body_graph)
+    del graph.node[:]
+    graph.node.append(loop)
+    del graph.value_info[:]
+    graph.initializer.extend(initializers)
+    graph.initializer.extend([
+        numpy_helper.from_array(np.array(steps, dtype=np.int64), "loop_steps"),
+        numpy_helper.from_array(np.array(True), "loop_true")
+    ])
+
+    inputs = [value for value in graph.input if value.name != "timestep"]
+    if "noise" in COEFFICIENTS[scheduler]:
+        inputs.append(helper.make_tensor_value_info("noise", latent_type, [steps] + latent_dims))
+    del graph.input[:]
+    graph.input.extend(inputs)
+    del graph.output[:]
+    graph.output.append(helper.make_tensor_value_info("latents", latent_type, latent_dims))
+    return model
+
+
+def parse_common_args(raw_args):
+    parser = argparse.ArgumentParser("Common arguments")
+    parser.add_argument("--denoiser", required=True, type=Path, help="Converted unet/transformer model.onnx")
+    parser.add_argument("--schedule", required=True, choices=SCHEDULES, help="lcm: Locomotion_LCM, euler_trailing: AnimateDiff-Lightning, flow_match: FluxSchnell")
+    parser.add_argument("--steps", default=4, type=int, help="Inference steps baked into the loop")
+    parser.add_argument("--prediction_type", default="epsilon", choices=["epsilon", "v_prediction"])
+    parser.add_argument("--beta_schedule", default="scaled_linear", choices=["scaled_linear", "linear"], help="lcm/euler_trailing beta schedule (AnimateDiff-Lightning uses linear)")
+    parser.add_argument("--beta_start", default=0.00085, type=float)
+    parser.add_argument("--beta_end", default=0.012, type=float)
+    parser.add_argument("--shift", default=1.0, type=float, help="flow_match sigma shift")
+    parser.add_argument("--output", default=None, type=Path, help="Output model, default model_loop.onnx next to the denoiser (shares model.onnx.data)")
+    return parser.parse_known_args(raw_args)
+
+
+def main(raw_args=None):
+    common_args, extra_args = parse_common_args(raw_args)
+    model_output = common_args.output or common_args.denoiser.parent / "model_loop.onnx"
+
+    print('Denoise Loop Conversion')
+    print('--------------------------------------')
+    print(f'Denoiser: {common_args.denoiser}')
+    print(f'Schedule: {common_args.schedule}')
+    print(f'Steps: {common_args.steps}')
+    print(f'Output: {model_output}')
+    print('--------------------------------------')
+
+    tables = create_schedule(common_args.schedule, common_args.steps, common_args.beta_schedule, common_args.beta_start, common_args.beta_end, common_args.shift)
+    print(f"Timesteps: {tables['timestep'].round(4).tolist()}")
+    onnx.save(create_loop_model(common_args.denoiser, common_args.schedule, tables, common_args.prediction_type), model_output)
+
+    print('Denoise Loop Conversion Complete.')
+
+
+if __name__ == "__main__":
+    main()
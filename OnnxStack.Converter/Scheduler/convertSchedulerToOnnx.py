@@ -0,0 +1,209 @@
+import argparse
+import onnx
+from pathlib import Path
+from onnx import helper, TensorProto
+
+
+SCHEDULERS = ["euler", "ddim", "lcm", "flow_match"]
+COEFFICIENTS = {
+    "euler": ["sigma", "sigma_next"],
+    "ddim": ["alpha_prod_t", "alpha_prod_t_prev"],
+    "lcm": ["alpha_prod_t", "alpha_prod_t_prev", "c_skip", "c_out", "noise"],
+    "flow_match": ["sigma", "sigma_next"]
+}
+OUTPUTS = {
+    "euler": ["prev_sample"],
+    "ddim": ["prev_sample"],
+    "lcm": ["prev_sample", "denoised"],
+    "flow_match": ["prev_sample"]
+}
+LATENT_DIMS = "batch,channels,height,width"
+
+
+class StepGraph:
+    # Minimal node builder, every intermediate gets a unique <prefix>_<n> name
+    def __init__(self, prefix="step"):
+        self.prefix = prefix
+        self.nodes = []
+        self.initializers = []
+
+    def op(self, op_type, *inputs, output=None):
+        output = output or f"{self.prefix}_{len(self.nodes)}"
+        self.nodes.append(helper.make_node(op_type, list(inputs), [output], name=f"{self.prefix}_{len(self.nodes)}"))
+        return output
+
+    def const(self, value, dtype):
+        name = f"{self.prefix}_const_{len(self.initializers)}"
+        self.initializers.append(helper.make_tensor(name, dtype, [], [value]))
+        return name
+
+    def sqrt_one_minus(self, value, dtype):
+        return self.op("Sqrt", self.op("Sub", self.const(1.0, dtype), value))
+
+    def identity(self, value, output):
+        self.op("Identity", value, output=output)
+
+
+def tensor_dims(value):
+    # Symbolic shape of a graph input/output, unnamed dynamic axes get a <name>_<axis> name
+    dims = value.type.tensor_type.shape.dim
+    return [dim.dim_param or (dim.dim_value if dim.HasField("dim_value") else f"{value.name}_{axis}") for axis, dim in enumerate(dims)]
+
+
+def predict_original(graph: StepGraph, sample, model_output, alpha_prod_t, prediction_type, dtype):
+    # x0 and epsilon from the model prediction at alpha_prod_t
+    sqrt_alpha = graph.op("Sqrt", alpha_prod_t)
+    sqrt_one_minus_alpha = graph.sqrt_one_minus(alpha_prod_t, dtype)
+    if prediction_type == "v_prediction":
+        pred_original = graph.op("Sub", graph.op("Mul", sqrt_alpha, sample), graph.op("Mul", sqrt_one_minus_alpha, model_output))
+        pred_epsilon = graph.op("Add", graph.op("Mul", sqrt_alpha, model_output), graph.op("Mul", sqrt_one_minus_alpha, sample))
+    else:
+        pred_original = graph.op("Div", graph.op("Sub", sample, graph.op("Mul", sqrt_one_minus_alpha, model_output)), sqrt_alpha)
+        pred_epsilon = model_output
+    return pred_original, pred_epsilon
+
+
+def build_step(graph: StepGraph, scheduler: str, prediction_type: str, dtype):
+    # Appends the step nodes, inputs: sample, model_output + COEFFICIENTS, outputs: OUTPUTS
+    sample, model_output = "sample", "model_output"
+    if scheduler == "euler":
+        # x + (sigma_next - sigma) * (x - denoised) / sigma
+        sigma, sigma_next = COEFFICIENTS[scheduler]
+        if prediction_type == "v_prediction":
+            sigma_sq_plus_one = graph.op("Add", graph.op("Mul", sigma, sigma), graph.const(1.0, dtype))
+            denoised = graph.op("Add",
+                graph.op("Mul", model_output, graph.op("Neg", graph.op("Div", sigma, graph.op("Sqrt", sigma_sq_plus_one)))),
+                graph.op("Div", sample, sigma_sq_plus_one))
+            derivative = graph.op("Div", graph.op("Sub", sample, denoised), sigma)
+        else:
+            derivative = model_output
+        graph.identity(graph.op("Add", sample, graph.op("Mul", graph.op("Sub", sigma_next, sigma), derivative)), "prev_sample")
+
+    elif scheduler == "flow_match":
+        # x + (sigma_next - sigma) * velocity
+        sigma, sigma_next = COEFFICIENTS[scheduler]
+        graph.identity(graph.op("Add", sample, graph.op("Mul", graph.op("Sub", sigma_next, sigma), model_output)), "prev_sample")
+
+    elif scheduler == "ddim":
+        # Deterministic DDIM (eta = 0)
+        alpha_prod_t, alpha_prod_t_prev = COEFFICIENTS[scheduler]
+        pred_original, pred_epsilon = predict_original(graph, sample, model_output, alpha_prod_t, prediction_type, dtype)
+        graph.identity(graph.op("Add",
+            graph.op("Mul", graph.op("Sqrt", alpha_prod_t_prev), pred_original),
+            graph.op("Mul", graph.sqrt_one_minus(alpha_prod_t_prev, dtype), pred_epsilon)), "prev_sample")
+
+    elif scheduler == "lcm":
+        # Consistency step, alpha_prod_t_prev = 1 on the final step returns denoised
+        alpha_prod_t, alpha_prod_t_prev, c_skip, c_out, noise = COEFFICIENTS[scheduler]
+        pred_original, _ = predict_original(graph, sample, model_output, alpha_prod_t, prediction_type, dtype)
+        denoised = graph.op("Add", graph.op("Mul", c_out, pred_original), graph.op("Mul", c_skip, sample))
+        graph.identity(denoised, "denoised")
+        graph.identity(graph.op("Add",
+            graph.op("Mul", graph.op("Sqrt", alpha_prod_t_prev), denoised),
+            graph.op("Mul", graph.sqrt_one_minus(alpha_prod_t_prev, dtype), noise)), "prev_sample")
+
+    else:
+        raise ValueError(f"Unknown scheduler {scheduler}, expected one of {SCHEDULERS}")
+
+
+def create_step_model(scheduler: str, prediction_type: str, dtype, opset: int, latent_dims: list):
+    # sample, model_output, noise and the outputs share the latent shape, the other coefficients are [1]
+    graph = StepGraph()
+    build_step(graph, scheduler, prediction_type, dtype)
+    inputs = [helper.make_tensor_value_info(name, dtype, latent_dims) for name in ["sample", "model_output"]]
+    inputs += [helper.make_tensor_value_info(name, dtype, latent_dims if name == "noise" else [1]) for name in COEFFICIENTS[scheduler]]
+    outputs = [helper.make_tensor_value_info(name, dtype, latent_dims) for name in OUTPUTS[scheduler]]
+    opset_imports = [helper.make_opsetid("", opset)]
+    return helper.make_model(
+        helper.make_graph(graph.nodes, f"{scheduler}_step", inputs, outputs, graph.initializers),
+        opset_imports=opset_imports,
+        ir_version=helper.find_min_ir_version_for(opset_imports)
+    )
+
+
+def create_denoiser_step_model(denoiser_path: Path, scheduler: str, prediction_type: str):
+    # denoiser + step in one graph: the latent input is shared, the first denoiser output is the model_output
+    model = onnx.load(denoiser_path, load_external_data=False)
+    graph_inputs = [value.name for value in model.graph.input]
+    latent_name = "sample" if "sample" in graph_inputs else "hidden_states"
+    latent = next(value for value in model.graph.input if value.name == latent_name)
+    output_name = model.graph.output[0].name
+    dtype = latent.type.tensor_type.elem_type
+    latent_dims = tensor_dims(latent)
+
+    step = StepGraph(f"{scheduler}_step")
+    build_step(step, scheduler, prediction_type, dtype)
+    renames = {"sample": latent_name, "model_output": output_name}
+    for name in COEFFICIENTS[scheduler]:
+        if name in graph_inputs:
+            raise ValueError(f"{denoiser_path} already has an input named {name}")
+
+    if scheduler == "euler":
+        # Karras input scaling: the denoiser sees sample / sqrt(sigma^2 + 1)
+        scaled_name = f"{latent_name}_scaled"
+        for node in model.graph.node:
+            for index, input_name in enumerate(node.input):
+                if input_name == latent_name:
+                    node.input[index] = scaled_name
+        scale = StepGraph("scale")
+        sigma_sq_plus_one = scale.op("Add", scale.op("Mul", "sigma", "sigma"), scale.const(1.0, dtype))
+        scale.op("Div", latent_name, scale.op("Sqrt", sigma_sq_plus_one), output=scaled_name)
+        nodes = scale.nodes + list(model.graph.node)
+        del model.graph.node[:]
+        model.graph.node.extend(nodes)
+        model.graph.initializer.extend(scale.initializers)
+
+    for node in step.nodes:
+        node.input[:] = [renames.get(input, input) for input in node.input]
+    model.graph.node.extend(step.nodes)
+    model.graph.initializer.extend(step.initializers)
+    model.graph.input.extend([helper.make_tensor_value_info(name, dtype, latent_dims if name == "noise" else [1]) for name in COEFFICIENTS[scheduler]])
+    del model.graph.output[:]
+    model.graph.output.extend([helper.make_tensor_value_info(name, dtype, latent_dims) for name in OUTPUTS[scheduler]])
+    return model
+
+
+def parse_common_args(raw_args):
+    parser = argparse.ArgumentParser("Common arguments")
+    parser.add_argument("--output", required=True, type=Path, help="Output folder, step graphs are saved as <scheduler>/model.onnx")
+    parser.add_argument("--schedulers", default=",".join(SCHEDULERS), type=str, help="The scheduler steps to export `euler,ddim,lcm,flow_match`")
+    parser.add_argument("--prediction_type", default="epsilon", choices=["epsilon", "v_prediction"], help="Model prediction type (flow_match always predicts velocity)")
+    parser.add_argument("--dtype", default="float32", choices=["float32", "float16"], help="Latent and coefficient type of the step graphs")
+    parser.add_argument("--opset", default=17, type=int)
+    parser.add_argument("--latent_dims", default=LATENT_DIMS, type=str, help="Comma separated symbolic latent axes of the step graphs, e.g. batch,channels,frames,height,width for video")
+    parser.add_argument("--denoiser", default=None, type=Path, help="Converted unet/transformer model.onnx, also saves a denoiser + step graph per scheduler next to it")
+    return parser.parse_known_args(raw_args)
+
+
+def main(raw_args=None):
+    common_args, extra_args = parse_common_args(raw_args)
+    schedulers = common_args.schedulers.split(",")
+    dtype = TensorProto.FLOAT16 if common_args.dtype == "float16" else TensorProto.FLOAT
+    latent_dims = common_args.latent_dims.split(",")
+
+    print('Scheduler Step Conversion')
+    print('--------------------------------------')
+    print(f'Output: {common_args.output}')
+    print(f'Schedulers: {schedulers}')
+    print(f'Prediction Type: {common_args.prediction_type}')
+    print(f'Latent Dims: {latent_dims}')
+    print(f'Denoiser: {common_args.denoiser}')
+    print('--------------------------------------')
+
+    for scheduler in schedulers:
+        output_dir = common_args.output / scheduler
+        output_dir.mkdir(parents=True, exist_ok=True)
+        onnx.save(create_step_model(scheduler, common_args.prediction_type, dtype, common_args.opset, latent_dims), output_dir / "model.onnx")
+        print(f"Step {scheduler}: {output_dir / 'model.onnx'}")
+
+        if common_args.denoiser is not None:
+            # Saved next to the denoiser so model.onnx.data is shared
+            denoiser_step_path = common_args.denoiser.parent / f"model_{scheduler}.onnx"
+            onnx.save(create_denoiser_step_model(common_args.denoiser, scheduler, common_args.prediction_type), denoiser_step_path)
+            print(f"Denoiser + {scheduler}: {denoiser_step_path}")
+
+    print('Scheduler Step Conversion Complete.')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import time
+import argparse
+import numpy as np
+import onnxruntime
+from pathlib import Path
+from tabulate import tabulate
+
+
+def create_session(model_path: Path, threads: int, provider: str):
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = threads
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return onnxruntime.InferenceSession(str(model_path), options, providers=[provider])
+
+
+def unet_inputs(session, height: int, width: int):
+    # [uncond, cond] text batch, the sample is batched with it unless guidance_scale is fused (--guided)
+    dtypes = {"tensor(float)": np.float32, "tensor(float16)": np.float16, "tensor(int64)": np.int64}
+    sample_batch = 1 if "guidance_scale" in [input.name for input in session.get_inputs()] else 2
+    inputs = {}
+    for input in session.get_inputs():
+        dtype = dtypes[input.type]
+        if input.name == "sample":
+            inputs[input.name] = np.random.rand(sample_batch, 4, height // 8, width // 8).astype(dtype)
+        elif input.name in ("timestep", "timestep_index"):
+            inputs[input.name] = np.array([999] * sample_batch, dtype=dtype)
+        elif input.name == "encoder_hidden_states" or input.name.startswith(("key_", "value_")):
+            hidden_size = input.shape[2] if isinstance(input.shape[2], int) else 768
+            inputs[input.name] = np.random.rand(2, 77, hidden_size).astype(dtype)
+        elif input.name == "guidance_scale":
+            inputs[input.name] = np.array([7.5], dtype=dtype)
+        elif input.name != "deep_cache":
+            raise ValueError(f"Unsupported input {input.name}, the benchmark expects a unet model")
+    return inputs
+
+
+def deep_cache_schedule(steps: int, interval: int):
+    # Reference schedule: the full unet on the first step and every interval steps, the shallow unet reuses its deep_cache in between
+    return [step % interval == 0 for step in range(steps)]
+
+
+def run_schedule(full_session, shallow_session, inputs: dict, schedule: list):
+    shallow_names = [input.name for input in shallow_session.get_inputs()]
+    start = time.perf_counter()
+    for is_full in schedule:
+        if is_full:
+            _, deep_cache = full_session.run(None, inputs)
+        else:
+            shallow_inputs = {name: inputs[name] for name in shallow_names if name != "deep_cache"}
+            shallow_session.run(None, {**shallow_inputs, "deep_cache": deep_cache})
+    return (time.perf_counter() - start) * 1000
+
+
+def benchmark(full_path: Path, shallow_path: Path, steps: int, intervals: list, height: int, width: int, threads: int, provider: str):
+    full_session = create_session(full_path, threads, provider)
+    shallow_session = create_session(shallow_path, threads, provider)
+    inputs = unet_inputs(full_session, height, width)
+    run_schedule(full_session, shallow_session, inputs, deep_cache_schedule(2, 2))
+
+    # Speedup against the full unet on every step (interval 1)
+    baseline = run_schedule(full_session, shallow_session, inputs, deep_cache_schedule(steps, 1))
+    results = []
+    for interval in intervals:
+        schedule = deep_cache_schedule(steps, interval)
+        schedule_ms = baseline if interval == 1 else run_schedule(full_session, shallow_session, inputs, schedule)
+        results.append([interval, sum(schedule), steps - sum(schedule), schedule_ms, baseline / schedule_ms])
+    print(tabulate(results, headers=["Interval", "Full Steps", "Shallow Steps", "Schedule (ms)", "Speedup"], floatfmt=".2f"))
+    return results
+
+
+def parse_common_args(raw_args):
+    parser = argparse.ArgumentParser("Common arguments")
+    parser.add_argument("--input", required=True, type=Path, help="Converted model folder with unet and unet_shallow (--deep_cache)")
+    parser.add_argument("--steps", default=20, type=int, help="Denoising steps per schedule")
+    parser.add_argument("--intervals", default="1,2,3,5", type=str, help="Comma separated full unet intervals, 1 = full unet every step")
+    parser.add_argument("--height", default=512, type=int)
+    parser.add_argument("--width", default=512, type=int)
+    parser.add_argument("--threads", default=0, type=int, help="CPU intra-op threads (0 = default)")
+    parser.add_argument("--provider", default="CPUExecutionProvider", type=str)
+    return parser.parse_known_args(raw_args)
+
+
+def main(raw_args=None):
+    common_args, extra_args = parse_common_args(raw_args)
+    intervals = [int(interval) for interval in common_args.intervals.split(",")]
+
+    print('Deep Cache Benchmark')
+    print('--------------------------------------')
+    print(f'Input: {common_args.input}')
+    print(f'Steps: {common_args.steps}')
+    print(f'Intervals: {intervals}')
+    print(f'Size: {common_args.width}x{common_args.height}')
+    print(f'Provider: {common_args.provider}')
+    print('--------------------------------------')
+
+    full_path = common_args.input / "unet" / "model.onnx"
+    shallow_path = common_args.input / "unet_shallow" / "model.onnx"
+    benchmark(full_path, shallow_path, common_args.steps, intervals, common_args.height, common_args.width, common_args.threads, common_args.provider)
+
+    print('Deep Cache Benchmark Complete.')
+
+
+if __name__ == "__main__":
+    main()
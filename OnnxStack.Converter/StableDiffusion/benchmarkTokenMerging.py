@@ -0,0 +1,95 @@
+import time
+import argparse
+import numpy as np
+import onnxruntime
+from pathlib import Path
+from tabulate import tabulate
+
+
+def create_session(model_path: Path, threads: int, provider: str):
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = threads
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return onnxruntime.InferenceSession(str(model_path), options, providers=[provider])
+
+
+def unet_inputs(session, height: int, width: int):
+    # [uncond, cond] text batch, the sample is batched with it unless guidance_scale is fused (--guided)
+    dtypes = {"tensor(float)": np.float32, "tensor(float16)": np.float16, "tensor(int64)": np.int64}
+    sample_batch = 1 if "guidance_scale" in [input.name for input in session.get_inputs()] else 2
+    inputs = {}
+    for input in session.get_inputs():
+        dtype = dtypes[input.type]
+        if input.name == "sample":
+            inputs[input.name] = np.random.rand(sample_batch, 4, height // 8, width // 8).astype(dtype)
+        elif input.name in ("timestep", "timestep_index"):
+            inputs[input.name] = np.array([999] * sample_batch, dtype=dtype)
+        elif input.name == "encoder_hidden_states" or input.name.startswith(("key_", "value_")):
+            hidden_size = input.shape[2] if isinstance(input.shape[2], int) else 768
+            inputs[input.name] = np.random.rand(2, 77, hidden_size).astype(dtype)
+        elif input.name == "guidance_scale":
+            inputs[input.name] = np.array([7.5], dtype=dtype)
+        elif input.name == "tome_ratio":
+            inputs[input.name] = np.array([0.0], dtype=dtype)
+        else:
+            raise ValueError(f"Unsupported input {input.name}, the benchmark expects a unet model")
+    return inputs
+
+
+def benchmark_step(session, inputs: dict, runs: int):
+    out_sample = session.run(None, inputs)[0]
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        session.run(None, inputs)
+        timings.append(time.perf_counter() - start)
+    return float(np.median(timings)) * 1000, out_sample
+
+
+def benchmark(model_path: Path, ratios: list, height: int, width: int, runs: int, threads: int, provider: str):
+    session = create_session(model_path, threads, provider)
+    inputs = unet_inputs(session, height, width)
+    dtype = inputs["tome_ratio"].dtype
+    timings = [benchmark_step(session, {**inputs, "tome_ratio": np.array([ratio], dtype=dtype)}, runs) for ratio in [0.0] + ratios]
+
+    # Speedup and out_sample difference against the unmerged step (ratio 0)
+    baseline, baseline_sample = timings[0]
+    results = []
+    for ratio, (step_ms, out_sample) in zip(ratios, timings[1:]):
+        sample_diff = float(np.abs(out_sample - baseline_sample).mean())
+        results.append([ratio, step_ms, baseline / step_ms, sample_diff])
+    print(tabulate(results, headers=["Ratio", "Step (ms)", "Speedup", "Sample Diff"], floatfmt=".4f"))
+    return results
+
+
+def parse_common_args(raw_args):
+    parser = argparse.ArgumentParser("Common arguments")
+    parser.add_argument("--input", required=True, type=Path, help="Converted unet model.onnx with the tome_ratio input (--tome)")
+    parser.add_argument("--ratios", default="0,0.3,0.5,0.7", type=str, help="Comma separated tome_ratio values, 0 = no merging")
+    parser.add_argument("--height", default=512, type=int)
+    parser.add_argument("--width", default=512, type=int)
+    parser.add_argument("--runs", default=3, type=int, help="Timed runs per ratio")
+    parser.add_argument("--threads", default=0, type=int, help="CPU intra-op threads (0 = default)")
+    parser.add_argument("--provider", default="CPUExecutionProvider", type=str)
+    return parser.parse_known_args(raw_args)
+
+
+def main(raw_args=None):
+    common_args, extra_args = parse_common_args(raw_args)
+    ratios = [float(ratio) for ratio in common_args.ratios.split(",")]
+
+    print('ToMe Benchmark')
+    print('--------------------------------------')
+    print(f'Input: {common_args.input}')
+    print(f'Ratios: {ratios}')
+    print(f'Size: {common_args.width}x{common_args.height}')
+    print(f'Provider: {common_args.provider}')
+    print('--------------------------------------')
+
+    benchmark(common_args.input, ratios, common_args.height, common_args.width, common_args.runs, common_args.threads, common_args.provider)
+
+    print('ToMe Benchmark Complete.')
+
+
+if __name__ == "__main__":
+    main()
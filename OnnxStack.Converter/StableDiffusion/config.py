@@ -1,3 +1,14 @@
 vae_sample_size = 512
 unet_sample_size = 64
 cross_attention_dim = 768
+guided = False
+context_kv = False
+cross_attention_layers = 16 # cross-attention layers in the unet, one key_<n>/value_<n> input pair each with context_kv
+cross_attention_dims = [] # key/value dims per layer, recorded when the unet is loaded
+timestep_table = False
+timestep_table_size = 1000 # discrete training timesteps, timestep_index rows of the timestep table
+time_embed_dim = 0 # recorded when the unet is loaded
+deep_cache = False
+deep_cache_channels = 0 # up_blocks[-2] output channels of the deep_cache feature, recorded when the unet is loaded
+tome = False
+tome_max_downsample = 1 # token merging in the self-attention of the levels down to sample size / tome_max_downsample
@@ -5,11 +5,19 @@ import shutil
 import warnings
 from pathlib import Path
 import config
+from convertTokenizerToOnnx import save_tokenizer_model, save_fused_text_encoders
 from olive.workflows import run as olive_run
 from olive.model import ONNXModelHandler
+from ioManifest import save_io_manifest
 
 
-def optimize(script_dir: str, model_input: str, model_output: Path, submodel_names: list[str]):
+# Tokenizer model.onnx: max_length and input_ids type of the matching text encoder
+TOKENIZERS = {
+    "tokenizer": (77, "int32")
+}
+
+
+def optimize(script_dir: str, model_input: str, model_output: Path, submodel_names: list[str], fuse_tokenizer: bool = False, io_dtype: str = "float32"):
     model_info = {}
     model_dir = model_input
    
@@ -24,15 +32,51 @@ def optimize(script_dir: str, model_input: str, model_output: Path, submodel_nam
             olive_config = json.load(fin)
 
         olive_config["input_model"]["config"]["model_path"] = model_dir
+        if io_dtype == "float16":
+            io_dtype_config(olive_config)
+        if submodel_name == "context_projection" or (submodel_name == "unet" and config.context_kv):
+            context_kv_config(olive_config, submodel_name)
+        if submodel_name == "unet" and config.timestep_table:
+            timestep_table_config(olive_config)
         run_res = olive_run(olive_config)
         save_onnx_submodel(script_dir, submodel_name, model_info)
         print(f"Optimizing {submodel_name} complete.")
 
-    save_onnx_models(model_dir, model_info, model_output, submodel_names)
+    save_onnx_models(model_dir, model_info, model_output, submodel_names, fuse_tokenizer)
     return model_info
 
 
-def save_onnx_models(model_dir, model_info, model_output, submodel_names):
+def timestep_table_config(olive_config):
+    # int64 timestep_index in place of the float timestep
+    io_config = olive_config["input_model"]["config"]["io_config"]
+    dynamic_axes = io_config["dynamic_axes"]
+    for name, table_name in [("timestep", "timestep_index")]:
+        io_config["input_names"][io_config["input_names"].index(name)] = table_name
+        dynamic_axes[table_name] = dynamic_axes.pop(name)
+
+
+def context_kv_config(olive_config, submodel_name: str):
+    # key_<n>/value_<n> per cross-attention layer: context_projection outputs, unet inputs in place of encoder_hidden_states
+    io_config = olive_config["input_model"]["config"]["io_config"]
+    names = [f"{kind}_{index}" for index in range(config.cross_attention_layers) for kind in ("key", "value")]
+    dynamic_axes = io_config["dynamic_axes"]
+    for name in names:
+        dynamic_axes[name] = dict(dynamic_axes["encoder_hidden_states"])
+    if submodel_name == "context_projection":
+        io_config["output_names"] = names
+        return
+    index = io_config["input_names"].index("encoder_hidden_states")
+    io_config["input_names"][index:index + 1] = names
+    dynamic_axes.pop("encoder_hidden_states")
+
+
+def io_dtype_config(olive_config):
+    for olive_pass in olive_config["passes"].values():
+        if "keep_io_types" in olive_pass["config"]:
+            olive_pass["config"]["keep_io_types"] = False
+
+
+def save_onnx_models(model_dir, model_info, model_output, submodel_names, fuse_tokenizer=False):
     model_dir = Path(model_dir)
     model_output.mkdir(parents=True, exist_ok=True)
     
@@ -41,6 +85,7 @@ def save_onnx_models(model_dir, model_info, model_output, submodel_names):
         if submodel_name in ("tokenizer"):
             if os.path.exists(model_dir / submodel_name):
                 shutil.copytree(model_dir / submodel_name, model_output / submodel_name, ignore=shutil.ignore_patterns("*tokenizer_config.json"))
+                save_tokenizer_model(model_dir / submodel_name, model_output / submodel_name, *TOKENIZERS[submodel_name])
             continue
         
         dst_dir = model_output / submodel_name
@@ -53,6 +98,9 @@ def save_onnx_models(model_dir, model_info, model_output, submodel_names):
         if os.path.exists(src_data_path):
             shutil.copy(src_data_path, dst_dir)
 
+    if fuse_tokenizer:
+        save_fused_text_encoders(model_dir, model_output, TOKENIZERS)
+
     print(f"Model Output: {model_output}")
 
 
@@ -87,6 +135,10 @@ def parse_common_args(raw_args):
     parser.add_argument("--output", default=None, type=Path)
     parser.add_argument("--modules", default="tokenizer,text_encoder,vae_decoder,vae_encoder,unet,controlnet", help="The modules to convert")
     parser.add_argument("--clean", action="store_true", help="Deletes the Olive cache")
+    parser.add_argument("--io_dtype", default="float32", choices=["float32", "float16"], help="Graph input/output type of the float16 models, float16 drops the float32 casts at the graph boundary (io_manifest.json lists the types)")
+    parser.add_argument("--fuse_tokenizer", default=False, action="store_true", help="Also save text_encoder*/model_tokenizer.onnx with the tokenizer graph fused in front (string input, one session)")
+    parser.add_argument("--context_kv", default=False, action="store_true", help="Export the unet with key_<n>/value_<n> cross-attention inputs, precomputed once per prompt by the context_projection model")
+    parser.add_argument("--timestep_table", default=False, action="store_true", help="Export the unet with an int64 timestep_index input, time embeddings of every discrete timestep precomputed")
     return parser.parse_known_args(raw_args)
 
 
@@ -95,6 +147,10 @@ def main(raw_args=None):
     model_input = common_args.input
     model_output = common_args.output
     submodel_names = common_args.modules.split(",")
+    config.context_kv = common_args.context_kv
+    config.timestep_table = common_args.timestep_table
+    if config.context_kv and "unet" in submodel_names and "context_projection" not in submodel_names:
+        submodel_names.insert(submodel_names.index("unet"), "context_projection")
     script_dir = Path(__file__).resolve().parent
 
     if model_output is None:
@@ -109,11 +165,16 @@ def main(raw_args=None):
     print(f'Input: {model_input}')
     print(f'Output: {model_output}')
     print(f'Modules: {submodel_names}')
+    print(f'Fuse Tokenizer: {common_args.fuse_tokenizer}')
+    print(f'Context KV: {common_args.context_kv}')
+    print(f'Timestep Table: {common_args.timestep_table}')
+    print(f'IO Dtype: {common_args.io_dtype}')
     print('--------------------------------------')
 
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
-        optimize(script_dir, model_input, model_output, submodel_names)
+        optimize(script_dir, model_input, model_output, submodel_names, fuse_tokenizer=common_args.fuse_tokenizer, io_dtype=common_args.io_dtype)
+    save_io_manifest(model_output)
 
     clean(script_dir)
     print('Olive StableDiffusion2 Conversion Complete.')
@@ -0,0 +1,287 @@
+import json
+import argparse
+import numpy as np
+import onnx
+from pathlib import Path
+from onnx import helper, numpy_helper, TensorProto
+
+
+# Custom tokenizer ops from onnxruntime_extensions, the session must register get_library_path()
+CONTRIB_DOMAIN = "ai.onnx.contrib"
+DTYPES = {"int32": TensorProto.INT32, "int64": TensorProto.INT64}
+
+
+def get_file_content(path):
+    with open(path, "rb") as file:
+        return file.read()
+
+
+def special_token(tokenizer_config: dict, name: str, default: str):
+    token = tokenizer_config.get(name) or default
+    return token["content"] if isinstance(token, dict) else token
+
+
+def create_clip_tokenizer_model(tokenizer_dir: Path, max_length: int, dtype):
+    # CLIPTokenizer pads to the longest prompt (its own truncation mixes rows in a batch),
+    # padding/truncation to max_length, the pad token (SD2/SDXL tokenizer_2 pad with "!")
+    # and the end token of truncated prompts are applied in-graph
+    vocab = json.loads((tokenizer_dir / "vocab.json").read_text(encoding="utf-8"))
+    tokenizer_config = {}
+    if (tokenizer_dir / "tokenizer_config.json").exists():
+        tokenizer_config = json.loads((tokenizer_dir / "tokenizer_config.json").read_text(encoding="utf-8"))
+    pad_id = vocab[special_token(tokenizer_config, "pad_token", "<|endoftext|>")]
+    eos_id = vocab[special_token(tokenizer_config, "eos_token", "<|endoftext|>")]
+    last_position = np.zeros(max_length, dtype=bool)
+    last_position[-1] = True
+
+    nodes = [
+        helper.make_node(
+            "CLIPTokenizer", ["text"], ["clip_ids", "clip_mask"],
+            vocab=(tokenizer_dir / "vocab.json").read_text(encoding="utf-8"),
+            merges=(tokenizer_dir / "merges.txt").read_text(encoding="utf-8"),
+            padding_length=-1,
+            name="CLIPTokenizer",
+            domain=CONTRIB_DOMAIN
+        ),
+        helper.make_node("Shape", ["clip_ids"], ["clip_length"], start=1),
+        helper.make_node("Sub", ["length", "clip_length"], ["pad_length"]),
+        helper.make_node("Max", ["pad_length", "no_pad"], ["pad_end"]),
+        helper.make_node("Concat", ["pad_start", "pad_end"], ["pads"], axis=0),
+        helper.make_node("Pad", ["clip_ids", "pads", "pad_id"], ["clip_ids_padded"]),
+        helper.make_node("Pad", ["clip_mask", "pads", "mask_pad"], ["clip_mask_padded"]),
+        helper.make_node("Slice", ["clip_ids_padded", "no_pad", "length", "sequence_axis"], ["clip_ids_truncated"]),
+        helper.make_node("Slice", ["clip_mask_padded", "no_pad", "length", "sequence_axis"], ["attention_mask"]),
+        helper.make_node("Cast", ["attention_mask"], ["token_mask"], to=TensorProto.BOOL),
+        helper.make_node("Where", ["token_mask", "clip_ids_truncated", "pad_id"], ["padded_ids"]),
+        helper.make_node("And", ["token_mask", "last_position"], ["truncated"]),
+        helper.make_node("Where", ["truncated", "eos_id", "padded_ids"], ["token_ids"]),
+        helper.make_node("Cast", ["token_ids"], ["input_ids"], to=dtype)
+    ]
+    initializers = [
+        numpy_helper.from_array(np.array(pad_id, dtype=np.int64), "pad_id"),
+        numpy_helper.from_array(np.array(eos_id, dtype=np.int64), "eos_id"),
+        numpy_helper.from_array(np.array(0, dtype=np.int64), "mask_pad"),
+        numpy_helper.from_array(np.array([max_length], dtype=np.int64), "length"),
+        numpy_helper.from_array(np.array([0], dtype=np.int64), "no_pad"),
+        numpy_helper.from_array(np.array([0, 0, 0], dtype=np.int64), "pad_start"),
+        numpy_helper.from_array(np.array([1], dtype=np.int64), "sequence_axis"),
+        numpy_helper.from_array(last_position, "last_position")
+    ]
+    return create_tokenizer_model(nodes, initializers, "clip_tokenizer", max_length, dtype)
+
+
+def create_t5_tokenizer_model(tokenizer_dir: Path, max_length: int, dtype, bucket: int = 0):
+    # SentencepieceTokenizer returns ragged tokens, scattered into [batch, max_length] with
+    # truncation to max_length - 1 tokens, </s> after the last token and <pad> after that.
+    # With a bucket the batch is padded to the longest prompt rounded up to a multiple of bucket
+    import sentencepiece
+    sp_model = tokenizer_dir / "spiece.model"
+    processor = sentencepiece.SentencePieceProcessor(model_file=str(sp_model))
+
+    def const(name, value):
+        return numpy_helper.from_array(np.array(value, dtype=np.int64), name)
+
+    nodes = [
+        helper.make_node(
+            "SentencepieceTokenizer",
+            ["text", "nbest_size", "alpha", "add_bos", "add_eos", "reverse", "fairseq"],
+            ["tokens", "row_splits", "token_offsets"],
+            model=get_file_content(sp_model),
+            name="SentencepieceTokenizer",
+            domain=CONTRIB_DOMAIN
+        ),
+        # Prompt index and position of each token from the row splits [batch + 1]
+        helper.make_node("Shape", ["text"], ["batch"]),
+        helper.make_node("Squeeze", ["batch"], ["batch_size"]),
+        helper.make_node("Range", ["zero", "batch_size", "one"], ["rows"]),
+        helper.make_node("Slice", ["row_splits", "first", "last"], ["row_starts"]),
+        helper.make_node("Slice", ["row_splits", "second", "end"], ["row_ends"]),
+        helper.make_node("Sub", ["row_ends", "row_starts"], ["row_lengths"]),
+        helper.make_node("Shape", ["tokens"], ["token_count"]),
+        helper.make_node("Squeeze", ["token_count"], ["token_size"]),
+        helper.make_node("Range", ["zero", "token_size", "one"], ["token_range"]),
+        helper.make_node("Unsqueeze", ["token_range", "axis_1"], ["token_column"]),
+        helper.make_node("Unsqueeze", ["row_ends", "axis_0"], ["row_ends_row"]),
+        helper.make_node("GreaterOrEqual", ["token_column", "row_ends_row"], ["token_after_row"]),
+        helper.make_node("Cast", ["token_after_row"], ["token_after_row_count"], to=TensorProto.INT64),
+        helper.make_node("ReduceSum", ["token_after_row_count", "axis_1"], ["instance_indices"], keepdims=0),
+        helper.make_node("Gather", ["row_starts", "instance_indices"], ["token_starts"]),
+        helper.make_node("Sub", ["token_range", "token_starts"], ["positions"]),
+        # Truncate and scatter
+        helper.make_node("Less", ["positions", "max_tokens"], ["keep"]),
+        helper.make_node("Compress", ["instance_indices", "keep"], ["kept_rows"], axis=0),
+        helper.make_node("Compress", ["positions", "keep"], ["kept_positions"], axis=0),
+        helper.make_node("Cast", ["tokens"], ["tokens_int64"], to=TensorProto.INT64),
+        helper.make_node("Compress", ["tokens_int64", "keep"], ["kept_tokens"], axis=0),
+        helper.make_node("Unsqueeze", ["kept_rows", "axis_1"], ["kept_rows_column"]),
+        helper.make_node("Unsqueeze", ["kept_positions", "axis_1"], ["kept_positions_column"]),
+        helper.make_node("Concat", ["kept_rows_column", "kept_positions_column"], ["kept_indices"], axis=1),
+        helper.make_node("Concat", ["batch", "length"], ["output_shape"], axis=0),
+        helper.make_node("Expand", ["pad_id", "output_shape"], ["pad_ids"]),
+        helper.make_node("ScatterND", ["pad_ids", "kept_indices", "kept_tokens"], ["prompt_ids"]),
+        # </s> and attention mask
+        helper.make_node("Min", ["row_lengths", "max_tokens"], ["eos_positions"]),
+        helper.make_node("Unsqueeze", ["rows", "axis_1"], ["rows_column"]),
+        helper.make_node("Unsqueeze", ["eos_positions", "axis_1"], ["eos_positions_column"]),
+        helper.make_node("Concat", ["rows_column", "eos_positions_column"], ["eos_indices"], axis=1),
+        helper.make_node("Expand", ["eos_id", "batch"], ["eos_ids"]),
+        helper.make_node("ScatterND", ["prompt_ids", "eos_indices", "eos_ids"], ["token_ids"]),
+        helper.make_node("Range", ["zero", "max_length", "one"], ["columns"]),
+        helper.make_node("Unsqueeze", ["columns", "axis_0"], ["columns_row"]),
+        helper.make_node("LessOrEqual", ["columns_row", "eos_positions_column"], ["token_mask"]),
+        helper.make_node("Cast", ["token_mask"], ["attention_mask"], to=TensorProto.INT64),
+        helper.make_node("Cast", ["token_ids"], ["input_ids"], to=dtype)
+    ]
+    if bucket:
+        # length = min(ceil((longest + 1) / bucket) * bucket, max_length), the + 1 is the </s>
+        index = next(index for index, node in enumerate(nodes) if node.output[0] == "row_lengths") + 1
+        nodes[index:index] = [
+            helper.make_node("ReduceMax", ["row_lengths"], ["longest"], keepdims=1),
+            helper.make_node("Add", ["longest", "bucket_round"], ["longest_rounded"]),
+            helper.make_node("Div", ["longest_rounded", "bucket"], ["buckets"]),
+            helper.make_node("Mul", ["buckets", "bucket"], ["bucket_length"]),
+            helper.make_node("Min", ["bucket_length", "length_limit"], ["length"]),
+            helper.make_node("Squeeze", ["length"], ["max_length"])
+        ]
+    initializers = [
+        helper.make_tensor("nbest_size", TensorProto.INT64, [], [0]),
+        helper.make_tensor("alpha", TensorProto.FLOAT, [], [0]),
+        helper.make_tensor("add_bos", TensorProto.BOOL, [], [False]),
+        helper.make_tensor("add_eos", TensorProto.BOOL, [], [False]),
+        helper.make_tensor("reverse", TensorProto.BOOL, [], [False]),
+        helper.make_tensor("fairseq", TensorProto.BOOL, [], [False]),
+        const("zero", 0),
+        const("one", 1),
+        const("axis_0", [0]),
+        const("axis_1", [1]),
+        const("first", [0]),
+        const("second", [1]),
+        const("last", [-1]),
+        const("end", [np.iinfo(np.int64).max]),
+        const("max_tokens", max_length - 1),
+        const("pad_id", processor.pad_id()),
+        const("eos_id", processor.eos_id())
+    ]
+    if bucket:
+        initializers += [const("bucket", [bucket]), const("bucket_round", [bucket]), const("length_limit", [max_length])]
+        return create_tokenizer_model(nodes, initializers, "t5_tokenizer", "sequence_length", dtype)
+    initializers += [const("length", [max_length]), const("max_length", max_length)]
+    return create_tokenizer_model(nodes, initializers, "t5_tokenizer", max_length, dtype)
+
+
+def create_tokenizer_model(nodes: list, initializers: list, name: str, max_length, dtype):
+    graph = helper.make_graph(
+        nodes,
+        name,
+        [helper.make_tensor_value_info("text", TensorProto.STRING, ["batch"])],
+        [
+            helper.make_tensor_value_info("input_ids", dtype, ["batch", max_length]),
+            helper.make_tensor_value_info("attention_mask", TensorProto.INT64, ["batch", max_length])
+        ],
+        initializers
+    )
+    opset_imports = [helper.make_opsetid("", 17), helper.make_opsetid(CONTRIB_DOMAIN, 1)]
+    return helper.make_model(graph, opset_imports=opset_imports, ir_version=8)
+
+
+def create_tokenizer_model_for(tokenizer_dir: Path, max_length: int, dtype, bucket: int = 0):
+    # bucket only applies to T5, the CLIP text encoders always take max_length tokens
+    if (tokenizer_dir / "spiece.model").exists():
+        return create_t5_tokenizer_model(tokenizer_dir, max_length, dtype, bucket)
+    if (tokenizer_dir / "vocab.json").exists() and (tokenizer_dir / "merges.txt").exists():
+        return create_clip_tokenizer_model(tokenizer_dir, max_length, dtype)
+    raise ValueError(f"{tokenizer_dir} has no spiece.model or vocab.json/merges.txt")
+
+
+def save_tokenizer_model(tokenizer_dir: Path, output_dir: Path, max_length: int, dtype: str, bucket: int = 0):
+    # model.onnx next to the copied tokenizer files: text [batch] -> input_ids, attention_mask [batch, max_length]
+    output_dir.mkdir(parents=True, exist_ok=True)
+    onnx.save(create_tokenizer_model_for(Path(tokenizer_dir), max_length, DTYPES[dtype], bucket), output_dir / "model.onnx")
+
+
+def prefix_graph(graph, prefix: str, keep: set):
+    # Unique tokenizer names inside the text encoder graph
+    def rename(name):
+        return name if not name or name in keep else f"{prefix}{name}"
+
+    for node in graph.node:
+        node.name = rename(node.name or node.output[0])
+        node.input[:] = [rename(name) for name in node.input]
+        node.output[:] = [rename(name) for name in node.output]
+    for initializer in graph.initializer:
+        initializer.name = rename(initializer.name)
+
+
+def create_fused_text_encoder_model(tokenizer_dir: Path, max_length: int, encoder_path: Path, bucket: int = 0):
+    # Tokenizer nodes in front of the text encoder, text [batch] -> embeddings in one session run
+    model = onnx.load(encoder_path, load_external_data=False)
+    graph = model.graph
+    encoder_inputs = {value.name: value for value in graph.input}
+    input_dtype = encoder_inputs["input_ids"].type.tensor_type.elem_type
+    tokenizer = create_tokenizer_model_for(Path(tokenizer_dir), max_length, input_dtype, bucket).graph
+    encoder_mask = "attention_mask" in encoder_inputs
+    prefix_graph(tokenizer, "tokenizer/", {"text", "input_ids"} if encoder_mask else {"text", "input_ids", "attention_mask"})
+
+    nodes = list(tokenizer.node)
+    if encoder_mask:
+        mask_dtype = encoder_inputs["attention_mask"].type.tensor_type.elem_type
+        nodes.append(helper.make_node("Cast", ["tokenizer/attention_mask"], ["attention_mask"], name="tokenizer/attention_mask_cast", to=mask_dtype))
+    else:
+        # Exposed for pipelines that mask the text embeddings downstream (T5)
+        graph.output.append(tokenizer.output[1])
+    nodes.extend(graph.node)
+    del graph.node[:]
+    graph.node.extend(nodes)
+    graph.initializer.extend(tokenizer.initializer)
+
+    inputs = list(tokenizer.input) + [value for value in graph.input if value.name not in ("input_ids", "attention_mask")]
+    del graph.input[:]
+    graph.input.extend(inputs)
+    if not any(opset.domain == CONTRIB_DOMAIN for opset in model.opset_import):
+        model.opset_import.append(helper.make_opsetid(CONTRIB_DOMAIN, 1))
+    return model
+
+
+def save_fused_text_encoders(model_dir: Path, model_output: Path, tokenizers: dict, bucket: int = 0):
+    # model_tokenizer.onnx next to each converted text encoder, shares its model.onnx.data
+    for tokenizer_name, (max_length, _) in tokenizers.items():
+        tokenizer_dir = Path(model_dir) / tokenizer_name
+        encoder_dir = model_output / tokenizer_name.replace("tokenizer", "text_encoder")
+        if tokenizer_dir.exists() and (encoder_dir / "model.onnx").exists():
+            print(f"Saving {encoder_dir.name} + {tokenizer_name} model...")
+            onnx.save(create_fused_text_encoder_model(tokenizer_dir, max_length, encoder_dir / "model.onnx", bucket), encoder_dir / "model_tokenizer.onnx")
+
+
+def parse_common_args(raw_args):
+    parser = argparse.ArgumentParser("Common arguments")
+    parser.add_argument("--input", required=True, type=Path, help="Tokenizer folder (vocab.json/merges.txt or spiece.model)")
+    parser.add_argument("--output", default=None, type=Path, help="Output folder, default the tokenizer folder")
+    parser.add_argument("--max_length", default=77, type=int, help="Padded/truncated sequence length of the text encoder")
+    parser.add_argument("--dtype", default="int32", choices=list(DTYPES), help="input_ids type of the text encoder")
+    parser.add_argument("--bucket", default=0, type=int, help="T5 only, pad to the longest prompt rounded up to a multiple of bucket (at most max_length), 0 = always max_length")
+    parser.add_argument("--text_encoder", default=None, type=Path, help="Converted text encoder model.onnx, also saves the fused tokenizer + text encoder as model_tokenizer.onnx next to it")
+    return parser.parse_known_args(raw_args)
+
+
+def main(raw_args=None):
+    common_args, extra_args = parse_common_args(raw_args)
+    output_dir = common_args.output or common_args.input
+
+    print('Tokenizer Conversion')
+    print('--------------------------------------')
+    print(f'Input: {common_args.input}')
+    print(f'Output: {output_dir}')
+    print(f'Max Length: {common_args.max_length}')
+    print(f'DType: {common_args.dtype}')
+    print(f'Bucket: {common_args.bucket}')
+    print(f'Text Encoder: {common_args.text_encoder}')
+    print('--------------------------------------')
+    save_tokenizer_model(common_args.input, output_dir, common_args.max_length, common_args.dtype, common_args.bucket)
+    if common_args.text_encoder is not None:
+        fused_model = create_fused_text_encoder_model(common_args.input, common_args.max_length, common_args.text_encoder, common_args.bucket)
+        onnx.save(fused_model, common_args.text_encoder.parent / "model_tokenizer.onnx")
+    print('Tokenizer Conversion Complete.')
+
+
+if __name__ == "__main__":
+    main()
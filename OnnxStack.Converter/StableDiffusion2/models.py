@@ -2,6 +2,7 @@ import config
 import torch
 from typing import Union, Tuple
 from diffusers import AutoencoderKL, UNet2DConditionModel
+from diffusers.models.attention_processor import Attention
 from transformers.models.clip.modeling_clip import CLIPTextModel
 
 # Helper latency-only dataloader that creates random tensors with no label
@@ -93,11 +94,19 @@ def unet_inputs(batchsize, torch_dtype, is_conversion_inputs=False):
         "timestep": torch.rand((batchsize,), dtype=torch_dtype),
         "encoder_hidden_states": torch.rand((batchsize, 77, config.cross_attention_dim), dtype=torch_dtype),
     }
+    if config.context_kv:
+        inputs = context_kv_inputs(inputs)
+    if config.timestep_table:
+        inputs = timestep_table_inputs(inputs)
     return inputs
 
 
 def unet_load(model_name):
     model = UNet2DConditionModel.from_pretrained(model_name, subfolder="unet", torch_dtype=torch.float32)
+    if config.context_kv:
+        context_kv_load(model)
+    if config.timestep_table:
+        timestep_table_load(model)
     return model
 
 
@@ -110,6 +119,163 @@ def unet_data_loader(data_dir, batchsize, *args, **kwargs):
 
 
 
+# -----------------------------------------------------------------------------
+# CONTEXT PROJECTION
+# -----------------------------------------------------------------------------
+class ContextAttnProcessor:
+    # AttnProcessor2_0 for cross-attention, key/value are the precomputed context_projection outputs
+    def __init__(self):
+        self.key = None
+        self.value = None
+
+    def __call__(self, attn, hidden_states, encoder_hidden_states=None, attention_mask=None, temb=None, *args, **kwargs):
+        residual = hidden_states
+        input_ndim = hidden_states.ndim
+        if input_ndim == 4:
+            batch_size, channel, height, width = hidden_states.shape
+            hidden_states = hidden_states.view(batch_size, channel, height * width).transpose(1, 2)
+
+        batch_size = hidden_states.shape[0]
+        if attention_mask is not None:
+            attention_mask = attn.prepare_attention_mask(attention_mask, self.key.shape[1], batch_size)
+            attention_mask = attention_mask.view(batch_size, attn.heads, -1, attention_mask.shape[-1])
+
+        query = attn.to_q(hidden_states)
+        head_dim = query.shape[-1] // attn.heads
+        query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        key = self.key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        value = self.value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+
+        hidden_states = torch.nn.functional.scaled_dot_product_attention(query, key, value, attn_mask=attention_mask, dropout_p=0.0, is_causal=False)
+        hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim).to(query.dtype)
+        hidden_states = attn.to_out[0](hidden_states)
+        hidden_states = attn.to_out[1](hidden_states)
+
+        if input_ndim == 4:
+            hidden_states = hidden_states.transpose(-1, -2).reshape(batch_size, channel, height, width)
+        if attn.residual_connection:
+            hidden_states = hidden_states + residual
+        return hidden_states / attn.rescale_output_factor
+
+
+def cross_attention_modules(model):
+    modules = [module for module in model.modules() if isinstance(module, Attention) and module.is_cross_attention]
+    if len(modules) != config.cross_attention_layers:
+        raise ValueError(f"config.cross_attention_layers is {config.cross_attention_layers}, the unet has {len(modules)} cross-attention layers")
+    return modules
+
+
+class ContextProjection(torch.nn.Module):
+    # Key/value projections of every cross-attention layer, computed once per prompt instead of every step
+    def __init__(self, unet):
+        super().__init__()
+        self.attentions = torch.nn.ModuleList(cross_attention_modules(unet))
+
+    def forward(self, encoder_hidden_states):
+        outputs = []
+        for attention in self.attentions:
+            outputs += [attention.to_k(encoder_hidden_states), attention.to_v(encoder_hidden_states)]
+        return tuple(outputs)
+
+
+def context_kv_load(unet):
+    # encoder_hidden_states input replaced by key_<n>/value_<n> per cross-attention layer, weight names are unchanged
+    attentions = cross_attention_modules(unet)
+    processors = [ContextAttnProcessor() for attention in attentions]
+    for attention, processor in zip(attentions, processors):
+        attention.set_processor(processor)
+    config.cross_attention_dims = [attention.to_k.out_features for attention in attentions]
+    forward = unet.forward
+
+    def context_kv_forward(sample, timestep, *args):
+        cross_attention_kv, args = args[:len(processors) * 2], args[len(processors) * 2:]
+        for processor, key, value in zip(processors, cross_attention_kv[0::2], cross_attention_kv[1::2]):
+            processor.key, processor.value = key, value
+        # Placeholder, the cross-attention layers are the only encoder_hidden_states consumers
+        encoder_hidden_states = torch.zeros((cross_attention_kv[0].shape[0], 1, config.cross_attention_dim), dtype=sample.dtype)
+        return forward(sample, timestep, encoder_hidden_states, *args)
+    unet.forward = context_kv_forward
+
+
+def context_kv_inputs(inputs):
+    # encoder_hidden_states [batch, sequence, cross_attention_dim] -> key_<n>/value_<n> [batch, sequence, dim] at the same position
+    context_inputs = {}
+    for name, value in inputs.items():
+        if name != "encoder_hidden_states":
+            context_inputs[name] = value
+            continue
+        for index, dim in enumerate(config.cross_attention_dims):
+            context_inputs[f"key_{index}"] = torch.rand((*value.shape[:2], dim), dtype=value.dtype)
+            context_inputs[f"value_{index}"] = torch.rand((*value.shape[:2], dim), dtype=value.dtype)
+    return context_inputs
+
+
+def context_projection_inputs(batchsize, torch_dtype):
+    return {
+        "encoder_hidden_states": torch.rand((batchsize, 77, config.cross_attention_dim), dtype=torch_dtype)
+    }
+
+
+def context_projection_load(model_name):
+    model = UNet2DConditionModel.from_pretrained(model_name, subfolder="unet", torch_dtype=torch.float32)
+    return ContextProjection(model)
+
+
+def context_projection_conversion_inputs(model=None):
+    return tuple(context_projection_inputs(1, torch.float32).values())
+
+
+def context_projection_data_loader(data_dir, batchsize, *args, **kwargs):
+    return RandomDataLoader(context_projection_inputs, batchsize, torch.float16)
+
+
+
+# -----------------------------------------------------------------------------
+# TIMESTEP TABLE
+# -----------------------------------------------------------------------------
+class TimestepTable(torch.nn.Module):
+    # Replaces time_embedding, time_embedding(time_proj(t)) of every discrete timestep is an initializer gathered by timestep_index
+    def __init__(self, table):
+        super().__init__()
+        self.register_buffer("table", table)
+        self.emb = None
+
+    def forward(self, t_emb, condition=None):
+        return self.emb.expand(t_emb.shape[0], -1)
+
+
+def timestep_table_load(unet):
+    # timestep input replaced by int64 timestep_index [batch], the sinusoidal time_proj and time_embedding MLP are not exported
+    if unet.time_embedding.cond_proj is not None:
+        raise ValueError("timestep_table does not support a timestep_cond unet (LCM guidance embedding)")
+    with torch.no_grad():
+        timesteps = torch.arange(config.timestep_table_size)
+        table = unet.time_embedding(unet.time_proj(timesteps).to(unet.dtype))
+    unet.time_proj = torch.nn.Identity()
+    unet.time_embedding = TimestepTable(table)
+    config.time_embed_dim = table.shape[1]
+    forward = unet.forward
+
+    def timestep_table_forward(sample, timestep_index, *args):
+        unet.time_embedding.emb = unet.time_embedding.table[timestep_index]
+        # Placeholder, only its batch reaches TimestepTable
+        timestep = torch.zeros(timestep_index.shape, dtype=sample.dtype)
+        return forward(sample, timestep, *args)
+    unet.forward = timestep_table_forward
+
+
+def timestep_table_inputs(inputs):
+    # timestep -> int64 timestep_index at the same position
+    table_inputs = {}
+    for name, value in inputs.items():
+        if name == "timestep":
+            table_inputs["timestep_index"] = torch.randint(0, config.timestep_table_size, value.shape)
+        else:
+            table_inputs[name] = value
+    return table_inputs
+
+
+
 # -----------------------------------------------------------------------------
 # CONTROLNET - UNET
 # -----------------------------------------------------------------------------
@@ -2,4 +2,8 @@ vae_sample_size = 1024
 unet_sample_size = 128
 cross_attention_dim = 2048
 time_ids_size = 6
-text_embeds_size = 1280
\ No newline at end of file
+text_embeds_size = 1280
+guided = False
+text_bucket = 0
+conditioning = False
+modulation_size = 0 # AdaLN modulation columns per timestep, recorded when the transformer is loaded
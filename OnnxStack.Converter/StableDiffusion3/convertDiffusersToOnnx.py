@@ -5,11 +5,21 @@ import json
 import shutil
 import warnings
 from pathlib import Path
+from convertTokenizerToOnnx import save_tokenizer_model, save_fused_text_encoders
 from olive.workflows import run as olive_run
 from olive.model import ONNXModelHandler
+from ioManifest import save_io_manifest
 
 
-def optimize(script_dir: str, model_input: str, model_output: Path, submodel_names: list[str]):
+# Tokenizer model.onnx: max_length and input_ids type of the matching text encoder
+TOKENIZERS = {
+    "tokenizer": (77, "int32"),
+    "tokenizer_2": (77, "int64"),
+    "tokenizer_3": (512, "int64")
+}
+
+
+def optimize(script_dir: str, model_input: str, model_output: Path, submodel_names: list[str], fuse_tokenizer: bool = False, io_dtype: str = "float32"):
     model_info = {}
     model_dir = model_input
    
@@ -24,15 +34,46 @@ def optimize(script_dir: str, model_input: str, model_output: Path, submodel_nam
             olive_config = json.load(fin)
 
         olive_config["input_model"]["config"]["model_path"] = model_dir
+        if io_dtype == "float16":
+            io_dtype_config(olive_config)
+        if submodel_name == "text_encoder_3" and config.text_bucket:
+            dynamic_text_config(olive_config)
+        if submodel_name in ("unet", "transformer") and config.guided:
+            olive_config["input_model"]["config"]["io_config"]["input_names"].append("guidance_scale")
+        if submodel_name == "transformer" and config.conditioning:
+            conditioning_config(olive_config)
         run_res = olive_run(olive_config)
         save_onnx_submodel(script_dir, submodel_name, model_info)
         print(f"Optimizing {submodel_name} complete.")
 
-    save_onnx_models(model_dir, model_info, model_output, submodel_names)
+    save_onnx_models(model_dir, model_info, model_output, submodel_names, fuse_tokenizer)
     return model_info
 
 
-def save_onnx_models(model_dir, model_info, model_output, submodel_names):
+def dynamic_text_config(olive_config):
+    # Variable text length, the T5 tokenizer pads to a multiple of --text_bucket instead of max_length
+    io_config = olive_config["input_model"]["config"]["io_config"]
+    dynamic_axes = io_config.setdefault("dynamic_axes", {})
+    io_config["input_names"].append("attention_mask")
+    for name in ("input_ids", "attention_mask", "last_hidden_state"):
+        dynamic_axes[name] = {"0": "batch_size", "1": "sequence_length"}
+
+
+def conditioning_config(olive_config):
+    # modulation [batch, modulation] takes the timestep slot, pooled_projections only feeds the conditioning model
+    io_config = olive_config["input_model"]["config"]["io_config"]
+    renames = {"timestep": "modulation"}
+    io_config["input_names"] = [renames.get(name, name) for name in io_config["input_names"] if name != "pooled_projections"]
+    io_config["dynamic_axes"].pop("pooled_projections", None)
+
+
+def io_dtype_config(olive_config):
+    for olive_pass in olive_config["passes"].values():
+        if "keep_io_types" in olive_pass["config"]:
+            olive_pass["config"]["keep_io_types"] = False
+
+
+def save_onnx_models(model_dir, model_info, model_output, submodel_names, fuse_tokenizer=False):
     model_dir = Path(model_dir)
     model_output.mkdir(parents=True, exist_ok=True)
     
@@ -41,6 +82,7 @@ def save_onnx_models(model_dir, model_info, model_output, submodel_names):
         if submodel_name in ("tokenizer", "tokenizer_2", "tokenizer_3"):
             if os.path.exists(model_dir / submodel_name):
                 shutil.copytree(model_dir / submodel_name, model_output / submodel_name, ignore=shutil.ignore_patterns("*tokenizer_config.json"))
+                save_tokenizer_model(model_dir / submodel_name, model_output / submodel_name, *TOKENIZERS[submodel_name], config.text_bucket)
             continue
         
         dst_dir = model_output / submodel_name
@@ -53,6 +95,9 @@ def save_onnx_models(model_dir, model_info, model_output, submodel_names):
         if os.path.exists(src_data_path):
             shutil.copy(src_data_path, dst_dir)
 
+    if fuse_tokenizer:
+        save_fused_text_encoders(model_dir, model_output, TOKENIZERS, config.text_bucket)
+
     print(f"Model Output: {model_output}")
 
 
@@ -87,6 +132,11 @@ def parse_common_args(raw_args):
     parser.add_argument("--output", default=None, type=Path)
     parser.add_argument("--modules", default="tokenizer,tokenizer_2,tokenizer_3,text_encoder,text_encoder_2,text_encoder_3,vae_encoder,vae_decoder,transformer,controlnet", help="The modules to convert `tokenizer,tokenizer_2,tokenizer_3,text_encoder,text_encoder_2,text_encoder_3,vae_encoder,vae_decoder,transformer`")
     parser.add_argument("--clean", default=False, action="store_true", help="Deletes the Olive cache")
+    parser.add_argument("--io_dtype", default="float32", choices=["float32", "float16"], help="Graph input/output type of the float16 models, float16 drops the float32 casts at the graph boundary (io_manifest.json lists the types)")
+    parser.add_argument("--guided", default=False, action="store_true", help="Export the unet/transformer with classifier-free guidance fused (guidance_scale input)")
+    parser.add_argument("--fuse_tokenizer", default=False, action="store_true", help="Also save text_encoder*/model_tokenizer.onnx with the tokenizer graph fused in front (string input, one session)")
+    parser.add_argument("--text_bucket", default=0, type=int, help="Dynamic T5 text length: attention_mask inputs, the T5 tokenizer pads to a multiple of text_bucket (64), 0 = fixed max_length")
+    parser.add_argument("--conditioning", default=False, action="store_true", help="Also export the conditioning model (AdaLN modulation for all timesteps in one run), the transformer takes a modulation input instead of timestep/pooled_projections")
     return parser.parse_known_args(raw_args)
 
 
@@ -95,6 +145,7 @@ def main(raw_args=None):
     model_input = common_args.input
     model_output = common_args.output
     submodel_names = common_args.modules.split(",")
+    config.guided = common_args.guided
     script_dir = Path(__file__).resolve().parent
 
     if model_output is None:
@@ -104,15 +155,25 @@ def main(raw_args=None):
     if common_args.clean:
         clean(script_dir)
 
+    config.text_bucket = common_args.text_bucket
+    config.conditioning = common_args.conditioning
+    if config.conditioning and "transformer" in submodel_names and "conditioning" not in submodel_names:
+        submodel_names.insert(submodel_names.index("transformer"), "conditioning")
     print('Olive Conversion - SD3 Model')
     print('--------------------------------------')
     print(f'Input: {model_input}')
     print(f'Output: {model_output}')
     print(f'Modules: {submodel_names}')
+    print(f'Guided: {common_args.guided}')
+    print(f'Fuse Tokenizer: {common_args.fuse_tokenizer}')
+    print(f'Text Bucket: {common_args.text_bucket}')
+    print(f'Conditioning: {common_args.conditioning}')
+    print(f'IO Dtype: {common_args.io_dtype}')
     print('--------------------------------------')
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
-        optimize(script_dir, model_input, model_output, submodel_names)
+        optimize(script_dir, model_input, model_output, submodel_names, fuse_tokenizer=common_args.fuse_tokenizer, io_dtype=common_args.io_dtype)
+    save_io_manifest(model_output)
 
     clean(script_dir)
     print('Olive SD3 Conversion Complete.')
@@ -0,0 +1,51 @@
+import json
+import argparse
+import onnx
+from pathlib import Path
+
+
+def io_types(values, initializers: set):
+    return {
+        value.name: "string" if value.type.tensor_type.elem_type == onnx.TensorProto.STRING else onnx.helper.tensor_dtype_to_np_dtype(value.type.tensor_type.elem_type).name
+        for value in values if value.name not in initializers
+    }
+
+
+def save_io_manifest(model_output: Path):
+    # io_manifest.json: input/output element types of every converted model, the runtime binds buffers of those types
+    model_output = Path(model_output)
+    manifest = {}
+    for model_path in sorted(model_output.glob("**/*.onnx")):
+        graph = onnx.load(model_path, load_external_data=False).graph
+        initializers = {initializer.name for initializer in graph.initializer}
+        manifest[model_path.relative_to(model_output).as_posix()] = {
+            "inputs": io_types(graph.input, initializers),
+            "outputs": io_types(graph.output, initializers)
+        }
+    with (model_output / "io_manifest.json").open("w") as fout:
+        json.dump(manifest, fout, indent=4)
+    return manifest
+
+
+def parse_common_args(raw_args):
+    parser = argparse.ArgumentParser("Common arguments")
+    parser.add_argument("--input", required=True, type=Path, help="Converted model folder, io_manifest.json is saved next to the model folders")
+    return parser.parse_known_args(raw_args)
+
+
+def main(raw_args=None):
+    common_args, extra_args = parse_common_args(raw_args)
+
+    print('IO Manifest')
+    print('--------------------------------------')
+    print(f'Input: {common_args.input}')
+    print('--------------------------------------')
+
+    manifest = save_io_manifest(common_args.input)
+    print(f"Models: {len(manifest)}")
+
+    print('IO Manifest Complete.')
+
+
+if __name__ == "__main__":
+    main()
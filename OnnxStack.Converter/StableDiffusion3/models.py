@@ -2,6 +2,7 @@ import config
 import torch
 from typing import Union, Tuple
 from diffusers import AutoencoderKL, SD3Transformer2DModel
+from diffusers.models.normalization import AdaLayerNormZero, SD35AdaLayerNormZeroX, AdaLayerNormContinuous
 from transformers import CLIPTextModel, CLIPTextModelWithProjection, T5EncoderModel
 
 
@@ -66,9 +67,12 @@ def text_encoder_2_data_loader(data_dir, batchsize, *args, **kwargs):
 # TEXT ENCODER 3
 # -----------------------------------------------------------------------------
 def text_encoder_3_inputs(batchsize, torch_dtype):
-    return {
+    inputs = {
         "input_ids": torch.zeros((batchsize, 512), dtype=torch_dtype)
     }
+    if config.text_bucket:
+        inputs["attention_mask"] = torch.ones((batchsize, 512), dtype=torch.int64)
+    return inputs
 
 
 def text_encoder_3_load(model_name):
@@ -152,6 +156,26 @@ class WrappedSD3Transformer2DModel(SD3Transformer2DModel):
         )
 
 
+class GuidedSD3Transformer2DModel(WrappedSD3Transformer2DModel):
+    def forward(
+        self,
+        hidden_states: torch.FloatTensor, 
+        timestep: torch.FloatTensor, 
+        encoder_hidden_states: torch.FloatTensor,
+        pooled_projections: torch.FloatTensor,
+        guidance_scale: torch.FloatTensor
+    ) -> torch.FloatTensor:
+        # encoder_hidden_states and pooled_projections are [uncond, cond], returns uncond + guidance_scale * (cond - uncond)
+        noise_pred = super().forward(
+            hidden_states = torch.cat([hidden_states] * 2),
+            timestep = torch.cat([timestep] * 2),
+            encoder_hidden_states = encoder_hidden_states,
+            pooled_projections = pooled_projections
+        )[0]
+        noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
+        return noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
+
+
 def unet_inputs(batchsize, torch_dtype, is_conversion_inputs=False):
     inputs = {
         "hidden_states": torch.rand((batchsize, 16, config.unet_sample_size, config.unet_sample_size), dtype=torch_dtype),
@@ -159,11 +183,20 @@ def unet_inputs(batchsize, torch_dtype, is_conversion_inputs=False):
         "encoder_hidden_states": torch.rand((batchsize, 77, 4096), dtype=torch_dtype),
         "pooled_projections": torch.rand((1, 2048), dtype=torch_dtype)
     }
+    if config.guided:
+        inputs["encoder_hidden_states"] = torch.rand((batchsize * 2, 77, 4096), dtype=torch_dtype)
+        inputs["pooled_projections"] = torch.rand((batchsize * 2, 2048), dtype=torch_dtype)
+        inputs["guidance_scale"] = torch.tensor([7.0], dtype=torch_dtype)
+    if config.conditioning:
+        inputs = modulation_inputs(inputs)
     return inputs
 
 
 def unet_load(model_name):
-    model = WrappedSD3Transformer2DModel.from_pretrained(model_name, subfolder="transformer", torch_dtype=torch.float32)
+    model_class = GuidedSD3Transformer2DModel if config.guided else WrappedSD3Transformer2DModel
+    model = model_class.from_pretrained(model_name, subfolder="transformer", torch_dtype=torch.float32)
+    if config.conditioning:
+        modulation_load(model)
     return model
 
 
@@ -176,6 +209,93 @@ def unet_data_loader(data_dir, batchsize, *args, **kwargs):
 
 
 
+# -----------------------------------------------------------------------------
+# CONDITIONING
+# -----------------------------------------------------------------------------
+class ModulationInput(torch.nn.Module):
+    # Replaces an AdaLN linear, returns its slice of the precomputed conditioning modulation
+    def __init__(self, out_features):
+        super().__init__()
+        self.out_features = out_features
+        self.modulation = None
+
+    def forward(self, emb):
+        return self.modulation
+
+
+def modulation_modules(model):
+    # AdaLN layers in module order: norm1/norm1_context per block (SD3.5 dual attention norm1 has 9 chunks), norm_out
+    return [module for module in model.modules() if isinstance(module, (AdaLayerNormZero, SD35AdaLayerNormZeroX, AdaLayerNormContinuous))]
+
+
+class Conditioning(torch.nn.Module):
+    # time_text_embed and the AdaLN shift/scale/gate linears of every block, all scheduled timesteps in one run
+    def __init__(self, transformer):
+        super().__init__()
+        self.time_text_embed = transformer.time_text_embed
+        self.norms = torch.nn.ModuleList(modulation_modules(transformer))
+
+    def forward(self, timestep, pooled_projections):
+        # timestep [steps] x pooled_projections [batch, 2048] -> modulation [steps, batch, modulation]
+        steps, batch = timestep.shape[0], pooled_projections.shape[0]
+        timestep = timestep[:, None].expand(steps, batch).flatten()
+        pooled_projections = pooled_projections.expand(steps, -1, -1).flatten(0, 1)
+        temb = self.time_text_embed(timestep, pooled_projections)
+        modulation = torch.cat([norm.linear(norm.silu(temb)) for norm in self.norms], dim=1)
+        return modulation.unflatten(0, (steps, batch))
+
+
+def modulation_load(transformer):
+    # timestep/pooled_projections inputs replaced by one conditioning modulation row, the other weight names are unchanged
+    norms = modulation_modules(transformer)
+    for norm in norms:
+        norm.linear = ModulationInput(norm.linear.out_features)
+    sizes = [norm.linear.out_features for norm in norms]
+    config.modulation_size = sum(sizes)
+    forward = transformer.forward
+
+    def conditioning_forward(hidden_states, modulation, encoder_hidden_states, *args):
+        for norm, norm_modulation in zip(norms, modulation.split(sizes, dim=1)):
+            norm.linear.modulation = norm_modulation
+        # Placeholders, the AdaLN linears are the only temb consumers
+        timestep = torch.zeros((hidden_states.shape[0],), dtype=hidden_states.dtype)
+        pooled_projections = torch.zeros((modulation.shape[0], transformer.config.pooled_projection_dim), dtype=hidden_states.dtype)
+        return forward(hidden_states, timestep, encoder_hidden_states, pooled_projections, *args)
+    transformer.forward = conditioning_forward
+
+
+def modulation_inputs(inputs):
+    # timestep/pooled_projections -> modulation [batch, modulation] at the timestep position, batch follows pooled_projections
+    conditioning_inputs = {}
+    for name, value in inputs.items():
+        if name == "timestep":
+            conditioning_inputs["modulation"] = torch.rand((inputs["pooled_projections"].shape[0], config.modulation_size), dtype=value.dtype)
+        elif name != "pooled_projections":
+            conditioning_inputs[name] = value
+    return conditioning_inputs
+
+
+def conditioning_inputs(batchsize, torch_dtype):
+    return {
+        "timestep": torch.rand((28,), dtype=torch_dtype),
+        "pooled_projections": torch.rand((batchsize * 2 if config.guided else batchsize, 2048), dtype=torch_dtype)
+    }
+
+
+def conditioning_load(model_name):
+    model = SD3Transformer2DModel.from_pretrained(model_name, subfolder="transformer", torch_dtype=torch.float32)
+    return Conditioning(model)
+
+
+def conditioning_conversion_inputs(model=None):
+    return tuple(conditioning_inputs(1, torch.float32).values())
+
+
+def conditioning_data_loader(data_dir, batchsize, *args, **kwargs):
+    return RandomDataLoader(conditioning_inputs, batchsize, torch.float16)
+
+
+
 # -----------------------------------------------------------------------------
 # CONTROLNET - TRANSFORMER
 # -----------------------------------------------------------------------------
@@ -1,3 +1,9 @@
 vae_sample_size = 512
 unet_sample_size = 64
 cross_attention_dim = 768
+context_kv = False
+cross_attention_layers = 16 # cross-attention layers in the unet, one key_<n>/value_<n> input pair each with context_kv
+cross_attention_dims = [] # key/value dims per layer, recorded when the unet is loaded
+timestep_table = False
+timestep_table_size = 1000 # discrete training timesteps, timestep_index rows of the timestep table
+time_embed_dim = 0 # recorded when the unet is loaded
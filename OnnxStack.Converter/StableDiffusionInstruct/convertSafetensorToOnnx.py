@@ -37,6 +37,10 @@ def parse_common_args(raw_args):
     parser.add_argument("--output", default=None, type=Path)
     parser.add_argument("--modules", default="tokenizer,text_encoder,vae_encoder,vae_decoder,unet,controlnet", help="The modules to convert `tokenizer,text_encoder,vae_encoder,vae_decoder,unet,controlnet`")
     parser.add_argument("--clean", default=False, action="store_true", help="Deletes the Olive cache")
+    parser.add_argument("--io_dtype", default="float32", choices=["float32", "float16"], help="Graph input/output type of the float16 models, float16 drops the float32 casts at the graph boundary (io_manifest.json lists the types)")
+    parser.add_argument("--fuse_tokenizer", default=False, action="store_true", help="Also save text_encoder*/model_tokenizer.onnx with the tokenizer graph fused in front (string input, one session)")
+    parser.add_argument("--context_kv", default=False, action="store_true", help="Export the unet with key_<n>/value_<n> cross-attention inputs, precomputed once per prompt by the context_projection model")
+    parser.add_argument("--timestep_table", default=False, action="store_true", help="Export the unet with an int64 timestep_index input, time embeddings of every discrete timestep precomputed")
     return parser.parse_known_args(raw_args)
 
 
@@ -5,10 +5,20 @@ import json
 import shutil
 import warnings
 from pathlib import Path
+from convertTokenizerToOnnx import save_tokenizer_model, save_fused_text_encoders
 from olive.workflows import run as olive_run
 from olive.model import ONNXModelHandler
+from ioManifest import save_io_manifest
 
-def optimize(script_dir: str, model_input: str, model_output: Path, submodel_names: list[str]):
+
+# Tokenizer model.onnx: max_length and input_ids type of the matching text encoder
+TOKENIZERS = {
+    "tokenizer": (77, "int32"),
+    "tokenizer_2": (77, "int64")
+}
+
+
+def optimize(script_dir: str, model_input: str, model_output: Path, submodel_names: list[str], vae_tile_size: int = 0, fuse_tokenizer: bool = False, io_dtype: str = "float32"):
     model_info = {}
     model_dir = model_input
    
@@ -23,15 +33,81 @@ def optimize(script_dir: str, model_input: str, model_output: Path, submodel_nam
             olive_config = json.load(fin)
 
         olive_config["input_model"]["config"]["model_path"] = model_dir
+        if io_dtype == "float16":
+            io_dtype_config(olive_config)
+        if submodel_name in ("vae_encoder", "vae_decoder") and vae_tile_size:
+            tile_vae_config(olive_config, submodel_name, vae_tile_size)
+        if submodel_name in ("unet", "unet_shallow", "transformer") and config.guided:
+            olive_config["input_model"]["config"]["io_config"]["input_names"].append("guidance_scale")
+        if submodel_name == "context_projection" or (submodel_name in ("unet", "unet_shallow") and config.context_kv):
+            context_kv_config(olive_config, submodel_name)
+        if submodel_name in ("unet", "unet_shallow") and config.timestep_table:
+            timestep_table_config(olive_config)
+        if submodel_name in ("unet", "unet_shallow") and config.tome:
+            olive_config["input_model"]["config"]["io_config"]["input_names"].append("tome_ratio")
+        if submodel_name in ("unet", "unet_shallow") and config.deep_cache:
+            deep_cache_config(olive_config, submodel_name)
         run_res = olive_run(olive_config)
         save_onnx_submodel(script_dir, submodel_name, model_info)
         print(f"Optimizing {submodel_name} complete.")
 
-    save_onnx_models(model_dir, model_info, model_output, submodel_names)
+    save_onnx_models(model_dir, model_info, model_output, submodel_names, fuse_tokenizer)
     return model_info
 
 
-def save_onnx_models(model_dir, model_info, model_output, submodel_names):
+def timestep_table_config(olive_config):
+    # int64 timestep_index in place of the float timestep, time_ids_embedding (createTimeTables.py) in place of time_ids
+    io_config = olive_config["input_model"]["config"]["io_config"]
+    dynamic_axes = io_config["dynamic_axes"]
+    for name, table_name in [("timestep", "timestep_index"), ("time_ids", "time_ids_embedding")]:
+        io_config["input_names"][io_config["input_names"].index(name)] = table_name
+        dynamic_axes[table_name] = dynamic_axes.pop(name)
+
+
+def deep_cache_config(olive_config, submodel_name: str):
+    # deep_cache [batch, channels, height, width]: unet output, unet_shallow input after the other inputs
+    io_config = olive_config["input_model"]["config"]["io_config"]
+    io_config["dynamic_axes"]["deep_cache"] = {"0": "unet_deep_cache_batch", "2": "unet_sample_height", "3": "unet_sample_width"}
+    if submodel_name == "unet":
+        io_config["output_names"].append("deep_cache")
+        return
+    io_config["input_names"].append("deep_cache")
+
+
+def context_kv_config(olive_config, submodel_name: str):
+    # key_<n>/value_<n> per cross-attention layer: context_projection outputs, unet inputs in place of encoder_hidden_states
+    io_config = olive_config["input_model"]["config"]["io_config"]
+    names = [f"{kind}_{index}" for index in range(config.cross_attention_layers) for kind in ("key", "value")]
+    dynamic_axes = io_config["dynamic_axes"]
+    for name in names:
+        dynamic_axes[name] = dict(dynamic_axes["encoder_hidden_states"])
+    if submodel_name == "context_projection":
+        io_config["output_names"] = names
+        return
+    index = io_config["input_names"].index("encoder_hidden_states")
+    io_config["input_names"][index:index + 1] = names
+    dynamic_axes.pop("encoder_hidden_states")
+
+
+def tile_vae_config(olive_config, submodel_name: str, tile_size: int):
+    # Static tile export for tiledVae.py, the height/width axes are baked to the tile
+    io_config = olive_config["input_model"]["config"]["io_config"]
+    if submodel_name == "vae_decoder":
+        io_config["input_shapes"] = [[1, 4, tile_size // 8, tile_size // 8]]
+    else:
+        io_config["input_shapes"] = [[1, 3, tile_size, tile_size]]
+    io_config["input_types"] = ["float32"]
+    io_config.pop("dynamic_axes", None)
+    olive_config["input_model"]["config"].pop("dummy_inputs_func", None)
+
+
+def io_dtype_config(olive_config):
+    for olive_pass in olive_config["passes"].values():
+        if "keep_io_types" in olive_pass["config"]:
+            olive_pass["config"]["keep_io_types"] = False
+
+
+def save_onnx_models(model_dir, model_info, model_output, submodel_names, fuse_tokenizer=False):
     model_dir = Path(model_dir)
     model_output.mkdir(parents=True, exist_ok=True)
     
@@ -40,6 +116,7 @@ def save_onnx_models(model_dir, model_info, model_output, submodel_names):
         if submodel_name in ("tokenizer", "tokenizer_2"):
             if os.path.exists(model_dir / submodel_name):
                 shutil.copytree(model_dir / submodel_name, model_output / submodel_name, ignore=shutil.ignore_patterns("*tokenizer_config.json"))
+                save_tokenizer_model(model_dir / submodel_name, model_output / submodel_name, *TOKENIZERS[submodel_name])
             continue
         
         dst_dir = model_output / submodel_name
@@ -52,6 +129,9 @@ def save_onnx_models(model_dir, model_info, model_output, submodel_names):
         if os.path.exists(src_data_path):
             shutil.copy(src_data_path, dst_dir)
 
+    if fuse_tokenizer:
+        save_fused_text_encoders(model_dir, model_output, TOKENIZERS)
+
     print(f"Model Output: {model_output}")
 
 
@@ -86,7 +166,15 @@ def parse_common_args(raw_args):
     parser.add_argument("--output", default=None, type=Path)
     parser.add_argument("--modules", default="tokenizer,tokenizer_2,text_encoder,text_encoder_2,vae_encoder,vae_decoder,unet,controlnet", help="The modules to convert `tokenizer,tokenizer_2,text_encoder,text_encoder_2,vae_encoder,vae_decoder,unet,controlnet`")
     parser.add_argument("--clean", default=False, action="store_true", help="Deletes the Olive cache")
+    parser.add_argument("--io_dtype", default="float32", choices=["float32", "float16"], help="Graph input/output type of the float16 models, float16 drops the float32 casts at the graph boundary (io_manifest.json lists the types)")
+    parser.add_argument("--vae_tile_size", default=0, type=int, help="Export the vae_encoder/vae_decoder for a fixed pixel tile size (multiple of 8) for tiledVae.py, 0 = dynamic")
+    parser.add_argument("--guided", default=False, action="store_true", help="Export the unet/transformer with classifier-free guidance fused (guidance_scale input)")
     parser.add_argument("--vae_fp16_fix", default=False, action="store_true", help="Use 'madebyollin/sdxl-vae-fp16-fix' vae model")
+    parser.add_argument("--fuse_tokenizer", default=False, action="store_true", help="Also save text_encoder*/model_tokenizer.onnx with the tokenizer graph fused in front (string input, one session)")
+    parser.add_argument("--context_kv", default=False, action="store_true", help="Export the unet with key_<n>/value_<n> cross-attention inputs, precomputed once per prompt by the context_projection model")
+    parser.add_argument("--timestep_table", default=False, action="store_true", help="Export the unet with an int64 timestep_index input, time embeddings of every discrete timestep precomputed, time_ids_embedding input from createTimeTables.py in place of time_ids")
+    parser.add_argument("--deep_cache", default=False, action="store_true", help="Also export unet_shallow (outermost down/up blocks only, deep_cache input), the unet gains the deep_cache output of its deeper blocks")
+    parser.add_argument("--tome", default=False, action="store_true", help="Export the unet with token merging (ToMe) in the highest resolution self-attention, tome_ratio input (0 = no merging)")
     return parser.parse_known_args(raw_args)
 
 
@@ -104,6 +192,15 @@ def main(raw_args=None):
         clean(script_dir)
 
     submodel_names = common_args.modules.split(",")
+    config.context_kv = common_args.context_kv
+    config.timestep_table = common_args.timestep_table
+    if config.context_kv and "unet" in submodel_names and "context_projection" not in submodel_names:
+        submodel_names.insert(submodel_names.index("unet"), "context_projection")
+    config.deep_cache = common_args.deep_cache
+    if config.deep_cache and "unet" in submodel_names and "unet_shallow" not in submodel_names:
+        submodel_names.insert(submodel_names.index("unet") + 1, "unet_shallow")
+    config.guided = common_args.guided
+    config.tome = common_args.tome
     config.vae_fp16_fix = common_args.vae_fp16_fix
 
     print('Olive Conversion - SDXL Model')
@@ -111,11 +208,20 @@ def main(raw_args=None):
     print(f'Input: {model_input}')
     print(f'Output: {model_output}')
     print(f'Modules: {submodel_names}')
+    print(f'VAE Tile Size: {common_args.vae_tile_size}')
+    print(f'Guided: {common_args.guided}')
     print(f'vae_fp16_fix: {common_args.vae_fp16_fix}')
+    print(f'Fuse Tokenizer: {common_args.fuse_tokenizer}')
+    print(f'Context KV: {common_args.context_kv}')
+    print(f'Timestep Table: {common_args.timestep_table}')
+    print(f'Deep Cache: {common_args.deep_cache}')
+    print(f'ToMe: {common_args.tome}')
+    print(f'IO Dtype: {common_args.io_dtype}')
     print('--------------------------------------')
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
-        optimize(script_dir, model_input, model_output, submodel_names)
+        optimize(script_dir, model_input, model_output, submodel_names, common_args.vae_tile_size, fuse_tokenizer=common_args.fuse_tokenizer, io_dtype=common_args.io_dtype)
+    save_io_manifest(model_output)
 
     clean(script_dir)
     print('Olive SDXL Conversion Complete.')
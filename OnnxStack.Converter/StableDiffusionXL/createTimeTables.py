@@ -0,0 +1,71 @@
+import argparse
+import numpy as np
+import torch
+from pathlib import Path
+from diffusers import UNet2DConditionModel
+
+
+def time_ids(height: int, width: int, time_ids_size: int, aesthetic_score: float):
+    # Pipeline time_ids without cropping, original size = target size. The refiner (5 ids) takes an aesthetic score in place of the target size
+    if time_ids_size == 5:
+        return [height, width, 0, 0, aesthetic_score]
+    return [height, width, 0, 0, height, width]
+
+
+def time_ids_embedding(unet, time_ids: list):
+    # add_time_proj(time_ids) through the time_ids columns of add_embedding.linear_1, the text_embeds columns and bias stay in the unet
+    with torch.no_grad():
+        time_embeds = unet.add_time_proj(torch.tensor(time_ids, dtype=torch.float32)).reshape(1, -1)
+        weight = unet.add_embedding.linear_1.weight.float()
+        return (time_embeds @ weight[:, -time_embeds.shape[1]:].T).numpy()
+
+
+def time_tables(unet, height: int, width: int, text_embeds_size: int, aesthetic_score: float, negative_aesthetic_score: float):
+    # [uncond, cond] rows, the --guided batch order. Only the refiner negative differs (negative aesthetic score)
+    time_ids_size = (unet.config.projection_class_embeddings_input_dim - text_embeds_size) // unet.config.addition_time_embed_dim
+    negative = time_ids_embedding(unet, time_ids(height, width, time_ids_size, negative_aesthetic_score))
+    positive = time_ids_embedding(unet, time_ids(height, width, time_ids_size, aesthetic_score))
+    return np.concatenate([negative, positive])
+
+
+def parse_resolution(resolution: str):
+    width, height = resolution.lower().split("x")
+    return int(width), int(height)
+
+
+def parse_common_args(raw_args):
+    parser = argparse.ArgumentParser("Common arguments")
+    parser.add_argument("--input", required=True, type=str, help="Diffusers model folder, the unet subfolder is loaded")
+    parser.add_argument("--output", required=True, type=Path, help="Output folder, tables are saved as <width>x<height>/time_ids_embedding.npy")
+    parser.add_argument("--resolutions", default="1024x1024", type=str, help="Comma separated <width>x<height> image sizes")
+    parser.add_argument("--text_embeds_size", default=1280, type=int, help="text_encoder_2 projection size (config.text_embeds_size)")
+    parser.add_argument("--aesthetic_score", default=6.0, type=float, help="Refiner only")
+    parser.add_argument("--negative_aesthetic_score", default=2.5, type=float, help="Refiner only")
+    parser.add_argument("--dtype", default="float32", choices=["float32", "float16"], help="Table type of the unet input")
+    return parser.parse_known_args(raw_args)
+
+
+def main(raw_args=None):
+    common_args, extra_args = parse_common_args(raw_args)
+    resolutions = [parse_resolution(resolution) for resolution in common_args.resolutions.split(",")]
+
+    print('Time Tables')
+    print('--------------------------------------')
+    print(f'Input: {common_args.input}')
+    print(f'Output: {common_args.output}')
+    print(f'Resolutions: {resolutions}')
+    print('--------------------------------------')
+
+    unet = UNet2DConditionModel.from_pretrained(common_args.input, subfolder="unet")
+    for width, height in resolutions:
+        output_dir = common_args.output / f"{width}x{height}"
+        output_dir.mkdir(parents=True, exist_ok=True)
+        table = time_tables(unet, height, width, common_args.text_embeds_size, common_args.aesthetic_score, common_args.negative_aesthetic_score)
+        np.save(output_dir / "time_ids_embedding.npy", table.astype(common_args.dtype))
+        print(f"{width}x{height}: {list(table.shape)}")
+
+    print('Time Tables Complete.')
+
+
+if __name__ == "__main__":
+    main()
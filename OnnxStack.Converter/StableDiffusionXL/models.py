@@ -2,6 +2,7 @@ import config
 import torch
 from typing import Union, Tuple
 from diffusers import AutoencoderKL, UNet2DConditionModel
+from diffusers.models.attention_processor import Attention
 from transformers.models.clip.modeling_clip import CLIPTextModel, CLIPTextModelWithProjection
 
 # Helper latency-only dataloader that creates random tensors with no label
@@ -138,6 +139,28 @@ class SDXLUNet2DConditionModel(UNet2DConditionModel):
         )
 
 
+class GuidedSDXLUNet2DConditionModel(SDXLUNet2DConditionModel):
+    def forward(
+        self,
+        sample: torch.FloatTensor, 
+        timestep: torch.FloatTensor, 
+        encoder_hidden_states: torch.FloatTensor,
+        text_embeds: torch.FloatTensor,
+        time_ids: torch.FloatTensor,
+        guidance_scale: torch.FloatTensor
+    ) -> torch.FloatTensor:
+        # encoder_hidden_states, text_embeds and time_ids are [uncond, cond], returns uncond + guidance_scale * (cond - uncond)
+        noise_pred = super().forward(
+            sample = torch.cat([sample] * 2),
+            timestep = torch.cat([timestep] * 2),
+            encoder_hidden_states = encoder_hidden_states,
+            text_embeds = text_embeds,
+            time_ids = time_ids
+        )[0]
+        noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
+        return noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
+
+
 def unet_inputs(batchsize, torch_dtype, is_conversion_inputs=False):
     inputs = {
         "sample": torch.rand((batchsize, 4, config.unet_sample_size, config.unet_sample_size), dtype=torch_dtype),
@@ -146,11 +169,31 @@ def unet_inputs(batchsize, torch_dtype, is_conversion_inputs=False):
         "text_embeds": torch.rand((1, config.text_embeds_size), dtype=torch_dtype),
         "time_ids": torch.rand((1, config.time_ids_size), dtype=torch_dtype),
     }
+    if config.guided:
+        inputs["encoder_hidden_states"] = torch.rand((batchsize * 2, 77, config.cross_attention_dim), dtype=torch_dtype)
+        inputs["text_embeds"] = torch.rand((batchsize * 2, config.text_embeds_size), dtype=torch_dtype)
+        inputs["time_ids"] = torch.rand((batchsize * 2, config.time_ids_size), dtype=torch_dtype)
+        inputs["guidance_scale"] = torch.tensor([5.0], dtype=torch_dtype)
+    if config.context_kv:
+        inputs = context_kv_inputs(inputs)
+    if config.timestep_table:
+        inputs = timestep_table_inputs(inputs)
+    if config.tome:
+        inputs["tome_ratio"] = torch.tensor([0.5], dtype=torch_dtype)
     return inputs
 
 
 def unet_load(model_name):
-    model = SDXLUNet2DConditionModel.from_pretrained(model_name, subfolder="unet", torch_dtype=torch.float32)
+    model_class = GuidedSDXLUNet2DConditionModel if config.guided else SDXLUNet2DConditionModel
+    model = model_class.from_pretrained(model_name, subfolder="unet", torch_dtype=torch.float32)
+    if config.context_kv:
+        context_kv_load(model)
+    if config.timestep_table:
+        timestep_table_load(model)
+    if config.deep_cache:
+        deep_cache_load(model)
+    if config.tome:
+        tome_load(model)
     return model
 
 
@@ -163,6 +206,355 @@ def unet_data_loader(data_dir, batchsize, *args, **kwargs):
 
 
 
+# -----------------------------------------------------------------------------
+# CONTEXT PROJECTION
+# -----------------------------------------------------------------------------
+class ContextAttnProcessor:
+    # AttnProcessor2_0 for cross-attention, key/value are the precomputed context_projection outputs
+    def __init__(self):
+        self.key = None
+        self.value = None
+
+    def __call__(self, attn, hidden_states, encoder_hidden_states=None, attention_mask=None, temb=None, *args, **kwargs):
+        residual = hidden_states
+        input_ndim = hidden_states.ndim
+        if input_ndim == 4:
+            batch_size, channel, height, width = hidden_states.shape
+            hidden_states = hidden_states.view(batch_size, channel, height * width).transpose(1, 2)
+
+        batch_size = hidden_states.shape[0]
+        if attention_mask is not None:
+            attention_mask = attn.prepare_attention_mask(attention_mask, self.key.shape[1], batch_size)
+            attention_mask = attention_mask.view(batch_size, attn.heads, -1, attention_mask.shape[-1])
+
+        query = attn.to_q(hidden_states)
+        head_dim = query.shape[-1] // attn.heads
+        query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        key = self.key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        value = self.value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+
+        hidden_states = torch.nn.functional.scaled_dot_product_attention(query, key, value, attn_mask=attention_mask, dropout_p=0.0, is_causal=False)
+        hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim).to(query.dtype)
+        hidden_states = attn.to_out[0](hidden_states)
+        hidden_states = attn.to_out[1](hidden_states)
+
+        if input_ndim == 4:
+            hidden_states = hidden_states.transpose(-1, -2).reshape(batch_size, channel, height, width)
+        if attn.residual_connection:
+            hidden_states = hidden_states + residual
+        return hidden_states / attn.rescale_output_factor
+
+
+def cross_attention_modules(model):
+    modules = [module for module in model.modules() if isinstance(module, Attention) and module.is_cross_attention]
+    if len(modules) != config.cross_attention_layers:
+        raise ValueError(f"config.cross_attention_layers is {config.cross_attention_layers}, the unet has {len(modules)} cross-attention layers")
+    return modules
+
+
+class ContextProjection(torch.nn.Module):
+    # Key/value projections of every cross-attention layer, computed once per prompt instead of every step
+    def __init__(self, unet):
+        super().__init__()
+        self.attentions = torch.nn.ModuleList(cross_attention_modules(unet))
+
+    def forward(self, encoder_hidden_states):
+        outputs = []
+        for attention in self.attentions:
+            outputs += [attention.to_k(encoder_hidden_states), attention.to_v(encoder_hidden_states)]
+        return tuple(outputs)
+
+
+def context_kv_load(unet):
+    # encoder_hidden_states input replaced by key_<n>/value_<n> per cross-attention layer, weight names are unchanged
+    attentions = cross_attention_modules(unet)
+    processors = [ContextAttnProcessor() for attention in attentions]
+    for attention, processor in zip(attentions, processors):
+        attention.set_processor(processor)
+    config.cross_attention_dims = [attention.to_k.out_features for attention in attentions]
+    forward = unet.forward
+
+    def context_kv_forward(sample, timestep, *args):
+        cross_attention_kv, args = args[:len(processors) * 2], args[len(processors) * 2:]
+        for processor, key, value in zip(processors, cross_attention_kv[0::2], cross_attention_kv[1::2]):
+            processor.key, processor.value = key, value
+        # Placeholder, the cross-attention layers are the only encoder_hidden_states consumers
+        encoder_hidden_states = torch.zeros((cross_attention_kv[0].shape[0], 1, config.cross_attention_dim), dtype=sample.dtype)
+        return forward(sample, timestep, encoder_hidden_states, *args)
+    unet.forward = context_kv_forward
+
+
+def context_kv_inputs(inputs):
+    # encoder_hidden_states [batch, sequence, cross_attention_dim] -> key_<n>/value_<n> [batch, sequence, dim] at the same position
+    context_inputs = {}
+    for name, value in inputs.items():
+        if name != "encoder_hidden_states":
+            context_inputs[name] = value
+            continue
+        for index, dim in enumerate(config.cross_attention_dims):
+            context_inputs[f"key_{index}"] = torch.rand((*value.shape[:2], dim), dtype=value.dtype)
+            context_inputs[f"value_{index}"] = torch.rand((*value.shape[:2], dim), dtype=value.dtype)
+    return context_inputs
+
+
+def context_projection_inputs(batchsize, torch_dtype):
+    return {
+        "encoder_hidden_states": torch.rand((batchsize, 77, config.cross_attention_dim), dtype=torch_dtype)
+    }
+
+
+def context_projection_load(model_name):
+    model = UNet2DConditionModel.from_pretrained(model_name, subfolder="unet", torch_dtype=torch.float32)
+    return ContextProjection(model)
+
+
+def context_projection_conversion_inputs(model=None):
+    return tuple(context_projection_inputs(1, torch.float32).values())
+
+
+def context_projection_data_loader(data_dir, batchsize, *args, **kwargs):
+    return RandomDataLoader(context_projection_inputs, batchsize, torch.float16)
+
+
+
+# -----------------------------------------------------------------------------
+# TIMESTEP TABLE
+# -----------------------------------------------------------------------------
+class TimestepTable(torch.nn.Module):
+    # Replaces time_embedding, time_embedding(time_proj(t)) of every discrete timestep is an initializer gathered by timestep_index
+    def __init__(self, table):
+        super().__init__()
+        self.register_buffer("table", table)
+        self.emb = None
+
+    def forward(self, t_emb, condition=None):
+        return self.emb.expand(t_emb.shape[0], -1)
+
+
+class TimeIdsLinear(torch.nn.Module):
+    # Replaces add_embedding.linear_1, the time_ids columns are precomputed per resolution (createTimeTables.py) and added to the text_embeds projection
+    def __init__(self, linear, text_embeds_size):
+        super().__init__()
+        self.text_embeds_size = text_embeds_size
+        self.weight = torch.nn.Parameter(linear.weight[:, :text_embeds_size].detach().clone())
+        self.bias = linear.bias
+
+    def forward(self, add_embeds):
+        text_embeds, time_ids_embedding = add_embeds[:, :self.text_embeds_size], add_embeds[:, self.text_embeds_size:]
+        return torch.nn.functional.linear(text_embeds, self.weight, self.bias) + time_ids_embedding
+
+
+def timestep_table_load(unet):
+    # timestep input replaced by int64 timestep_index [batch], the sinusoidal time_proj and time_embedding MLP are not exported
+    if unet.time_embedding.cond_proj is not None:
+        raise ValueError("timestep_table does not support a timestep_cond unet (LCM guidance embedding)")
+    with torch.no_grad():
+        timesteps = torch.arange(config.timestep_table_size)
+        table = unet.time_embedding(unet.time_proj(timesteps).to(unet.dtype))
+    unet.time_proj = torch.nn.Identity()
+    unet.time_embedding = TimestepTable(table)
+    config.time_embed_dim = table.shape[1]
+    # time_ids input replaced by time_ids_embedding [batch, time_embed_dim], add_time_proj passes it through to add_embedding
+    unet.add_time_proj = torch.nn.Identity()
+    unet.add_embedding.linear_1 = TimeIdsLinear(unet.add_embedding.linear_1, config.text_embeds_size)
+    forward = unet.forward
+
+    def timestep_table_forward(sample, timestep_index, *args):
+        unet.time_embedding.emb = unet.time_embedding.table[timestep_index]
+        # Placeholder, only its batch reaches TimestepTable
+        timestep = torch.zeros(timestep_index.shape, dtype=sample.dtype)
+        return forward(sample, timestep, *args)
+    unet.forward = timestep_table_forward
+
+
+def timestep_table_inputs(inputs):
+    # timestep -> int64 timestep_index, time_ids -> time_ids_embedding [batch, time_embed_dim] at the same positions
+    table_inputs = {}
+    for name, value in inputs.items():
+        if name == "timestep":
+            table_inputs["timestep_index"] = torch.randint(0, config.timestep_table_size, value.shape)
+        elif name == "time_ids":
+            table_inputs["time_ids_embedding"] = torch.rand((value.shape[0], config.time_embed_dim), dtype=value.dtype)
+        else:
+            table_inputs[name] = value
+    return table_inputs
+
+
+
+# -----------------------------------------------------------------------------
+# DEEP CACHE
+# -----------------------------------------------------------------------------
+class DeepCacheSkip(torch.nn.Module):
+    # Replaces a block the shallow unet does not run: returns its input (down blocks with one placeholder per residual), up_blocks[-2] returns the deep_cache input
+    def __init__(self, block, residuals=0):
+        super().__init__()
+        self.resnets = [None] * len(block.resnets)
+        self.residuals = residuals
+        self.cache = None
+
+    def forward(self, hidden_states, *args, **kwargs):
+        if self.cache is not None:
+            return self.cache
+        if self.residuals:
+            return hidden_states, (hidden_states,) * self.residuals
+        return hidden_states
+
+
+def deep_cache_load(unet):
+    # Adds the deep_cache output: up_blocks[-2] output, the input of the outermost up block
+    config.deep_cache_channels = unet.config.block_out_channels[1]
+    forward = unet.forward
+
+    def deep_cache_forward(*args):
+        cache = []
+        handle = unet.up_blocks[-2].register_forward_hook(lambda module, inputs, output: cache.append(output))
+        sample = forward(*args)
+        handle.remove()
+        sample = sample if torch.is_tensor(sample) else sample[0]
+        return sample, cache[-1]
+    unet.forward = deep_cache_forward
+
+
+def deep_cache_shallow_load(unet):
+    # Shallow unet: conv_in, down_blocks[0], up_blocks[-1] and conv_out, the deeper blocks are skipped and their up_blocks[-2] output is the deep_cache input
+    for index, block in enumerate(unet.down_blocks[1:], 1):
+        residuals = len(block.resnets) + (len(block.downsamplers) if block.downsamplers is not None else 0)
+        unet.down_blocks[index] = DeepCacheSkip(block, residuals)
+    unet.mid_block = DeepCacheSkip(unet.mid_block)
+    for index, block in enumerate(unet.up_blocks[:-1]):
+        unet.up_blocks[index] = DeepCacheSkip(block)
+    forward = unet.forward
+
+    def deep_cache_shallow_forward(*args):
+        unet.up_blocks[-2].cache = args[-1]
+        # The deep_cache output of the full unet is the input again, only the sample is returned
+        return forward(*args[:-1])[0]
+    unet.forward = deep_cache_shallow_forward
+
+
+def deep_cache_inputs(inputs):
+    # deep_cache [batch, channels, height, width] appended: the up_blocks[-2] output of the last full unet step, [uncond, cond] with --guided
+    sample = inputs["sample"]
+    inputs["deep_cache"] = torch.rand((sample.shape[0] * (2 if config.guided else 1), config.deep_cache_channels, *sample.shape[-2:]), dtype=sample.dtype)
+    return inputs
+
+
+def unet_shallow_inputs(batchsize, torch_dtype):
+    return deep_cache_inputs(unet_inputs(batchsize, torch_dtype))
+
+
+def unet_shallow_load(model_name):
+    model = unet_load(model_name)
+    deep_cache_shallow_load(model)
+    return model
+
+
+def unet_shallow_conversion_inputs(model=None):
+    return tuple(unet_shallow_inputs(1, torch.float32).values())
+
+
+def unet_shallow_data_loader(data_dir, batchsize, *args, **kwargs):
+    return RandomDataLoader(unet_shallow_inputs, batchsize, torch.float16)
+
+
+
+# -----------------------------------------------------------------------------
+# TOKEN MERGING
+# -----------------------------------------------------------------------------
+def bipartite_soft_matching(metric, height, width, ratio):
+    # ToMe with a fixed 2x2 stride: the top-left token of every 2x2 cell is a dst token, the ratio * tokens most similar src tokens are averaged into their closest dst token
+    rows = torch.arange(height, device=metric.device) % 2 == 0
+    columns = torch.arange(width, device=metric.device) % 2 == 0
+    is_dst = (rows[:, None] & columns[None, :]).flatten()
+    dst_index = torch.nonzero(is_dst)[:, 0]
+    src_index = torch.nonzero(~is_dst)[:, 0]
+    with torch.no_grad():
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        scores = metric[:, src_index] @ metric[:, dst_index].transpose(-1, -2)
+        node_max, node_index = scores.max(dim=-1)
+        edge_index = node_max.argsort(dim=-1, descending=True)
+        merge_count = torch.clamp((ratio * metric.shape[1]).long(), max=src_index.shape[0])[0]
+        unmerged_index = edge_index[:, merge_count:]
+        merged_index = edge_index[:, :merge_count]
+        merged_dst_index = node_index.gather(1, merged_index)
+
+    def merge(x):
+        # [batch, tokens, channels] -> [batch, unmerged src + dst, channels]
+        src, dst = x[:, src_index], x[:, dst_index]
+        channels = x.shape[-1]
+        unmerged = src.gather(1, unmerged_index[..., None].expand(-1, -1, channels))
+        src = src.gather(1, merged_index[..., None].expand(-1, -1, channels))
+        dst = dst.scatter_add(1, merged_dst_index[..., None].expand(-1, -1, channels), src)
+        counts = torch.ones_like(dst[..., :1]).scatter_add(1, merged_dst_index[..., None], torch.ones_like(src[..., :1]))
+        return torch.cat([unmerged, dst / counts], dim=1)
+
+    def unmerge(x):
+        # Merged src tokens take the value of their dst token
+        unmerged, dst = x[:, :unmerged_index.shape[1]], x[:, unmerged_index.shape[1]:]
+        channels = x.shape[-1]
+        src = dst.gather(1, merged_dst_index[..., None].expand(-1, -1, channels))
+        index = torch.cat([dst_index[None].expand(x.shape[0], -1), src_index[unmerged_index], src_index[merged_index]], dim=1)
+        output = torch.zeros((x.shape[0], metric.shape[1], channels), dtype=x.dtype, device=x.device)
+        return output.scatter(1, index[..., None].expand(-1, -1, channels), torch.cat([dst, unmerged, src], dim=1))
+    return merge, unmerge
+
+
+class ToMeAttnProcessor:
+    # AttnProcessor2_0 for self-attention, tokens are merged before the attention and unmerged after the output projection
+    def __init__(self, state, downsample):
+        self.state = state
+        self.downsample = downsample
+
+    def __call__(self, attn, hidden_states, encoder_hidden_states=None, attention_mask=None, temb=None, *args, **kwargs):
+        residual = hidden_states
+        height, width = [(size + self.downsample - 1) // self.downsample for size in self.state["size"]]
+        merge, unmerge = bipartite_soft_matching(hidden_states, height, width, self.state["ratio"])
+        hidden_states = merge(hidden_states)
+
+        batch_size = hidden_states.shape[0]
+        query = attn.to_q(hidden_states)
+        key = attn.to_k(hidden_states)
+        value = attn.to_v(hidden_states)
+        head_dim = query.shape[-1] // attn.heads
+        query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+
+        hidden_states = torch.nn.functional.scaled_dot_product_attention(query, key, value, dropout_p=0.0, is_causal=False)
+        hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim).to(query.dtype)
+        hidden_states = attn.to_out[0](hidden_states)
+        hidden_states = attn.to_out[1](hidden_states)
+        hidden_states = unmerge(hidden_states)
+
+        if attn.residual_connection:
+            hidden_states = hidden_states + residual
+        return hidden_states / attn.rescale_output_factor
+
+
+def tome_attention_modules(unet):
+    # (self-attention, downsample) of the transformer blocks down to tome_max_downsample, the down/up block levels run at sample size / 2^level
+    levels = len(unet.down_blocks)
+    blocks = [(block, 2 ** index) for index, block in enumerate(unet.down_blocks)]
+    blocks += [(block, 2 ** (levels - 1 - index)) for index, block in enumerate(unet.up_blocks)]
+    return [(module, downsample) for block, downsample in blocks if downsample <= config.tome_max_downsample
+            for module in block.modules() if isinstance(module, Attention) and not module.is_cross_attention]
+
+
+def tome_load(unet):
+    # Adds the tome_ratio input [1]: fraction of the self-attention tokens merged, 0 = no merging
+    state = {}
+    for attention, downsample in tome_attention_modules(unet):
+        attention.set_processor(ToMeAttnProcessor(state, downsample))
+    forward = unet.forward
+
+    def tome_forward(*args):
+        state["size"] = args[0].shape[-2:]
+        state["ratio"] = args[-1]
+        return forward(*args[:-1])
+    unet.forward = tome_forward
+
+
+
 # -----------------------------------------------------------------------------
 # CONTROLNET - UNET
 # -----------------------------------------------------------------------------
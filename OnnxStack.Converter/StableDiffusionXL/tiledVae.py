@@ -0,0 +1,153 @@
+import argparse
+import numpy as np
+import onnxruntime as ort
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+
+VAE_SCALE = 8
+
+
+def tile_starts(size: int, tile: int, overlap: int):
+    # Evenly strided tile origins, the last tile is aligned to the far edge
+    if size <= tile:
+        return [0]
+    stride = tile - overlap
+    starts = list(range(0, size - tile, stride))
+    return starts + [size - tile]
+
+
+def blend_ramp(length: int, overlap: int, blend_start: bool, blend_end: bool):
+    ramp = np.ones(length, dtype=np.float32)
+    if overlap > 0:
+        edge = np.arange(1, overlap + 1, dtype=np.float32) / (overlap + 1)
+        if blend_start:
+            ramp[:overlap] = edge
+        if blend_end:
+            ramp[-overlap:] = edge[::-1]
+    return ramp
+
+
+def blend_masks(rows: list, cols: list, tile: int, overlap: int):
+    # Precomputed per tile position, only edges shared with a neighbour are faded
+    masks = {}
+    for row_index, _ in enumerate(rows):
+        row_ramp = blend_ramp(tile, overlap, row_index > 0, row_index < len(rows) - 1)
+        for col_index, _ in enumerate(cols):
+            col_ramp = blend_ramp(tile, overlap, col_index > 0, col_index < len(cols) - 1)
+            masks[(row_index, col_index)] = np.outer(row_ramp, col_ramp)[None, None]
+    return masks
+
+
+class TiledVae:
+    def __init__(self, model_path: Path, tile_size: int = 0, overlap: int = 64, workers: int = 2, threads: int = 0, provider: str = "CPUExecutionProvider"):
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(str(model_path), options, providers=[provider])
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.decoder = model_input.name == "latent_sample"
+        self.workers = workers
+
+        # Input tile from the static export, else --tile_size (pixels)
+        input_size = model_input.shape[2]
+        if isinstance(input_size, int):
+            self.input_tile = input_size
+        elif self.decoder:
+            self.input_tile = tile_size // VAE_SCALE
+        else:
+            self.input_tile = tile_size
+        if self.input_tile <= 0:
+            raise ValueError(f"{model_path} has dynamic height/width, set the tile size")
+
+        self.input_overlap = overlap // VAE_SCALE if self.decoder else overlap
+        self.output_tile = self.to_output(self.input_tile)
+        self.output_overlap = self.to_output(self.input_overlap)
+        if self.input_overlap * 2 > self.input_tile:
+            raise ValueError("Tile overlap must be at most half the tile size")
+
+    def to_output(self, size: int):
+        return size * VAE_SCALE if self.decoder else size // VAE_SCALE
+
+    def run_tile(self, tile: np.ndarray):
+        return self.session.run(None, {self.input_name: tile})[0]
+
+    def __call__(self, input: np.ndarray):
+        batch, _, height, width = input.shape
+        if batch != 1:
+            return np.concatenate([self(input[index:index + 1]) for index in range(batch)])
+
+        # Inputs smaller than a tile are edge padded, the output is cropped back
+        pad_height, pad_width = max(self.input_tile - height, 0), max(self.input_tile - width, 0)
+        if pad_height or pad_width:
+            input = np.pad(input, ((0, 0), (0, 0), (0, pad_height), (0, pad_width)), mode="edge")
+        rows = tile_starts(input.shape[2], self.input_tile, self.input_overlap)
+        cols = tile_starts(input.shape[3], self.input_tile, self.input_overlap)
+        masks = blend_masks(rows, cols, self.output_tile, self.output_overlap)
+
+        output = np.zeros((1, 1), dtype=np.float32)
+        weights = np.zeros((1, 1, self.to_output(input.shape[2]), self.to_output(input.shape[3])), dtype=np.float32)
+
+        def accumulate(row_index, col_index, future):
+            nonlocal output
+            result = future.result().astype(np.float32)
+            if output.shape[1] != result.shape[1]:
+                output = np.zeros((1, result.shape[1]) + weights.shape[2:], dtype=np.float32)
+            mask = masks[(row_index, col_index)]
+            top, left = self.to_output(rows[row_index]), self.to_output(cols[col_index])
+            output[:, :, top:top + self.output_tile, left:left + self.output_tile] += result * mask
+            weights[:, :, top:top + self.output_tile, left:left + self.output_tile] += mask
+
+        with ThreadPoolExecutor(self.workers) as executor:
+            # At most workers * 2 tiles in flight, peak memory is bound by the tile size
+            pending = deque()
+            for row_index, top in enumerate(rows):
+                for col_index, left in enumerate(cols):
+                    tile = np.ascontiguousarray(input[:, :, top:top + self.input_tile, left:left + self.input_tile])
+                    pending.append((row_index, col_index, executor.submit(self.run_tile, tile)))
+                    if len(pending) >= self.workers * 2:
+                        accumulate(*pending.popleft())
+            while pending:
+                accumulate(*pending.popleft())
+
+        output /= weights
+        return output[:, :, :self.to_output(height), :self.to_output(width)]
+
+
+def parse_common_args(raw_args):
+    parser = argparse.ArgumentParser("Common arguments")
+    parser.add_argument("--model", required=True, type=Path, help="Converted vae_decoder or vae_encoder model.onnx")
+    parser.add_argument("--input", required=True, type=Path, help="Input .npy, latents [1,C,H/8,W/8] for the decoder or image [1,3,H,W] in [-1,1] for the encoder")
+    parser.add_argument("--output", required=True, type=Path, help="Output .npy")
+    parser.add_argument("--tile_size", default=0, type=int, help="Tile size in pixels, only needed if the model has dynamic height/width")
+    parser.add_argument("--tile_overlap", default=64, type=int, help="Tile overlap in pixels, blended linearly")
+    parser.add_argument("--workers", default=2, type=int, help="Tiles run concurrently on the session")
+    parser.add_argument("--threads", default=0, type=int, help="ORT intra-op threads, 0 = default")
+    parser.add_argument("--provider", default="CPUExecutionProvider", type=str)
+    return parser.parse_known_args(raw_args)
+
+
+def main(raw_args=None):
+    common_args, extra_args = parse_common_args(raw_args)
+
+    vae = TiledVae(common_args.model, common_args.tile_size, common_args.tile_overlap, common_args.workers, common_args.threads, common_args.provider)
+    input = np.load(common_args.input)
+
+    print('Tiled VAE')
+    print('--------------------------------------')
+    print(f'Model: {common_args.model}')
+    print(f'Mode: {"decode" if vae.decoder else "encode"}')
+    print(f'Input: {list(input.shape)}')
+    print(f'Tile: {vae.input_tile}, Overlap: {vae.input_overlap}')
+    print(f'Workers: {common_args.workers}')
+    print('--------------------------------------')
+
+    output = vae(input.astype(np.float32))
+    np.save(common_args.output, output)
+    print(f'Output: {common_args.output} {list(output.shape)}')
+    print('Tiled VAE Complete.')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,9 @@
+text_bucket = 0
+context_kv = False
+cross_attention_layers = 0 # cross-attention layers in the transformer, one key_<n>/value_<n> input pair each with context_kv, recorded from the transformer blocks
+cross_attention_dims = [] # key/value dims per layer, recorded when the transformer is loaded
+conditioning = False
+modulation_size = 0 # temb + timestep_proj columns per timestep, recorded when the transformer is loaded
+block_cache = False
+block_cache_dim = 0 # block_signal/block_residual channels (inner_dim), recorded when the transformer is loaded
+attention_chunk = 0 # query tokens per attention chunk (ONNX Loop), 0 = full attention
@@ -35,9 +35,16 @@ def parse_common_args(raw_args):
     parser = argparse.ArgumentParser("Common arguments")
     parser.add_argument("--input", default="stable-diffusion-xl", type=str)
     parser.add_argument("--output", default=None, type=Path)
-    parser.add_argument("--modules", default="tokenizer,text_encoder,vae_decoder,transformer", help="The modules to convert `tokenizer,text_encoder,vae_decoder,transformer`")
+    parser.add_argument("--modules", default="tokenizer,text_encoder,vae_decoder,transformer", help="The modules to convert `tokenizer,text_encoder,vae_decoder,vae_decoder_init,vae_decoder_stream,transformer`")
     parser.add_argument("--conversion", default="optimized", help="Type of conversion: optimized or unoptimized")
+    parser.add_argument("--attention_chunk", default=0, type=int, help="Export the transformer attention in query chunks of N tokens (ONNX Loop), scores are [N, keys] per head instead of [queries, keys], 0 = full attention")
     parser.add_argument("--clean", default=False, action="store_true", help="Deletes the Olive cache")
+    parser.add_argument("--io_dtype", default="float32", choices=["float32", "float16"], help="Graph input/output type of the float16 models, float16 drops the float32 casts at the graph boundary (io_manifest.json lists the types)")
+    parser.add_argument("--fuse_tokenizer", default=False, action="store_true", help="Also save text_encoder*/model_tokenizer.onnx with the tokenizer graph fused in front (string input, one session)")
+    parser.add_argument("--text_bucket", default=0, type=int, help="Dynamic T5 text length: attention_mask inputs, the T5 tokenizer pads to a multiple of text_bucket (64), 0 = fixed max_length")
+    parser.add_argument("--context_kv", default=False, action="store_true", help="Export the transformer with key_<n>/value_<n> cross-attention inputs, precomputed once per prompt by the context_projection model")
+    parser.add_argument("--conditioning", default=False, action="store_true", help="Also export the conditioning model (time embedding and projection for all timesteps in one run), the transformer takes a modulation input instead of timestep")
+    parser.add_argument("--block_cache", default=False, action="store_true", help="Also export transformer_replay (block_residual replayed in place of the block stack), the transformer gains block_signal/block_residual outputs")
     return parser.parse_known_args(raw_args)
 
 
@@ -1,5 +1,6 @@
+import config
 import torch
-from typing import Union, Tuple
+from typing import Optional, Union, Tuple
 from diffusers import AutoencoderKLWan, WanTransformer3DModel
 from transformers import  UMT5EncoderModel
 
@@ -20,9 +21,12 @@ class RandomDataLoader:
 # TEXT ENCODER
 # -----------------------------------------------------------------------------
 def text_encoder_inputs(batchsize, torch_dtype):
-    return {
+    inputs = {
         "input_ids": torch.zeros((batchsize, 512), dtype=torch_dtype)
     }
+    if config.text_bucket:
+        inputs["attention_mask"] = torch.ones((batchsize, 512), dtype=torch.int64)
+    return inputs
 
 
 def text_encoder_load(model_name):
@@ -62,6 +66,120 @@ def vae_decoder_data_loader(data_dir, batchsize, *args, **kwargs):
 
 
 
+# -----------------------------------------------------------------------------
+# VAE DECODER STREAM
+# -----------------------------------------------------------------------------
+class WanStreamingDecoder(torch.nn.Module):
+    # One latent frame per call, the causal conv feat_cache is carried as explicit inputs/outputs
+    # cache_indices None: first frame (vae_decoder_init), else later frames (vae_decoder_stream)
+    def __init__(self, vae, cache_indices=None):
+        super().__init__()
+        self.vae = vae
+        self.cache_indices = cache_indices
+        self.init_cache_indices = []
+        self.upsample_inputs = []
+        if cache_indices is None:
+            for module in vae.decoder.modules():
+                if getattr(module, "mode", None) == "upsample3d":
+                    module.register_forward_pre_hook(lambda module, args: self.upsample_inputs.append(args[0]))
+
+    def forward(self, latent_sample, *cache):
+        self.upsample_inputs.clear()
+        feat_cache = [None] * self.vae._conv_num
+        if self.cache_indices is not None:
+            for index, value in zip(self.cache_indices, cache):
+                feat_cache[index] = value
+
+        sample = self.vae.decoder(self.vae.post_quant_conv(latent_sample), feat_cache=feat_cache, feat_idx=[0])
+        sample = torch.clamp(sample, min=-1.0, max=1.0)
+        if self.cache_indices is not None:
+            return (sample, *[feat_cache[index] for index in self.cache_indices])
+
+        # First frame: "Rep" marks an upsample time_conv that was skipped, equal to a zero cache,
+        # one frame caches are left padded with the zeros the causal conv would have padded
+        upsample_inputs = iter(self.upsample_inputs)
+        self.init_cache_indices = [index for index, value in enumerate(feat_cache) if value is not None]
+        cache = []
+        for index in self.init_cache_indices:
+            value = feat_cache[index]
+            if isinstance(value, str):
+                value = torch.zeros_like(next(upsample_inputs))
+            cache.append(torch.cat([torch.zeros_like(value)] * (2 - value.shape[2]) + [value], dim=2))
+        return (sample, *cache)
+
+
+stream_cache = []
+
+
+def vae_decoder_stream_cache(model_name, height, width):
+    # First frame cache tensors and their feat_cache indices, the vae_decoder_stream dummy inputs
+    decoder = vae_decoder_init_load(model_name)
+    with torch.no_grad():
+        cache = decoder(torch.rand((1, 16, 1, height, width)))[1:]
+    return decoder.vae, decoder.init_cache_indices, cache
+
+
+def vae_decoder_stream_io_config(model_name, init):
+    _, cache_indices, _ = vae_decoder_stream_cache(model_name, 8, 8)
+    cache_names = [f"cache_{index}" for index in range(len(cache_indices))]
+    cache_out_names = [f"cache_out_{index}" for index in range(len(cache_indices))]
+    dynamic_axes = {
+        "latent_sample": { "3": "height", "4": "width" },
+        "sample": { "3": "sample_height", "4": "sample_width" }
+    }
+    for index in range(len(cache_indices)):
+        dynamic_axes[cache_names[index]] = { "3": f"cache_{index}_height", "4": f"cache_{index}_width" }
+        dynamic_axes[cache_out_names[index]] = { "3": f"cache_{index}_height", "4": f"cache_{index}_width" }
+    return {
+        "input_names": ["latent_sample"] + ([] if init else cache_names),
+        "output_names": ["sample"] + cache_out_names,
+        "dynamic_axes": dynamic_axes
+    }
+
+
+def vae_decoder_init_inputs(batchsize, torch_dtype):
+    return {
+        "latent_sample": torch.rand((1, 16, 1, 60, 104), dtype=torch_dtype)
+    }
+
+
+def vae_decoder_init_load(model_name):
+    model = AutoencoderKLWan.from_pretrained(model_name, subfolder="vae", torch_dtype=torch.float32)
+    return WanStreamingDecoder(model)
+
+
+def vae_decoder_init_conversion_inputs(model=None):
+    return tuple(vae_decoder_init_inputs(1, torch.float32).values())
+
+
+def vae_decoder_init_data_loader(data_dir, batchsize, *args, **kwargs):
+    return RandomDataLoader(vae_decoder_init_inputs, batchsize, torch.float16)
+
+
+def vae_decoder_stream_inputs(batchsize, torch_dtype):
+    inputs = {
+        "latent_sample": torch.rand((1, 16, 1, 60, 104), dtype=torch_dtype)
+    }
+    for index, value in enumerate(stream_cache):
+        inputs[f"cache_{index}"] = value.to(torch_dtype)
+    return inputs
+
+
+def vae_decoder_stream_load(model_name):
+    model, cache_indices, cache = vae_decoder_stream_cache(model_name, 60, 104)
+    stream_cache[:] = cache
+    return WanStreamingDecoder(model, cache_indices)
+
+
+def vae_decoder_stream_conversion_inputs(model=None):
+    return tuple(vae_decoder_stream_inputs(1, torch.float32).values())
+
+
+def vae_decoder_stream_data_loader(data_dir, batchsize, *args, **kwargs):
+    return RandomDataLoader(vae_decoder_stream_inputs, batchsize, torch.float16)
+
+
+
 # -----------------------------------------------------------------------------
 # TRANSFORMER
 # -----------------------------------------------------------------------------
@@ -85,11 +203,23 @@ def transformer_inputs(batchsize, torch_dtype, is_conversion_inputs=False):
         "timestep": torch.rand((1,), dtype=torch_dtype),
         "encoder_hidden_states": torch.rand((1, 512, 4096), dtype=torch_dtype)
     }
+    if config.context_kv:
+        inputs = context_kv_inputs(inputs)
+    if config.conditioning:
+        inputs = modulation_inputs(inputs)
     return inputs
 
 
 def transformer_load(model_name):
     model = WrappedWanTransformer3DModel.from_pretrained(model_name, subfolder="transformer", torch_dtype=torch.float32)
+    if config.context_kv:
+        context_kv_load(model)
+    if config.conditioning:
+        modulation_load(model)
+    if config.block_cache:
+        block_cache_load(model)
+    if config.attention_chunk:
+        attention_chunk_load(model)
     return model
 
 
@@ -98,4 +228,298 @@ def transformer_conversion_inputs(model=None):
 
 
 def transformer_data_loader(data_dir, batchsize, *args, **kwargs):
-    return RandomDataLoader(transformer_inputs, batchsize, torch.float16)
\ No newline at end of file
+    return RandomDataLoader(transformer_inputs, batchsize, torch.float16)
+
+
+
+# -----------------------------------------------------------------------------
+# CONTEXT PROJECTION
+# -----------------------------------------------------------------------------
+class ContextAttnProcessor:
+    # WanAttnProcessor2_0 for the text cross-attention, key/value are the precomputed context_projection outputs
+    def __init__(self):
+        self.key = None
+        self.value = None
+
+    def __call__(self, attn, hidden_states, encoder_hidden_states=None, attention_mask=None, rotary_emb=None):
+        query = attn.to_q(hidden_states)
+        if attn.norm_q is not None:
+            query = attn.norm_q(query)
+
+        query = query.unflatten(2, (attn.heads, -1)).transpose(1, 2)
+        key = self.key.unflatten(2, (attn.heads, -1)).transpose(1, 2)
+        value = self.value.unflatten(2, (attn.heads, -1)).transpose(1, 2)
+
+        hidden_states = torch.nn.functional.scaled_dot_product_attention(query, key, value, attn_mask=attention_mask, dropout_p=0.0, is_causal=False)
+        hidden_states = hidden_states.transpose(1, 2).flatten(2, 3).type_as(query)
+        hidden_states = attn.to_out[0](hidden_states)
+        hidden_states = attn.to_out[1](hidden_states)
+        return hidden_states
+
+
+def cross_attention_layers(model_name):
+    # One cross-attention layer per transformer block (30 for Wan2.1 1.3B, 40 for 14B), resolved from the model config before the io_config is built
+    config.cross_attention_layers = WrappedWanTransformer3DModel.load_config(model_name, subfolder="transformer")["num_layers"]
+    return config.cross_attention_layers
+
+
+def cross_attention_modules(model):
+    modules = [block.attn2 for block in model.blocks]
+    config.cross_attention_layers = len(modules)
+    if any(module.add_k_proj is not None for module in modules):
+        raise ValueError("context_kv supports the text-to-video transformer, the image-to-video cross-attention also reads image tokens")
+    return modules
+
+
+class ContextProjection(torch.nn.Module):
+    # text_embedder and the key/value projections of every cross-attention layer, computed once per prompt instead of every step
+    def __init__(self, transformer):
+        super().__init__()
+        self.text_embedder = transformer.condition_embedder.text_embedder
+        self.attentions = torch.nn.ModuleList(cross_attention_modules(transformer))
+
+    def forward(self, encoder_hidden_states):
+        encoder_hidden_states = self.text_embedder(encoder_hidden_states)
+        outputs = []
+        for attention in self.attentions:
+            key = attention.to_k(encoder_hidden_states)
+            if attention.norm_k is not None:
+                key = attention.norm_k(key)
+            outputs += [key, attention.to_v(encoder_hidden_states)]
+        return tuple(outputs)
+
+
+def context_kv_load(transformer):
+    # encoder_hidden_states input replaced by key_<n>/value_<n> per cross-attention layer, weight names are unchanged
+    attentions = cross_attention_modules(transformer)
+    processors = [ContextAttnProcessor() for attention in attentions]
+    for attention, processor in zip(attentions, processors):
+        attention.set_processor(processor)
+    config.cross_attention_dims = [attention.to_k.out_features for attention in attentions]
+    forward = transformer.forward
+
+    def context_kv_forward(hidden_states, timestep, *args):
+        cross_attention_kv, args = args[:len(processors) * 2], args[len(processors) * 2:]
+        for processor, key, value in zip(processors, cross_attention_kv[0::2], cross_attention_kv[1::2]):
+            processor.key, processor.value = key, value
+        # Placeholder, the cross-attention layers are the only encoder_hidden_states consumers
+        encoder_hidden_states = torch.zeros((cross_attention_kv[0].shape[0], 1, transformer.config.text_dim), dtype=hidden_states.dtype)
+        return forward(hidden_states, timestep, encoder_hidden_states, *args)
+    transformer.forward = context_kv_forward
+
+
+def context_kv_inputs(inputs):
+    # encoder_hidden_states [batch, sequence, 4096] -> key_<n>/value_<n> [batch, sequence, dim] at the same position
+    context_inputs = {}
+    for name, value in inputs.items():
+        if name != "encoder_hidden_states":
+            context_inputs[name] = value
+            continue
+        for index, dim in enumerate(config.cross_attention_dims):
+            context_inputs[f"key_{index}"] = torch.rand((*value.shape[:2], dim), dtype=value.dtype)
+            context_inputs[f"value_{index}"] = torch.rand((*value.shape[:2], dim), dtype=value.dtype)
+    return context_inputs
+
+
+def context_projection_inputs(batchsize, torch_dtype):
+    return {
+        "encoder_hidden_states": torch.rand((1, 512, 4096), dtype=torch_dtype)
+    }
+
+
+def context_projection_load(model_name):
+    model = WanTransformer3DModel.from_pretrained(model_name, subfolder="transformer", torch_dtype=torch.float32)
+    return ContextProjection(model)
+
+
+def context_projection_conversion_inputs(model=None):
+    return tuple(context_projection_inputs(1, torch.float32).values())
+
+
+def context_projection_data_loader(data_dir, batchsize, *args, **kwargs):
+    return RandomDataLoader(context_projection_inputs, batchsize, torch.float16)
+
+
+
+# -----------------------------------------------------------------------------
+# CONDITIONING
+# -----------------------------------------------------------------------------
+class Conditioning(torch.nn.Module):
+    # condition_embedder time embedding and projection, temb and the timestep_proj shared by every block for all scheduled timesteps in one run
+    def __init__(self, transformer):
+        super().__init__()
+        self.condition_embedder = transformer.condition_embedder
+
+    def forward(self, timestep):
+        # timestep [steps] -> modulation [steps, temb + timestep_proj]
+        embedder = self.condition_embedder
+        temb = embedder.time_embedder(embedder.timesteps_proj(timestep))
+        timestep_proj = embedder.time_proj(embedder.act_fn(temb))
+        return torch.cat([temb, timestep_proj], dim=1)
+
+
+def modulation_load(transformer):
+    # timestep input replaced by one conditioning modulation row, time_embedder/time_proj are not exported, the other weight names are unchanged
+    embedder = transformer.condition_embedder
+    sizes = [embedder.time_proj.in_features, embedder.time_proj.out_features]
+    config.modulation_size = sum(sizes)
+    forward = transformer.forward
+
+    def condition_embedder_forward(timestep, encoder_hidden_states, encoder_hidden_states_image=None):
+        temb, timestep_proj = embedder.modulation.split(sizes, dim=1)
+        encoder_hidden_states = embedder.text_embedder(encoder_hidden_states)
+        if encoder_hidden_states_image is not None:
+            encoder_hidden_states_image = embedder.image_embedder(encoder_hidden_states_image)
+        return temb, timestep_proj, encoder_hidden_states, encoder_hidden_states_image
+    embedder.forward = condition_embedder_forward
+
+    def conditioning_forward(hidden_states, modulation, *args):
+        embedder.modulation = modulation
+        # Placeholder, the patched condition_embedder does not read the timestep
+        timestep = torch.zeros((modulation.shape[0],), dtype=hidden_states.dtype)
+        return forward(hidden_states, timestep, *args)
+    transformer.forward = conditioning_forward
+
+
+def modulation_inputs(inputs):
+    # timestep -> modulation [batch, temb + timestep_proj] at the timestep position
+    conditioning_inputs = {}
+    for name, value in inputs.items():
+        if name == "timestep":
+            conditioning_inputs["modulation"] = torch.rand((value.shape[0], config.modulation_size), dtype=value.dtype)
+        else:
+            conditioning_inputs[name] = value
+    return conditioning_inputs
+
+
+def conditioning_inputs(batchsize, torch_dtype):
+    return {
+        "timestep": torch.rand((50,), dtype=torch_dtype)
+    }
+
+
+def conditioning_load(model_name):
+    model = WanTransformer3DModel.from_pretrained(model_name, subfolder="transformer", torch_dtype=torch.float32)
+    return Conditioning(model)
+
+
+def conditioning_conversion_inputs(model=None):
+    return tuple(conditioning_inputs(1, torch.float32).values())
+
+
+def conditioning_data_loader(data_dir, batchsize, *args, **kwargs):
+    return RandomDataLoader(conditioning_inputs, batchsize, torch.float16)
+
+
+
+# -----------------------------------------------------------------------------
+# BLOCK CACHE
+# -----------------------------------------------------------------------------
+class BlockSkip(torch.nn.Module):
+    # Replaces the first transformer block in transformer_replay, returns its input, norm1/scale_shift_table stay for the block_signal
+    def __init__(self, block):
+        super().__init__()
+        self.norm1 = block.norm1
+        self.scale_shift_table = block.scale_shift_table
+
+    def forward(self, hidden_states, *args):
+        return hidden_states
+
+
+def block_cache_load(transformer, replay=False):
+    # block_signal: the first block modulated input, cheap and follows how much the step output changes
+    # block_residual: block stack output - input (video patches), added back to the block stack input by transformer_replay
+    first_block = transformer.blocks[0]
+    if replay:
+        first_block = BlockSkip(first_block)
+        transformer.blocks = torch.nn.ModuleList([first_block])
+    config.block_cache_dim = transformer.proj_out.in_features
+    state = {}
+
+    def block_input_hook(module, args):
+        # args: hidden_states, encoder_hidden_states, timestep_proj [batch, 6, dim], rotary_emb
+        hidden_states, timestep_proj = args[0], args[2]
+        shift_msa, scale_msa = (module.scale_shift_table + timestep_proj.float()).chunk(6, dim=1)[:2]
+        state["input"] = hidden_states
+        state["signal"] = (module.norm1(hidden_states.float()) * (1 + scale_msa) + shift_msa).type_as(hidden_states)
+    first_block.register_forward_pre_hook(block_input_hook)
+
+    def block_output_hook(module, args):
+        if replay:
+            return (args[0] + state["residual"], *args[1:])
+        state["residual"] = args[0] - state["input"]
+    transformer.norm_out.register_forward_pre_hook(block_output_hook)
+    forward = transformer.forward
+
+    def block_cache_forward(*args):
+        if replay:
+            state["residual"] = args[-1]
+            return forward(*args[:-1])[0], state["signal"]
+        return forward(*args)[0], state["signal"], state["residual"]
+    transformer.forward = block_cache_forward
+
+
+def block_cache_inputs(inputs):
+    # block_residual [batch, (1, 2, 2) video patches, block_cache_dim] appended after the transformer inputs
+    hidden_states = inputs["hidden_states"]
+    patches = hidden_states.shape[2] * (hidden_states.shape[3] // 2) * (hidden_states.shape[4] // 2)
+    return {**inputs, "block_residual": torch.rand((hidden_states.shape[0], patches, config.block_cache_dim), dtype=hidden_states.dtype)}
+
+
+def transformer_replay_inputs(batchsize, torch_dtype):
+    return block_cache_inputs(transformer_inputs(batchsize, torch_dtype))
+
+
+def transformer_replay_load(model_name):
+    model = WrappedWanTransformer3DModel.from_pretrained(model_name, subfolder="transformer", torch_dtype=torch.float32)
+    if config.context_kv:
+        context_kv_load(model)
+    if config.conditioning:
+        modulation_load(model)
+    block_cache_load(model, True)
+    if config.attention_chunk:
+        attention_chunk_load(model)
+    return model
+
+
+def transformer_replay_conversion_inputs(model=None):
+    return tuple(transformer_replay_inputs(1, torch.float32).values())
+
+
+def transformer_replay_data_loader(data_dir, batchsize, *args, **kwargs):
+    return RandomDataLoader(transformer_replay_inputs, batchsize, torch.float16)
+
+
+# -----------------------------------------------------------------------------
+# CHUNKED ATTENTION
+# -----------------------------------------------------------------------------
+@torch.jit.script
+def query_chunk_attention(query: torch.Tensor, key: torch.Tensor, value: torch.Tensor, attn_mask: Optional[torch.Tensor], scale: Optional[float], chunk_size: int, chunk_mask: bool):
+    # Scripted, exported as an ONNX Loop over the dynamic query length: the scores are [chunk_size, keys] per head instead of [queries, keys]
+    outputs = []
+    for start in range(0, query.shape[-2], chunk_size):
+        mask = attn_mask
+        if mask is not None and chunk_mask:
+            mask = mask[..., start:start + chunk_size, :]
+        outputs.append(torch.nn.functional.scaled_dot_product_attention(query[..., start:start + chunk_size, :], key, value, attn_mask=mask, scale=scale))
+    return torch.cat(outputs, dim=-2)
+
+
+def chunked_scaled_dot_product_attention(query, key, value, attn_mask=None, dropout_p=0.0, is_causal=False, scale=None, **kwargs):
+    # Exact, every query chunk attends to all keys. Only a mask with a query dimension is chunked, broadcast masks are passed whole
+    chunk_mask = attn_mask is not None and attn_mask.shape[-2] != 1
+    return query_chunk_attention(query, key, value, attn_mask, scale, config.attention_chunk, chunk_mask)
+
+
+def attention_chunk_load(transformer):
+    # scaled_dot_product_attention runs in query chunks of config.attention_chunk tokens during the transformer forward, the attention processors are unchanged
+    forward = transformer.forward
+
+    def attention_chunk_forward(*args):
+        scaled_dot_product_attention = torch.nn.functional.scaled_dot_product_attention
+        torch.nn.functional.scaled_dot_product_attention = chunked_scaled_dot_product_attention
+        try:
+            return forward(*args)
+        finally:
+            torch.nn.functional.scaled_dot_product_attention = scaled_dot_product_attention
+    transformer.forward = attention_chunk_forward